@@ -1,4 +1,4 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .pura import is_threat, create_issue, add_comment_user_notified, fetch_emails, classify, handle_event
\ No newline at end of file
+from .pura import is_threat, is_threat_batch, create_issue, create_issues, add_comment_user_notified, fetch_emails, fetch_mailboxes, classify, classify_many, Classifier, handle_event, handle_events, run_pipeline, run_daemon, start_refresher, stop_refresher, feed_status, start_classifiers, stop_classifiers, classifier_stats, cascade_stats, stop_outbox, outbox_stats, message_stats
\ No newline at end of file
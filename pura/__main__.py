@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 import getopt
 import os
+import signal
 import sys
+import threading
 
 import pura
 from pura.helpers.logger import increase_log_level, log_to_file
@@ -10,13 +12,17 @@ from pura.helpers.logger import rootLogger as logger
 
 current = os.path.realpath(os.path.dirname(__file__))
 APPNAME = 'pura'
+# Emails fetched per mailbox in a one-shot run, so that a first run (or a UIDVALIDITY reset) does not process the whole mailbox
+LIMIT = 10
 
 
 INDENT = '  '
-HELPMSG = f'''usage: {APPNAME} [-v] [-l]
+HELPMSG = f'''usage: {APPNAME} [-v] [-l] [-d] [-n LIMIT]
     General options:
     {INDENT * 1}-v, --verbose       {INDENT * 2}Increase verbosity (can be used several times, e.g. -vvv).
     {INDENT * 1}-l, --log-file      {INDENT * 2}Write log events to the file `{APPNAME}.log`.
+    {INDENT * 1}-d, --daemon        {INDENT * 2}Keep running, and process new reports as they arrive (IMAP IDLE).
+    {INDENT * 1}-n, --limit         {INDENT * 2}Max. emails to process per mailbox in a one-shot run (default: {LIMIT}, 0 for no limit).
     {INDENT * 1}--help              {INDENT * 2}Print this message.
 '''
 
@@ -27,8 +33,9 @@ def main():
     argv = sys.argv[1:]
 
     try:
-        opts, args = getopt.getopt(argv, 'hlv', ['help', 'log-file', 'verbose'])
-    except getopt.GetoptError:
+        opts, args = getopt.getopt(argv, 'hlvdn:', ['help', 'log-file', 'verbose', 'daemon', 'limit='])
+        limit = int(next((arg for opt, arg in opts if opt in ('-n', '--limit')), LIMIT))
+    except (getopt.GetoptError, ValueError):
         print(HELPMSG)
         sys.exit(2)
 
@@ -56,11 +63,20 @@ def main():
             print(HELPMSG)
             sys.exit(0)
 
-    emls = pura.fetch_emails()
-    #emls = pura.fetch_testdata()
-    for eml in emls:
-        print(eml.subject)
-        pura.handle_event(eml)
+    if list(filter(lambda opt: opt[0] in ('-d', '--daemon'), opts)):
+        try:
+            pura.run_daemon()
+        except KeyboardInterrupt:
+            logger.info('[PURA  ] Stopping.')
+        sys.exit(0)
+
+    stop = threading.Event()
+    # Stop fetching on SIGINT or SIGTERM, and finish the emails that have been fetched already
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    pura.run_pipeline(limit=limit or None, stop=stop)
+    # Wait for the reports to be delivered to Jira. Those that are not stay in the outbox for the next run.
+    pura.stop_outbox()
     
 
 if __name__ == '__main__':
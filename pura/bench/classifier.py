@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of batch classification with a resident `Classifier`.
+
+Trains a TF-IDF + multinomial naive Bayes model (like `algo=mnb`) on synthetic email
+bodies, saves and loads it like `CLASSIFIER_MODEL_FILE`, and classifies the same emails
+in batches of different sizes: one sparse matrix and one `predict_proba` call per batch.
+
+usage: python -m pura.bench.classifier [emails] [batch size ...]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import make_pipeline
+
+from pura.bench.synthetic import generate_documents
+from pura.modules.classifier import Classifier
+
+EMAILS = 2048
+BATCH_SIZES = [1, 32, 256]
+
+
+def train(directory):
+    documents, labels = generate_documents(2000, seed=1)
+    model = make_pipeline(TfidfVectorizer(), MultinomialNB()).fit(documents, labels)
+    path = os.path.join(directory, 'model.joblib')
+    joblib.dump(model, path)
+    return path
+
+
+def run(classifier, documents, labels, batch_size):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(documents), batch_size):
+        results += classifier.classify_many(documents[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    return {
+        'batch_size': batch_size,
+        'emails_per_s': len(documents) / elapsed,
+        'accuracy': sum(1 for (label, _), expected in zip(results, labels) if label == expected) / len(labels),
+        'mean_confidence': sum(confidence for _, confidence in results) / len(results)
+    }
+
+
+def main():
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else EMAILS
+    batch_sizes = [int(arg) for arg in sys.argv[2:]] or BATCH_SIZES
+    documents, labels = generate_documents(emails, seed=2)
+    with tempfile.TemporaryDirectory() as directory:
+        classifier = Classifier.load(train(directory))
+    print(f'{emails} emails')
+    print(f'{"batch size":>10} {"emails/s":>10} {"accuracy":>9} {"confidence":>11}')
+    for batch_size in batch_sizes:
+        res = run(classifier, documents, labels, batch_size)
+        print(f'{res["batch_size"]:>10} {res["emails_per_s"]:>10.0f} {res["accuracy"]:>9.3f} {res["mean_confidence"]:>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of PURA: fetch, parse, threat intel, classify and report.
+
+Generates a synthetic corpus of emails and synthetic threat intel feeds, serves them from the
+in-process IMAP and feed stand-ins, and runs `run_pipeline` against the Jira stand-in, like
+`python -m pura` does. Every tenth email links to a URL of a feed, and the text of the others
+comes from the vocabularies of a fast model trained on synthetic documents (see
+`pura.bench.classifier`), so every tier of the classification cascade gets emails.
+
+Reports per pipeline stage the emails/s of a worker and the p50/p99 seconds per batch, and end
+to end the emails/s and the p50/p99 seconds from fetching an email to the creation of its
+Jira issue. The results are saved as JSON, to compare them across runs.
+
+Other settings are taken from the environment (e.g. `PIPELINE_BATCH_SIZE`, or `OUTBOX_FILE=` to
+report synchronously). The feeds, outbox, message store and mailbox state are kept in a temporary
+directory, and the classifier cache is disabled, so every run starts cold.
+
+usage: python -m pura.bench.end_to_end [emails] [feed size] [latency_ms] [output.json]
+"""
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+
+from pura import pura
+from pura.bench.classifier import train
+from pura.bench.standins import FeedServer, IMAPServer, JiraServer
+from pura.bench.synthetic import generate_csv_feed, generate_documents, generate_eml, generate_feed
+from pura.helpers.config import mail_config
+from pura.modules import classifier, jira_client, threat_intel
+from pura.modules.feed_cache import FeedCache
+from pura.modules.pipeline import percentile
+
+EMAILS = 500
+FEED_SIZE = 10000
+LATENCY_MS = 5
+OUTPUT = 'end_to_end.json'
+MAILBOXES = ['inbox', 'junk']
+FEEDS = 3
+THREAT_EVERY = 10
+SUBJECT_RE = re.compile(r'Subject: (.*)')
+
+
+def feeds(size):
+    # Plain feeds and a PhishTank-like CSV feed, and the URLs of the first feed
+    plain = {f'/feed_{i}.txt': ('\n'.join(generate_feed(size, seed=i)), 0.0) for i in range(FEEDS)}
+    csv = {'/online-valid.csv': (generate_csv_feed(size, seed=FEEDS), 0.0)}
+    urls = [line for line in generate_feed(size, seed=0) if line.startswith('http')]
+    return plain, csv, urls
+
+
+def corpus(emails, urls):
+    # Returns the messages of every mailbox, and the subject of every (mailbox, UID)
+    documents, _ = generate_documents(emails, seed=2)
+    mailboxes = {mailbox: [] for mailbox in MAILBOXES}
+    subjects = {}
+    for i in range(emails):
+        mailbox = MAILBOXES[i % len(MAILBOXES)]
+        threat = i % THREAT_EVERY == 0
+        mailboxes[mailbox].append(generate_eml(i, seed=1, url=urls[i % len(urls)] if threat else None, text=None if threat else documents[i]))
+        subjects[(mailbox, len(mailboxes[mailbox]))] = f'Account verification #{i}'
+    return mailboxes, subjects
+
+
+def configure(directory, feed_server, imap, jira, plain, csv):
+    # Points PURA at the stand-ins, like `pura.bench.feed_fetch` and `pura.bench.imap_fetch` do
+    mail_config['imap'].update({'server': '127.0.0.1', 'port': imap.port, 'ssl': False})
+    mail_config['auth'].update({'user': 'bench', 'pass': 'bench'})
+    mail_config.update({'mailboxes': MAILBOXES, 'state_file': os.path.join(directory, 'mailbox_state.json')})
+    jira_client.JIRA_SERVER, jira_client.JIRA_USER, jira_client.JIRA_TOKEN = jira.url, 'bench', 'bench'
+    jira_client.JIRA_ASSIGNEES = jira.users
+    threat_intel.CACHE = FeedCache(cache_dir=os.path.join(directory, 'feeds'))
+    threat_intel.SNAPSHOT_DIR = None
+    threat_intel.FEEDS = {'plain': [feed_server.url(path) for path in plain], 'csv': [feed_server.url(path) for path in csv]}
+    classifier.CACHE_FILE = ''
+    classifier.FAST_MODEL_FILE = train(directory)
+    pura.MESSAGE_STORE_FILE = os.path.join(directory, 'messages.sqlite')
+    if pura.OUTBOX_FILE:
+        pura.OUTBOX_FILE = os.path.join(directory, 'outbox.sqlite')
+
+
+def main():
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else EMAILS
+    feed_size = int(sys.argv[2]) if len(sys.argv) > 2 else FEED_SIZE
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else LATENCY_MS) / 1000
+    output = sys.argv[4] if len(sys.argv) > 4 else OUTPUT
+
+    plain, csv, urls = feeds(feed_size)
+    mailboxes, subjects = corpus(emails, urls)
+
+    with tempfile.TemporaryDirectory() as directory, \
+            FeedServer({**plain, **csv}) as feed_server, \
+            IMAPServer(mailboxes, latency=latency) as imap, \
+            JiraServer(latency=latency) as jira:
+        configure(directory, feed_server, imap, jira, plain, csv)
+        # Load the feeds and the model before the clock starts, like a running daemon has
+        start = time.perf_counter()
+        threat_intel.is_threat_batch([['warm-up.invalid']])
+        feeds_s = time.perf_counter() - start
+        classifier.fast_classifier()
+
+        start, started = time.perf_counter(), time.time()
+        stages = pura.run_pipeline()
+        pura.stop_outbox()
+        elapsed = time.perf_counter() - start
+
+        created = {SUBJECT_RE.search(issue['fields']['description']).group(1): issue['created'] for issue in jira.issues.values()}
+        latencies = [created[subjects[key]] - fetched for key, fetched in imap.fetched.items() if subjects[key] in created]
+        fetch_s = max(imap.fetched.values(), default=started) - started
+        results = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'parameters': {
+                'emails': emails,
+                'feed_size': feed_size,
+                'feeds': len(plain) + len(csv),
+                'latency_ms': latency * 1000,
+                'outbox': bool(pura.OUTBOX_FILE),
+                'queue_size': pura.PIPELINE_QUEUE_SIZE,
+                'batch_size': pura.PIPELINE_BATCH_SIZE
+            },
+            'feeds_load_s': feeds_s,
+            'stages': {
+                'fetch': {'in': len(imap.fetched), 'seconds': fetch_s, 'emails_per_s': len(imap.fetched) / fetch_s if fetch_s else 0.0},
+                **{name: dict(stats, emails_per_s=stats['in'] / stats['seconds'] if stats['seconds'] else 0.0) for name, stats in stages.items()}
+            },
+            'end_to_end': {
+                'emails': emails,
+                'issues': len(jira.issues),
+                'seconds': elapsed,
+                'emails_per_s': emails / elapsed,
+                # From fetching an email to the creation of its issue
+                'p50_s': percentile(latencies, 50),
+                'p99_s': percentile(latencies, 99)
+            },
+            'cascade': pura.cascade_stats(),
+            'jira_calls': dict(jira.calls),
+            'imap_commands': imap.commands
+        }
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    end_to_end = results['end_to_end']
+    print(f'{emails} emails, {feed_size} entries per feed, {latency * 1000:.0f} ms latency per IMAP command and Jira call')
+    print(f'{"stage":>13} {"emails":>7} {"emails/s":>9} {"p50 (s)":>8} {"p99 (s)":>8}')
+    for name, stats in results['stages'].items():
+        # Fetching is not a stage of the pipeline, so it has no batch latencies
+        latency_s = f'{stats["p50_s"]:>8.3f} {stats["p99_s"]:>8.3f}' if 'p50_s' in stats else f'{"-":>8} {"-":>8}'
+        print(f'{name:>13} {stats["in"]:>7} {stats["emails_per_s"]:>9.1f} {latency_s}')
+    print(f'{"end to end":>13} {emails:>7} {end_to_end["emails_per_s"]:>9.1f} {end_to_end["p50_s"]:>8.3f} {end_to_end["p99_s"]:>8.3f}')
+    print(f'{end_to_end["issues"]} issues in {end_to_end["seconds"]:.2f}s. Saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the concurrent threat intel feed fetching.
+
+Serves a set of synthetic feeds with injected delays from a local HTTP stand-in,
+one of which is slower than the total deadline, and measures the wall time of `is_threat`.
+
+usage: python -m pura.bench.feed_fetch
+"""
+import time
+
+from pura.bench.standins import FeedServer
+from pura.bench.synthetic import generate_feed
+import pura.modules.threat_intel as threat_intel
+
+DELAYS = [0.5, 0.5, 1.0, 1.0, 1.5]
+SLOW_DELAY = 5.0
+DEADLINE = 2.0
+
+
+def main():
+    feeds = {f'/feed_{i}.txt': ('\n'.join(generate_feed(1000, seed=i)), delay) for i, delay in enumerate(DELAYS)}
+    feeds['/slow.txt'] = ('\n'.join(generate_feed(1000, seed=99)), SLOW_DELAY)
+
+    with FeedServer(feeds) as server:
+        threat_intel.CACHE = None
+        threat_intel.FEED_DEADLINE = DEADLINE
+        threat_intel.FEEDS = {'plain': [server.url(path) for path in feeds], 'csv': []}
+
+        start = time.perf_counter()
+        threat_intel.is_threat(['http://example.com/login'])
+        elapsed = time.perf_counter() - start
+
+    print(f'Feeds:               {len(feeds)} (delays: {DELAYS + [SLOW_DELAY]})')
+    print(f'Sequential estimate: {sum(DELAYS) + SLOW_DELAY:.2f}s')
+    print(f'Deadline:            {DEADLINE:.2f}s')
+    print(f'Concurrent:          {elapsed:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
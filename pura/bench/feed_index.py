@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the threat intel feed lookups.
+
+Compares the compiled `FeedIndex` against the previous approach, which
+re-stripped the feed for every host and scanned it as a list.
+Only hosts present in the feed are looked up, so both sides are measured on the exact-match path.
+
+usage: python -m pura.bench.feed_index [size ...]
+"""
+import random
+import sys
+import time
+
+from pura.bench.synthetic import generate_feed
+from pura.modules.feed_index import FeedIndex
+
+SIZES = [1000, 10000, 100000]
+HOSTS_PER_EMAIL = 40
+
+
+def __legacy_lookup(host, feed):
+    feed = [line.split()[0] for line in feed if not line.startswith('#') and line != '']
+    return host in feed
+
+
+def __sample_hosts(feed, n, seed=1):
+    rng = random.Random(seed)
+    entries = [line.split()[0] for line in feed if not line.startswith('#')]
+    return [rng.choice(entries) for _ in range(n)]
+
+
+def run(size):
+    feed = generate_feed(size)
+    hosts = __sample_hosts(feed, HOSTS_PER_EMAIL)
+
+    start = time.perf_counter()
+    index = FeedIndex(feed)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for host in hosts:
+        index.lookup(host)
+    indexed = (time.perf_counter() - start) / len(hosts)
+
+    start = time.perf_counter()
+    for host in hosts:
+        __legacy_lookup(host, feed)
+    legacy = (time.perf_counter() - start) / len(hosts)
+
+    return {
+        'size': size,
+        'build_s': build,
+        'indexed_us_per_host': indexed * 1e6,
+        'legacy_us_per_host': legacy * 1e6
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f'{"feed size":>10} {"build (ms)":>12} {"index (us/host)":>16} {"list scan (us/host)":>20}')
+    for size in sizes:
+        res = run(size)
+        print(f'{res["size"]:>10} {res["build_s"] * 1e3:>12.1f} {res["indexed_us_per_host"]:>16.2f} {res["legacy_us_per_host"]:>20.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the peak memory used to download and parse a CSV feed.
+
+Compares the streaming parser of `threat_intel` with the previous approach, which
+materialised the response text, split it into a list of lines and split every line on commas.
+Every run happens in its own process, and reports the growth of its peak RSS.
+
+usage: python -m pura.bench.feed_parse [size]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+import requests
+
+from pura.bench.standins import FeedServer
+from pura.bench.synthetic import generate_csv_feed
+from pura.helpers.hosts import is_ip, is_url
+from pura.modules.feed_index import FeedIndex
+import pura.modules.threat_intel as threat_intel
+
+SIZE = 200000
+
+
+def __legacy(url):
+    lines = requests.get(url).text.split('\n')
+    headers = lines.pop(0).split(',')
+    index = headers.index('url')
+    hosts = []
+    for line in lines:
+        line = line.split(',')
+        try:
+            data = line[index]
+            if data and (is_ip(data) or is_url(data)):
+                hosts.append(data)
+        except IndexError:
+            pass
+    return FeedIndex(hosts)
+
+
+def __streaming(url):
+    threat_intel.CACHE = None
+    threat_intel.FEEDS = {'plain': [], 'csv': [url]}
+    threat_intel.is_threat(['http://example.com/'])
+
+
+def __run(target, url, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    target(url)
+    elapsed = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((elapsed, (after - before) / 1024))
+
+
+def measure(target, url):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=__run, args=(target, url, queue))
+    process.start()
+    res = queue.get()
+    process.join()
+    return res
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else SIZE
+    body = generate_csv_feed(size)
+    with FeedServer({'/online-valid.csv': (body, 0)}) as server:
+        url = server.url('/online-valid.csv')
+        legacy_s, legacy_mb = measure(__legacy, url)
+        streaming_s, streaming_mb = measure(__streaming, url)
+
+    print(f'CSV feed: {size} rows, {len(body) / 2**20:.1f} MB')
+    print(f'{"":>10} {"time (s)":>9} {"peak RSS growth (MB)":>21}')
+    print(f'{"legacy":>10} {legacy_s:>9.2f} {legacy_mb:>21.1f}')
+    print(f'{"streaming":>10} {streaming_s:>9.2f} {streaming_mb:>21.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the memory-mapped feed snapshots.
+
+Compares building an in-memory `FeedIndex` from the feed lines with opening a
+`SnapshotIndex` of the same feed: load time, Python heap allocated (the mapped pages
+live in the shared page cache and are not counted) and lookup cost.
+
+usage: python -m pura.bench.feed_snapshot [size ...]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pura.bench.synthetic import generate_feed
+from pura.modules.feed_index import FeedIndex
+from pura.modules.feed_snapshot import SnapshotIndex, write_snapshot
+
+SIZES = [10000, 100000, 500000]
+LOOKUPS = 1000
+
+
+def __measure(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = load()
+    elapsed = time.perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return index, elapsed, allocated
+
+
+def __lookup_us(index, hosts):
+    start = time.perf_counter()
+    for host in hosts:
+        index.lookup(host)
+    return (time.perf_counter() - start) / len(hosts) * 1e6
+
+
+def run(size, directory):
+    feed = generate_feed(size)
+    rng = random.Random(1)
+    hosts = [rng.choice(feed[2:]).split()[0] for _ in range(LOOKUPS)]
+    path = os.path.join(directory, f'feed_{size}.snap')
+
+    index, build_s, build_bytes = __measure(lambda: FeedIndex(feed))
+    write_snapshot(index, path)
+    index_us = __lookup_us(index, hosts)
+    del index
+
+    snapshot, open_s, open_bytes = __measure(lambda: SnapshotIndex(path))
+    snapshot_us = __lookup_us(snapshot, hosts)
+    snapshot.close()
+
+    return {
+        'size': size,
+        'snapshot_bytes': os.path.getsize(path),
+        'build_ms': build_s * 1e3,
+        'build_heap_mb': build_bytes / 2**20,
+        'open_ms': open_s * 1e3,
+        'open_heap_mb': open_bytes / 2**20,
+        'index_us_per_host': index_us,
+        'snapshot_us_per_host': snapshot_us
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    print(f'{"feed size":>10} {"file (MB)":>10} {"build (ms)":>11} {"heap (MB)":>10} {"open (ms)":>10} {"heap (MB)":>10} {"index (us)":>11} {"snapshot (us)":>14}')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            res = run(size, directory)
+            print(f'{res["size"]:>10} {res["snapshot_bytes"] / 2**20:>10.1f} {res["build_ms"]:>11.1f} {res["build_heap_mb"]:>10.1f} {res["open_ms"]:>10.2f} {res["open_heap_mb"]:>10.3f} {res["index_us_per_host"]:>11.1f} {res["snapshot_us_per_host"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of per-message vs. bulk IMAP fetching.
+
+Serves a synthetic mailbox from the in-process IMAP stand-in with a fixed latency per
+command, to emulate a WAN link, and compares one `UID FETCH` per email with
+`FetchMail.fetch_sizes` + `FetchMail.fetch_many`.
+
+usage: python -m pura.bench.imap_fetch [emails] [latency_ms]
+"""
+import sys
+import time
+
+from pura.bench.standins import IMAPServer
+from pura.bench.synthetic import generate_eml
+from pura.helpers.config import mail_config
+from pura.modules.mail_client import FetchMail
+
+EMAILS = 200
+LATENCY_MS = 20
+
+
+def connect(port):
+    mail_config['imap'].update({'server': '127.0.0.1', 'port': port, 'ssl': False})
+    mail_config['auth'].update({'user': 'bench', 'pass': 'bench'})
+    return FetchMail()
+
+
+def main():
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else EMAILS
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else LATENCY_MS) / 1000
+
+    with IMAPServer({'inbox': [generate_eml(i) for i in range(emails)]}, latency=latency) as server:
+        client = connect(server.port)
+        uids = client.search_uids()
+
+        commands = server.commands
+        start = time.perf_counter()
+        for uid in uids:
+            client.fetch_uid(uid)
+        single_s = time.perf_counter() - start
+        single_commands = server.commands - commands
+
+        commands = server.commands
+        start = time.perf_counter()
+        client.fetch_sizes(uids)
+        fetched = sum(1 for _ in client.fetch_many(uids))
+        bulk_s = time.perf_counter() - start
+        bulk_commands = server.commands - commands
+
+    print(f'{emails} emails, {latency * 1000:.0f} ms latency per command')
+    print(f'{"":>12} {"commands":>9} {"time (s)":>9} {"emails/s":>9}')
+    print(f'{"per email":>12} {single_commands:>9} {single_s:>9.2f} {emails / single_s:>9.1f}')
+    print(f'{"bulk":>12} {bulk_commands:>9} {bulk_s:>9.2f} {fetched / bulk_s:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the REST calls made to report emails to Jira.
+
+Serves the Jira REST API from the in-process stand-in with a fixed latency per call, and
+reports the same low-confidence emails (which get the `Highest` priority and an assignee)
+three ways: the previous sequence of calls per email (create, fetch, set priority, search
+assignable users, assign, set priority again, attach), `create_issue` per email (one create
+call with priority and assignee, then the attachment), and `create_issues` (one bulk create
+call, then the attachments concurrently).
+
+usage: python -m pura.bench.jira_report [emails] [latency_ms]
+"""
+import io
+import random
+import sys
+import time
+
+from pura.bench.standins import JiraServer
+from pura.modules import jira_client
+
+EMAILS = 50
+LATENCY_MS = 20
+ATTACHMENT = b'From: e.vil@corp.ir\r\nSubject: Please verify your contact details\r\n\r\n' + b'x' * 4096
+
+
+def reports(emails):
+    return [{
+        'classification': 'Phishing',
+        'confidence_level': '42.0',
+        'recipient': 'hidden',
+        'email_sender': f'sender{i}@example.com',
+        'email_subject': f'Please verify your account #{i}',
+        'timedate': '15/04/2020:13:37',
+        'attachment': io.BytesIO(ATTACHMENT)
+    } for i in range(emails)]
+
+
+def legacy(jc, report):
+    # The calls `create_issue` made per email before priority and assignee were set on creation
+    issue = jc.create_issue(fields={
+        'project': {'key': 'SEC'},
+        'summary': f'[{report["classification"]}] for user {report["recipient"]}',
+        'description': report['email_subject'],
+        'issuetype': {'name': 'Task'}
+    })
+    issue.update(fields={'priority': {'id': '2', 'name': 'High'}})
+    users = jc.search_assignable_users_for_projects('', 'SEC')
+    jc.assign_issue(issue.key, random.choice(users).accountId)
+    issue.update(fields={'priority': {'id': '1', 'name': 'Highest'}})
+    jc.add_attachment(issue.key, report['attachment'], 'email')
+    return issue.key
+
+
+def measure(server, func):
+    server.calls.clear()
+    start = time.perf_counter()
+    keys = func()
+    return sum(1 for key in keys if key), server.total_calls, time.perf_counter() - start
+
+
+def main():
+    emails = int(sys.argv[1]) if len(sys.argv) > 1 else EMAILS
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else LATENCY_MS) / 1000
+
+    with JiraServer(latency=latency) as server:
+        # `jira_client` connects on first use
+        jira_client.JIRA_SERVER, jira_client.JIRA_USER, jira_client.JIRA_TOKEN = server.url, 'bench', 'bench'
+        jira_client.JIRA_ASSIGNEES = server.users
+
+        results = {
+            'previous': measure(server, lambda: [legacy(jira_client.client(), report) for report in reports(emails)]),
+            'create_issue': measure(server, lambda: [jira_client.create_issue(**report) for report in reports(emails)]),
+            'create_issues': measure(server, lambda: jira_client.create_issues(reports(emails)))
+        }
+
+    print(f'{emails} emails, {latency * 1000:.0f} ms latency per call')
+    print(f'{"":>14} {"issues":>7} {"calls":>7} {"calls/email":>12} {"time (s)":>9} {"emails/s":>9}')
+    for name, (issues, calls, elapsed) in results.items():
+        print(f'{name:>14} {issues:>7} {calls:>7} {calls / emails:>12.1f} {elapsed:>9.2f} {emails / elapsed:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
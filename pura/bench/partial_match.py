@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the threat intel partial matches.
+
+Compares the `DomainTrie` backed partial matching of `FeedIndex` against the
+previous list comprehensions, which scanned every feed line for every host.
+The hosts are a mix of subdomains and paths of feed entries and hosts that are not in the feed,
+so that every lookup goes past the exact matches. The run fails if the trie and the
+list comprehensions do not find the same number of hosts.
+
+usage: python -m pura.bench.partial_match [size ...]
+"""
+import random
+import sys
+import time
+
+from pura.bench.synthetic import generate_feed, random_url
+from pura.helpers.hosts import get_fqdn, get_fqdn_path, is_ip, is_url
+from pura.modules.feed_index import FeedIndex
+
+SIZES = [1000, 10000, 100000]
+HOSTS_PER_EMAIL = 40
+
+
+def __legacy_partial(host, feed):
+    match = [line for line in feed if host in line]
+    if is_url(host):
+        fqdn_path = get_fqdn_path(host)
+        match = [line for line in feed if fqdn_path in line]
+        if match:
+            return True, 0.8
+        fqdn = get_fqdn(host)
+        match = [line for line in feed if fqdn in line]
+        if match:
+            return True, 0.6
+    if is_ip(host):
+        match = [line for line in feed if host in line]
+        if match:
+            return True, 0.6
+    if match:
+        return True, 0.7
+    return False, 0.0
+
+
+def __sample_hosts(entries, n, seed=1):
+    rng = random.Random(seed)
+    urls = [entry for entry in entries if entry.startswith('http')]
+    hosts = []
+    for i in range(n):
+        if i % 3 == 0:
+            hosts.append(rng.choice(urls).rsplit('/', 1)[0] + '/')
+        elif i % 3 == 1:
+            hosts.append('http://www.' + get_fqdn(rng.choice(urls)) + '/index.html')
+        else:
+            hosts.append(random_url(rng))
+    return hosts
+
+
+def run(size):
+    feed = generate_feed(size)
+    entries = [line.split()[0] for line in feed if not line.startswith('#')]
+    hosts = __sample_hosts(entries, HOSTS_PER_EMAIL)
+    index = FeedIndex(feed)
+
+    start = time.perf_counter()
+    indexed = [index.lookup(host) for host in hosts]
+    indexed_s = (time.perf_counter() - start) / len(hosts)
+
+    start = time.perf_counter()
+    legacy = [__legacy_partial(host, entries) for host in hosts]
+    legacy_s = (time.perf_counter() - start) / len(hosts)
+
+    return {
+        'size': size,
+        'indexed_us_per_host': indexed_s * 1e6,
+        'legacy_us_per_host': legacy_s * 1e6,
+        'indexed_hits': sum(1 for found, _ in indexed if found),
+        'legacy_hits': sum(1 for found, _ in legacy if found)
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    failed = False
+    print(f'{"feed size":>10} {"trie (us/host)":>15} {"list comp. (us/host)":>21} {"hits (trie/list)":>17}')
+    for size in sizes:
+        res = run(size)
+        hits = f'{res["indexed_hits"]}/{res["legacy_hits"]}'
+        print(f'{res["size"]:>10} {res["indexed_us_per_host"]:>15.2f} {res["legacy_us_per_host"]:>21.2f} {hits:>17}')
+        if res['indexed_hits'] != res['legacy_hits']:
+            failed = True
+    if failed:
+        sys.exit('The trie and the list comprehensions found a different number of hosts')
+
+
+if __name__ == '__main__':
+    main()
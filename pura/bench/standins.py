@@ -0,0 +1,542 @@
+import json
+import re
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FeedServer:
+    """A local HTTP stand-in for the threat intel feeds
+
+        Parameters
+        ----------
+        feeds : dict
+            The feeds to serve, keyed by path: { '/feed.txt': (body, delay) }
+            body : string
+                The content of the feed.
+            delay : float
+                Seconds to wait before responding.
+    """
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if self.path not in server.feeds:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body, delay = server.feeds[self.path]
+                if delay:
+                    time.sleep(delay)
+                body = body.encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.httpd.server_port}{path}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class IMAPServer:
+    """A minimal, in-process IMAP4rev1 stand-in (plain text, no TLS)
+
+        Supports LOGIN, SELECT/EXAMINE, STATUS, LIST, SEARCH, FETCH, the UID variants of
+        SEARCH and FETCH, IDLE, NOOP and LOGOUT, which is what `FetchMail` uses.
+        Clients in IDLE are sent `EXISTS` as soon as a message is appended to their mailbox, and
+        messages appended before the IDLE are reported in the same write as its continuation
+        (or before it, with `exists_before_idle`).
+        The time that every message was first sent to a client is kept in `fetched`, keyed by (mailbox, UID).
+
+        Parameters
+        ----------
+        mailboxes : dict
+            The messages of every mailbox, keyed by name: { 'inbox': [bytes, ...] }
+            Message UIDs are assigned from 1, in order.
+        latency : float
+            Seconds to wait before answering every command, to emulate a WAN link.
+        exists_before_idle : bool
+            Whether the messages appended before an IDLE are reported before its continuation, which RFC 2177 allows.
+    """
+    def __init__(self, mailboxes, latency=0.0, uidvalidity=1, exists_before_idle=False):
+        self.latency = latency
+        self.exists_before_idle = exists_before_idle
+        self.commands = 0
+        self.fetched = {}
+        self.lock = threading.Lock()
+        self.idlers = set()
+        self.connections = set()
+        self.mailboxes = {}
+        for name, messages in mailboxes.items():
+            self.mailboxes[name.lower()] = {'uidvalidity': uidvalidity, 'next_uid': 1, 'messages': []}
+            for message in messages:
+                self.append(name, message)
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.selected = None
+                # The number of messages in the selected mailbox that the client has been told about
+                self.exists = 0
+                self.write_lock = threading.Lock()
+                with server.lock:
+                    server.connections.add(self)
+                try:
+                    self.serve()
+                except OSError:
+                    pass
+                finally:
+                    with server.lock:
+                        server.connections.discard(self)
+                        server.idlers.discard(self)
+
+            def serve(self):
+                self.send(b'* OK [CAPABILITY IMAP4rev1] PURA IMAP stand-in ready')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    try:
+                        tag, command, args = self.parse(line.decode('utf-8').rstrip('\r\n'))
+                    except ValueError:
+                        self.send(b'* BAD Invalid command')
+                        continue
+                    with server.lock:
+                        server.commands += 1
+                    if server.latency:
+                        time.sleep(server.latency)
+                    if not self.dispatch(tag, command, args):
+                        return
+
+            def send(self, data):
+                with self.write_lock:
+                    self.wfile.write(data + b'\r\n')
+
+            @staticmethod
+            def parse(line):
+                tag, command, *rest = line.split(' ', 2)
+                return tag, command.upper(), rest[0] if rest else ''
+
+            def dispatch(self, tag, command, args):
+                ok = f'{tag} OK {command} completed'.encode()
+                if command == 'LOGOUT':
+                    self.send(b'* BYE Logging out')
+                    self.send(ok)
+                    return False
+                if command == 'CAPABILITY':
+                    self.send(b'* CAPABILITY IMAP4rev1 IDLE')
+                elif command in ('LOGIN', 'NOOP'):
+                    pass
+                elif command == 'IDLE':
+                    with server.lock:
+                        server.idlers.add(self)
+                        count = len(server.mailboxes[self.selected]['messages']) if self.selected else 0
+                        known, self.exists = self.exists, max(self.exists, count)
+                    exists = f'* {count} EXISTS'.encode() if count > known else b''
+                    if exists and server.exists_before_idle:
+                        self.send(exists + b'\r\n+ idling')
+                    else:
+                        self.send(b'+ idling' + (b'\r\n' + exists if exists else b''))
+                    line = self.rfile.readline()
+                    with server.lock:
+                        server.idlers.discard(self)
+                    if not line:
+                        return False
+                    if line.strip().upper() != b'DONE':
+                        self.send(f'{tag} BAD Expected DONE'.encode())
+                        return True
+                elif command in ('SELECT', 'EXAMINE'):
+                    name = args.strip('"').lower()
+                    if name not in server.mailboxes:
+                        self.send(f'{tag} NO Mailbox does not exist'.encode())
+                        return True
+                    self.selected = name
+                    mailbox = server.mailboxes[name]
+                    self.exists = len(mailbox['messages'])
+                    self.send(f'* {self.exists} EXISTS'.encode())
+                    self.send(f'* OK [UIDVALIDITY {mailbox["uidvalidity"]}] UIDs valid'.encode())
+                    self.send(f'* OK [UIDNEXT {mailbox["next_uid"]}] Predicted next UID'.encode())
+                elif command == 'STATUS':
+                    name = args.split(' ', 1)[0].strip('"')
+                    mailbox = server.mailboxes.get(name.lower())
+                    if mailbox is None:
+                        self.send(f'{tag} NO Mailbox does not exist'.encode())
+                        return True
+                    self.send(f'* STATUS {name} (MESSAGES {len(mailbox["messages"])} UIDVALIDITY {mailbox["uidvalidity"]} UIDNEXT {mailbox["next_uid"]})'.encode())
+                elif command == 'LIST':
+                    for name in server.mailboxes:
+                        self.send(f'* LIST () "/" "{name}"'.encode())
+                elif command == 'SEARCH':
+                    self.search(args, uid=False)
+                elif command == 'FETCH':
+                    self.fetch(args, uid=False)
+                elif command == 'UID':
+                    subcommand, _, args = args.partition(' ')
+                    if subcommand.upper() == 'SEARCH':
+                        self.search(args, uid=True)
+                    elif subcommand.upper() == 'FETCH':
+                        self.fetch(args, uid=True)
+                    else:
+                        self.send(f'{tag} BAD Unsupported UID command'.encode())
+                        return True
+                else:
+                    self.send(f'{tag} BAD Unsupported command'.encode())
+                    return True
+                self.send(ok)
+                return True
+
+            def messages(self):
+                return server.mailboxes[self.selected]['messages'] if self.selected else []
+
+            @staticmethod
+            def in_set(value, message_set, highest):
+                for part in message_set.split(','):
+                    first, _, last = part.partition(':')
+                    first = highest if first == '*' else int(first)
+                    last = first if not last else (highest if last == '*' else int(last))
+                    if min(first, last) <= value <= max(first, last):
+                        return True
+                return False
+
+            def matching(self, message_set, uid):
+                messages = self.messages()
+                if not messages:
+                    return []
+                highest = messages[-1][0] if uid else len(messages)
+                return [(seq, msg_uid, message) for seq, (msg_uid, message) in enumerate(messages, 1) if self.in_set(msg_uid if uid else seq, message_set, highest)]
+
+            def search(self, args, uid):
+                criteria = args.upper().replace('CHARSET UTF-8', '').strip()
+                if criteria.startswith('UID '):
+                    found = [msg_uid for _, msg_uid, _ in self.matching(criteria.split(' ', 1)[1], uid=True)]
+                    if not uid:
+                        found = [seq for seq, _, _ in self.matching(criteria.split(' ', 1)[1], uid=True)]
+                else:
+                    found = [msg_uid if uid else seq for seq, (msg_uid, _) in enumerate(self.messages(), 1)]
+                self.send(('* SEARCH ' + ' '.join(str(n) for n in found)).strip().encode())
+
+            def fetch(self, args, uid):
+                message_set, _, items = args.partition(' ')
+                items = items.upper().strip('()').split()
+                for seq, msg_uid, message in self.matching(message_set, uid):
+                    parts = [f'UID {msg_uid}'.encode()]
+                    literals = []
+                    if 'RFC822.SIZE' in items:
+                        parts.append(f'RFC822.SIZE {len(message)}'.encode())
+                    if 'BODY.PEEK[HEADER]' in items or 'BODY[HEADER]' in items:
+                        literals.append((b'BODY[HEADER]', re.split(rb'\r?\n\r?\n', message, 1)[0] + b'\r\n\r\n'))
+                    if 'RFC822' in items or 'BODY.PEEK[]' in items or 'BODY[]' in items:
+                        literals.append((b'RFC822', message))
+                        server.fetched.setdefault((self.selected, msg_uid), time.time())
+                    response = f'* {seq} FETCH ('.encode() + b' '.join(parts)
+                    for name, literal in literals:
+                        response += b' ' + name + f' {{{len(literal)}}}'.encode()
+                        with self.write_lock:
+                            self.wfile.write(response + b'\r\n' + literal)
+                        response = b''
+                    self.send(response + b')')
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def append(self, mailbox, message):
+        """Add a message to a mailbox, returning its UID"""
+        name = mailbox.lower()
+        with self.lock:
+            mailbox = self.mailboxes[name]
+            uid = mailbox['next_uid']
+            mailbox['messages'].append((uid, message))
+            mailbox['next_uid'] += 1
+            count = len(mailbox['messages'])
+            idlers = [idler for idler in self.idlers if idler.selected == name]
+            for idler in idlers:
+                idler.exists = count
+        for idler in idlers:
+            try:
+                idler.send(f'* {count} EXISTS'.encode())
+            except OSError:
+                pass
+        return uid
+
+    def drop_connections(self):
+        """Close every client connection, to emulate a server restart or network failure"""
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JiraServer:
+    """A local stand-in for the Jira REST API (v2), which counts the calls it receives
+
+        Implements what `jira_client` uses: server info, creating issues (single and bulk),
+        reading, searching (by labels and assignee) and updating issues, assigning them, comments, attachments,
+        (assignable) users, priorities and issue types. It answers as a Jira Cloud instance, so users are
+        identified by account ID. Issues are kept in `issues`, with the time they were created.
+
+        Parameters
+        ----------
+        users : list
+            The account IDs of the assignable users.
+        latency : float
+            Seconds to wait before answering every call, to emulate a remote server.
+        rejected_fields : set
+            Fields that are not on the create screen: creating an issue with any of them fails
+            with 400, like it does in Jira.
+    """
+    PRIORITIES = ['Highest', 'High', 'Medium', 'Low', 'Lowest']
+    ISSUE_TYPES = ['Task', 'Bug']
+
+    def __init__(self, users=None, latency=0.0, rejected_fields=None, project='SEC'):
+        self.users = users if users is not None else ['user-1', 'user-2', 'user-3']
+        self.latency = latency
+        self.rejected_fields = set(rejected_fields or [])
+        self.project = project
+        self.calls = Counter()
+        self.issues = {}
+        self.lock = threading.Lock()
+        server = self
+
+        routes = [
+            ('GET', r'serverInfo', 'server_info'),
+            ('GET', r'field', 'fields'),
+            ('GET', r'priority', 'priorities'),
+            ('GET', r'issuetype', 'issue_types'),
+            ('GET', r'user/assignable/(?:multiProjectSearch|search)', 'assignable_users'),
+            ('GET', r'user/search', 'search_users'),
+            ('GET', r'search(?:/jql)?', 'search'),
+            ('POST', r'issue/bulk', 'create_bulk'),
+            ('POST', r'issue', 'create'),
+            ('GET', r'issue/([^/]+)', 'get_issue'),
+            ('PUT', r'issue/([^/]+)', 'update_issue'),
+            ('PUT', r'issue/([^/]+)/assignee', 'assign'),
+            ('GET', r'issue/([^/]+)/comment', 'comments'),
+            ('POST', r'issue/([^/]+)/comment', 'comment'),
+            ('POST', r'issue/([^/]+)/attachments', 'attach'),
+        ]
+        routes = [(method, re.compile(rf'/rest/api/(?:2|3|latest)/{pattern}$'), name) for method, pattern, name in routes]
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_method(self, method):
+                path, _, query = self.path.partition('?')
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if method == 'GET':
+                    # GET calls get the query string parameters instead of a body
+                    body = parse_qs(query)
+                for route_method, pattern, name in routes:
+                    match = pattern.match(path)
+                    if route_method == method and match:
+                        break
+                else:
+                    name, match = None, None
+                with server.lock:
+                    server.calls[name or f'{method} {path}'] += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if not name:
+                    return self.respond(404, {'errorMessages': [f'No stand-in for {method} {path}']})
+                status, response = getattr(server, f'_{name}')(body, *match.groups())
+                self.respond(status, response)
+
+            def respond(self, status, response):
+                data = json.dumps(response).encode('utf-8') if response is not None else b''
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                self.handle_method('GET')
+
+            def do_POST(self):
+                self.handle_method('POST')
+
+            def do_PUT(self):
+                self.handle_method('PUT')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_port}'
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def __key(self, key):
+        # Issues are addressed by key or by ID
+        if key in self.issues:
+            return key
+        return next((k for k, issue in self.issues.items() if issue['id'] == key), None)
+
+    def __issue_json(self, key):
+        issue = self.issues[key]
+        return {'id': issue['id'], 'key': key, 'self': f'{self.url}/rest/api/2/issue/{issue["id"]}', 'fields': issue['fields']}
+
+    def __new_issue(self, fields):
+        rejected = self.rejected_fields & set(fields)
+        if rejected:
+            return None, {field: f"Field '{field}' cannot be set. It is not on the appropriate screen, or unknown." for field in rejected}
+        with self.lock:
+            issue_id = str(10000 + len(self.issues))
+            key = f'{self.project}-{len(self.issues) + 1}'
+            self.issues[key] = {'id': issue_id, 'fields': dict(fields), 'comments': [], 'attachments': [], 'created': time.time()}
+        return {'id': issue_id, 'key': key, 'self': f'{self.url}/rest/api/2/issue/{issue_id}'}, None
+
+    def _server_info(self, body):
+        return 200, {'baseUrl': self.url, 'version': '1001.0.0', 'versionNumbers': [1001, 0, 0], 'deploymentType': 'Cloud', 'buildNumber': 100000, 'serverTitle': 'PURA Jira stand-in'}
+
+    def _fields(self, body):
+        return 200, []
+
+    def _priorities(self, body):
+        return 200, [{'id': str(i), 'name': name, 'self': f'{self.url}/rest/api/2/priority/{i}'} for i, name in enumerate(self.PRIORITIES, 1)]
+
+    def _issue_types(self, body):
+        return 200, [{'id': str(i), 'name': name, 'self': f'{self.url}/rest/api/2/issuetype/{i}'} for i, name in enumerate(self.ISSUE_TYPES, 1)]
+
+    def _assignable_users(self, body):
+        return 200, [{'self': f'{self.url}/rest/api/2/user?accountId={user}', 'accountId': user, 'name': user, 'displayName': user, 'active': True} for user in self.users]
+
+    def _search_users(self, body):
+        return self._assignable_users(body)
+
+    def _search(self, query):
+        # Only `labels` and `assignee` conditions are supported (`in (...)` or `=`), and every issue is open
+        jql = query.get('jql', [''])[0]
+
+        def values(field):
+            match = re.search(rf'{field}\s+(?:in\s*\(([^)]*)\)|=\s*("[^"]*"|[^\s)]+))', jql)
+            return {value.strip().strip('"') for value in (match.group(1) or match.group(2)).split(',')} if match else None
+
+        labels, assignees = values('labels'), values('assignee')
+        issues = []
+        for key, issue in list(self.issues.items()):
+            if labels is not None and not labels & set(issue['fields'].get('labels', [])):
+                continue
+            if assignees is not None and (issue['fields'].get('assignee') or {}).get('accountId') not in assignees:
+                continue
+            issues.append(self.__issue_json(key))
+        return 200, {'startAt': 0, 'maxResults': len(issues), 'total': len(issues), 'issues': issues}
+
+    def _create(self, body):
+        issue, errors = self.__new_issue(json.loads(body)['fields'])
+        if errors:
+            return 400, {'errorMessages': [], 'errors': errors}
+        return 201, issue
+
+    def _create_bulk(self, body):
+        issues, errors = [], []
+        for i, update in enumerate(json.loads(body)['issueUpdates']):
+            issue, error = self.__new_issue(update['fields'])
+            if error:
+                errors.append({'status': 400, 'failedElementNumber': i, 'elementErrors': {'errorMessages': [], 'errors': error}})
+            else:
+                issues.append(issue)
+        return (201 if not errors else 400 if not issues else 201), {'issues': issues, 'errors': errors}
+
+    def _get_issue(self, body, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        return 200, self.__issue_json(key)
+
+    def _update_issue(self, body, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        self.issues[key]['fields'].update(json.loads(body).get('fields', {}))
+        return 204, None
+
+    def _assign(self, body, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        self.issues[key]['fields']['assignee'] = json.loads(body)
+        return 204, None
+
+    def _comment(self, body, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        comment = json.loads(body).get('body')
+        self.issues[key]['comments'].append(comment)
+        return 201, {'id': str(len(self.issues[key]['comments'])), 'body': comment}
+
+    def _comments(self, query, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        comments = [{'id': str(i + 1), 'body': comment} for i, comment in enumerate(self.issues[key]['comments'])]
+        return 200, {'startAt': 0, 'maxResults': len(comments), 'total': len(comments), 'comments': comments}
+
+    def _attach(self, body, key):
+        key = self.__key(key)
+        if key is None:
+            return 404, {'errorMessages': ['Issue does not exist']}
+        self.issues[key]['attachments'].append(len(body))
+        return 200, [{'id': str(len(self.issues[key]['attachments'])), 'filename': 'email', 'size': len(body), 'self': f'{self.url}/rest/api/2/attachment/1'}]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
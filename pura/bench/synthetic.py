@@ -0,0 +1,115 @@
+import random
+import string
+
+TLDS = ['com', 'net', 'org', 'info', 'ru', 'io', 'xyz']
+
+
+def __label(rng, length=8):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def random_ip(rng):
+    return '.'.join(str(rng.randint(1, 254)) for _ in range(4))
+
+
+def random_fqdn(rng):
+    return f'{__label(rng)}.{__label(rng, 6)}.{rng.choice(TLDS)}'
+
+
+def random_url(rng):
+    return f'http://{random_fqdn(rng)}/{__label(rng, 5)}/{__label(rng, 7)}.php'
+
+
+def generate_feed(size, seed=0):
+    """Generate a synthetic plain text feed
+
+        Parameters
+        ----------
+        size : int
+            The number of entries in the feed.
+        seed : int
+            Seed for the random generator, so that runs are comparable.
+
+        Returns
+        -------
+        lines : list
+            The feed lines: a comment header followed by a mix of IPs (with counts), FQDNs and URLs.
+    """
+    rng = random.Random(seed)
+    lines = ['# Synthetic feed', '#']
+    generators = [lambda: f'{random_ip(rng)}\t3', lambda: random_fqdn(rng), lambda: random_url(rng)]
+    for i in range(size):
+        lines.append(generators[i % len(generators)]())
+    return lines
+
+
+def generate_csv_feed(size, seed=0):
+    """Generate a synthetic CSV feed in the format of PhishTank's `online-valid.csv`
+
+        Some of the URLs contain commas, and are quoted like in the real feed.
+
+        Returns
+        -------
+        text : string
+            The CSV, including the header.
+    """
+    rng = random.Random(seed)
+    lines = ['phish_id,url,phish_detail_url,submission_time,verified,verification_time,online,target']
+    for i in range(size):
+        url = random_url(rng)
+        if i % 10 == 0:
+            url = f'"{url}?a=1,b=2"'
+        lines.append(f'{i},{url},http://www.phishtank.com/phish_detail.php?phish_id={i},2020-04-15T13:37:00+00:00,yes,2020-04-15T13:40:00+00:00,yes,Other')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_eml(i, seed=0, body_size=2000, url=None, text=None):
+    """Generate a synthetic phishing-like email as raw RFC 822 bytes
+
+        Parameters
+        ----------
+        url : string
+            The link in the email (a random URL if not set).
+        text : string
+            The text after the link (`body_size` random letters if not set).
+    """
+    rng = random.Random(seed * 1000003 + i)
+    url = url or random_url(rng)
+    body = f'Dear user,\r\n\r\nPlease verify your account at {url} within 24 hours.\r\n\r\n'
+    body += (text if text is not None else ''.join(rng.choice(string.ascii_lowercase + ' ') for _ in range(body_size))) + '\r\n'
+    return (
+        f'Message-ID: <{i}.{seed}@{random_fqdn(rng)}>\r\n'
+        f'From: "Support" <support@{random_fqdn(rng)}>\r\n'
+        f'To: user{i}@example.com\r\n'
+        f'Subject: Account verification #{i}\r\n'
+        f'Date: Wed, 15 Apr 2020 13:37:00 +0000\r\n'
+        f'Content-Type: text/plain; charset=utf-8\r\n'
+        f'\r\n{body}'
+    ).encode('utf-8')
+
+
+def generate_documents(size, classes=5, length=200, seed=0):
+    """Generate labelled synthetic email bodies, for training and benchmarking classifiers
+
+        Every class has its own vocabulary, and shares a common vocabulary with the others.
+        The vocabularies do not depend on the seed, so a model trained on one seed can be
+        tested on another.
+
+        Returns
+        -------
+        documents : list
+            The bodies, as strings.
+        labels : list
+            The class (0 to classes - 1) of every body.
+    """
+    vocabulary_rng = random.Random(classes)
+    common = [__label(vocabulary_rng, vocabulary_rng.randint(3, 9)) for _ in range(2000)]
+    vocabularies = [[__label(vocabulary_rng, vocabulary_rng.randint(3, 9)) for _ in range(300)] for _ in range(classes)]
+    rng = random.Random(seed)
+    documents, labels = [], []
+    for i in range(size):
+        label = i % classes
+        words = [rng.choice(vocabularies[label]) if rng.random() < 0.3 else rng.choice(common) for _ in range(length)]
+        documents.append(' '.join(words))
+        labels.append(label)
+    return documents, labels
@@ -1,8 +1,10 @@
 from os import getenv
+from os.path import expanduser
 mail_config = {
     'imap': {
         'server': getenv('IMAP_SERVER'),
-        'port': getenv('IMAP_PORT')
+        'port': getenv('IMAP_PORT'),
+        'ssl': getenv('IMAP_SSL', '1') != '0'
     },
     'smtp': {
         'server': getenv('SMTP_SERVER'),
@@ -12,5 +14,22 @@ mail_config = {
         'user': getenv('MAIL_USER'),
         'pass': getenv('MAIL_PASS')
     },
-    'default_mailbox': getenv('DEFAULT_MAILBOX', 'inbox')
+    'default_mailbox': getenv('DEFAULT_MAILBOX', 'inbox'),
+    # Mailboxes to fetch reports from, and the max number of IMAP connections to fetch them with
+    'mailboxes': [mailbox.strip() for mailbox in getenv('IMAP_MAILBOXES', getenv('DEFAULT_MAILBOX', 'inbox')).split(',') if mailbox.strip()],
+    'max_connections': int(getenv('IMAP_MAX_CONNECTIONS', '4')),
+    # Messages per bulk FETCH command, and the size (bytes) above which a message is skipped
+    'fetch_chunk_size': int(getenv('IMAP_FETCH_CHUNK_SIZE', '200')),
+    'max_message_size': int(getenv('MAX_EMAIL_SIZE', str(25 * 1024 * 1024))),
+    # Daemon mode: seconds per IMAP IDLE, seconds between polls if IDLE is not supported,
+    # and the min/max seconds to back off before reconnecting
+    'idle_timeout': int(getenv('IMAP_IDLE_TIMEOUT', '1500')),
+    'poll_interval': int(getenv('IMAP_POLL_INTERVAL', '60')),
+    'reconnect_min': int(getenv('IMAP_RECONNECT_MIN', '1')),
+    'reconnect_max': int(getenv('IMAP_RECONNECT_MAX', '300')),
+    # Last processed UID and UIDVALIDITY per mailbox
+    'state_file': expanduser(getenv('MAILBOX_STATE_FILE', '~/.pura/mailbox_state.json')),
+    # Emails that have been fetched but not handled are fetched again after this many seconds, at most this many times
+    'retry_delay': int(getenv('IMAP_RETRY_DELAY', '300')),
+    'max_attempts': int(getenv('IMAP_MAX_ATTEMPTS', '5'))
 }
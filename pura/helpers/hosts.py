@@ -0,0 +1,67 @@
+import ipaddress
+import re
+from urllib.parse import urlparse
+
+import pura.helpers.regex as REGEX
+from pura.helpers.logger import rootLogger as logger
+
+IP_RE = re.compile(REGEX.IP, re.IGNORECASE)
+IP_MULTI_RE = re.compile(REGEX.IP_MULTI, re.IGNORECASE)
+URL_RE = re.compile(REGEX.URL, re.IGNORECASE)
+
+
+def get_fqdn(host):
+    try:
+        o = urlparse(host)
+        if o.netloc:
+            return o.netloc
+        else:
+            logger.warning('[TH-INT] No netloc found in host.')
+    except ValueError as e:
+        logger.error(f'[TH-INT] An error occurred while parsing a host.')
+        logger.error(e)
+
+    return host
+
+
+def get_fqdn_path(host):
+    try:
+        o = urlparse(host)
+        if o.netloc:
+            if not o.path:
+                logger.warning('[TH-INT] No path found in host.')
+            return f'{o.netloc}{o.path}'
+        else:
+            logger.warning('[TH-INT] No netloc found in host.')
+    except ValueError as e:
+        logger.error(f'[TH-INT] An error occurred while parsing a host.')
+        logger.error(e)
+
+    return host
+
+
+def is_ip(host):
+    try:
+        return bool(IP_RE.match(host))
+    except Exception as e:
+        logger.error(e)
+
+    return False
+
+
+def is_ipv4_address(host):
+    # Unlike `is_ip`, which also matches the start of e.g. `1.2.3.4/gate.php` or `1.2.3.4:8080`
+    try:
+        ipaddress.IPv4Address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def is_url(host):
+    try:
+        return bool(URL_RE.match(host))
+    except Exception as e:
+        logger.error(e)
+
+    return False
@@ -0,0 +1,196 @@
+import hashlib
+import random
+import re
+import time
+from collections import deque
+from itertools import count
+
+from pura.helpers.hosts import get_fqdn, is_url
+from pura.helpers.logger import rootLogger as logger
+
+# MinHash permutations, split into LSH bands of PERMUTATIONS / BANDS rows.
+# 16 bands of 4 rows make reports with a Jaccard similarity of ~0.5 likely candidates.
+PERMUTATIONS = 64
+BANDS = 16
+PRIME = (1 << 61) - 1
+SHINGLE_SIZE = 3
+
+WORD_RE = re.compile(r'\w+')
+DIGITS_RE = re.compile(r'\d+')
+SUBJECT_PREFIX_RE = re.compile(r'^\s*((re|fw|fwd|sv|vs|aw)\s*:\s*)+', re.IGNORECASE)
+
+__rng = random.Random(1)
+# Seeded, so signatures are comparable between runs
+COEFFICIENTS = [(__rng.randrange(1, PRIME), __rng.randrange(0, PRIME)) for _ in range(PERMUTATIONS)]
+
+
+def __hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def __words(text):
+    # Numbers are masked, since they are often personalized (invoice numbers, amounts, ...)
+    return [DIGITS_RE.sub('0', word) for word in WORD_RE.findall((text or '').lower())]
+
+
+def features(sender, subject, body, hosts):
+    """The features of a report: its sender domain, subject words, body shingles and hosts"""
+    feats = set()
+    if sender:
+        feats.add('from:' + sender.rsplit('@', 1)[-1].strip(' >').lower())
+    subject = SUBJECT_PREFIX_RE.sub('', subject or '')
+    feats.update('subject:' + word for word in __words(subject))
+    words = __words(body)
+    feats.update('body:' + ' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1)) if words)
+    for host in hosts or []:
+        feats.add('host:' + (get_fqdn(host) if is_url(host) else host).lower())
+    return feats
+
+
+def signature(feats):
+    """The MinHash signature of a set of features"""
+    if not feats:
+        return (PRIME,) * PERMUTATIONS
+    hashes = [__hash(feature) for feature in feats]
+    return tuple(min((a * h + b) % PRIME for h in hashes) for a, b in COEFFICIENTS)
+
+
+def similarity(sig_a, sig_b):
+    """The Jaccard similarity estimated from two signatures"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class Campaign:
+    """A group of near-duplicate reports, which is classified and ticketed once
+
+        Attributes
+        ----------
+        id : int
+        signature : tuple
+            The signature of the first report.
+        reports : list
+            Every report of the campaign, in the order they were added.
+        first_seen, last_seen : float
+            UNIX timestamps.
+        response : dict
+            The classification of the first report, once it has been classified.
+        issue_key : string
+            The key of the Jira issue of the campaign, once it has been created.
+        report_key : string
+            The outbox key of the first report of the campaign, which later reports wait for while its issue
+            is being created. None once the campaign has been discarded.
+    """
+    def __init__(self, campaign_id, sig, report, timestamp):
+        self.id = campaign_id
+        self.signature = sig
+        self.reports = [report]
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.response = None
+        self.issue_key = None
+        self.report_key = None
+
+    def __len__(self):
+        return len(self.reports)
+
+
+class CampaignIndex:
+    """Streaming near-duplicate detection of reports with MinHash and LSH
+
+        Every report is compared with the campaigns that share at least one LSH band with
+        it, and joins the most similar one if its estimated Jaccard similarity is at least
+        `threshold`. Otherwise it starts a new campaign. Campaigns that have not seen a
+        report for `window` seconds are dropped, so the index stays small.
+
+        Parameters
+        ----------
+        threshold : float
+            The min. similarity to join a campaign.
+        window : float
+            Seconds after the last report of a campaign that it can still be joined.
+    """
+    def __init__(self, threshold=0.6, window=24 * 3600):
+        self.threshold = threshold
+        self.window = window
+        self.campaigns = {}
+        self.__buckets = {}
+        self.__expiry = deque()
+        self.__ids = count(1)
+        self.__rows = PERMUTATIONS // BANDS
+
+    def __len__(self):
+        return len(self.campaigns)
+
+    def __bands(self, sig):
+        return [(band, sig[band * self.__rows:(band + 1) * self.__rows]) for band in range(BANDS)]
+
+    def expire(self, now=None):
+        """Drop the campaigns that have not seen a report within the window"""
+        now = time.time() if now is None else now
+        while self.__expiry and self.__expiry[0][0] < now - self.window:
+            _, campaign_id = self.__expiry.popleft()
+            campaign = self.campaigns.get(campaign_id)
+            # Campaigns are queued again on every report, so only the last entry counts
+            if campaign is None or campaign.last_seen >= now - self.window:
+                continue
+            self.discard(campaign)
+
+    def discard(self, campaign):
+        """Drop a campaign (e.g. when its first report failed), so that the next similar report starts a new one"""
+        if self.campaigns.get(campaign.id) is not campaign:
+            return
+        for band in self.__bands(campaign.signature):
+            bucket = self.__buckets.get(band)
+            if bucket:
+                bucket.discard(campaign.id)
+                if not bucket:
+                    del self.__buckets[band]
+        del self.campaigns[campaign.id]
+
+    def add(self, report, feats, timestamp=None):
+        """Add a report, and find or start its campaign
+
+            Parameters
+            ----------
+            report : object
+                The report (e.g. an email), stored in the campaign.
+            feats : set
+                The features of the report (see `features`).
+            timestamp : float
+                When the report was received (now if not set).
+
+            Returns
+            -------
+            campaign : Campaign
+                The campaign of the report.
+            new : bool
+                Whether the report started a new campaign.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        self.expire(timestamp)
+        sig = signature(feats)
+        bands = self.__bands(sig)
+
+        best, best_similarity = None, 0.0
+        candidates = set()
+        for band in bands:
+            candidates.update(self.__buckets.get(band, ()))
+        for campaign_id in candidates:
+            score = similarity(sig, self.campaigns[campaign_id].signature)
+            if score > best_similarity:
+                best, best_similarity = self.campaigns[campaign_id], score
+
+        if best and best_similarity >= self.threshold:
+            best.reports.append(report)
+            best.last_seen = max(best.last_seen, timestamp)
+            self.__expiry.append((best.last_seen, best.id))
+            logger.debug(f'[CAMPGN] Report joined campaign {best.id} ({len(best)} reports, similarity {best_similarity:.2f}).')
+            return best, False
+
+        campaign = Campaign(next(self.__ids), sig, report, timestamp)
+        self.campaigns[campaign.id] = campaign
+        for band in bands:
+            self.__buckets.setdefault(band, set()).add(campaign.id)
+        self.__expiry.append((timestamp, campaign.id))
+        logger.debug(f'[CAMPGN] Report started campaign {campaign.id}.')
+        return campaign, True
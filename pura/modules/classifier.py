@@ -0,0 +1,289 @@
+import os
+import re
+import threading
+
+import juicer
+import katatasso
+
+from pura.helpers.logger import rootLogger as logger
+from pura.modules.result_cache import ResultCache, content_key
+from pura.modules.worker_pool import WorkerPool
+
+ALGO = os.getenv('algo', 'mnb')
+# Classifier worker processes (0 to classify inline), seconds per email, and emails per worker before it is replaced
+WORKERS = int(os.getenv('CLASSIFIER_WORKERS', str(os.cpu_count() or 1)))
+TIMEOUT = float(os.getenv('CLASSIFIER_TIMEOUT', '120'))
+MAX_TASKS = int(os.getenv('CLASSIFIER_MAX_TASKS', '500'))
+# Bump to invalidate the cached results after retraining a model
+MODEL_VERSION = os.getenv('CLASSIFIER_MODEL_VERSION', '1')
+# Results of previously seen email bodies: in memory, and on disk (empty path to disable)
+CACHE_FILE = os.path.expanduser(os.getenv('CLASSIFIER_CACHE_FILE', '~/.pura/classifier_cache.sqlite'))
+CACHE_MEMORY_ENTRIES = int(os.getenv('CLASSIFIER_CACHE_MEMORY_ENTRIES', '1000'))
+CACHE_DISK_ENTRIES = int(os.getenv('CLASSIFIER_CACHE_DISK_ENTRIES', '100000'))
+# A trained scikit-learn model (and its vectorizer, unless the model is a pipeline), saved with joblib.
+# When set, emails are classified in batches by a resident `Classifier` instead of `katatasso.classifyv2`.
+MODEL_FILE = os.path.expanduser(os.getenv('CLASSIFIER_MODEL_FILE', ''))
+VECTORIZER_FILE = os.path.expanduser(os.getenv('CLASSIFIER_VECTORIZER_FILE', ''))
+# A fast model of the same kind, trained on plain tokens instead of NER output, for the first pass of the cascade
+FAST_MODEL_FILE = os.path.expanduser(os.getenv('CLASSIFIER_FAST_MODEL_FILE', ''))
+FAST_VECTORIZER_FILE = os.path.expanduser(os.getenv('CLASSIFIER_FAST_VECTORIZER_FILE', ''))
+
+TOKEN_RE = re.compile(r'\w+')
+
+WARM_UP_TEXT = 'Please verify your account details at the link below.'
+
+
+def extract_words(content):
+    """Extract the entities and words of an email body with Stanford NER"""
+    return juicer.extract_stanford(content, named_only=False, stemming=False)
+
+
+def classify_content(content):
+    """Classify an email body
+
+        Returns
+        -------
+        words : list
+            The extracted words.
+        label : int
+            The predicted category (see `katatasso.helpers.const.categories`).
+    """
+    words = extract_words(content)
+    return words, katatasso.classifyv2(words, algo=ALGO)
+
+
+def tokenize(content):
+    """Split an email body into lowercase tokens, which is much cheaper than `extract_words`"""
+    return TOKEN_RE.findall(content.lower())
+
+
+def warm_up():
+    # The NER tagger and the model are loaded on first use, so use them once before taking emails
+    if MODEL_FILE:
+        extract_words(WARM_UP_TEXT)
+    else:
+        classify_content(WARM_UP_TEXT)
+
+
+class Classifier:
+    """A resident text classifier, which classifies whole batches at once
+
+        Every batch is vectorized into one sparse matrix, and classified with a single
+        `predict_proba` (or `predict`) call.
+
+        Parameters
+        ----------
+        model : object
+            A trained scikit-learn classifier, or a pipeline that includes the vectorizer.
+        vectorizer : object
+            The fitted vectorizer of the model, if it is not a pipeline.
+    """
+    def __init__(self, model, vectorizer=None):
+        self.model = model
+        self.vectorizer = vectorizer
+
+    @classmethod
+    def load(cls, model_path, vectorizer_path=None):
+        """Load a model (and vectorizer) saved with joblib"""
+        import joblib
+        logger.info(f'[CLASS ] Loading the model {model_path}.')
+        return cls(joblib.load(model_path), joblib.load(vectorizer_path) if vectorizer_path else None)
+
+    def classify_many(self, documents):
+        """Classify a batch of documents
+
+            Parameters
+            ----------
+            documents : list
+                Strings, or lists of words (as extracted by `extract_words`), which are joined with spaces.
+
+            Returns
+            -------
+            results : list
+                A (label, confidence) tuple per document. The confidence is the probability
+                of the label (0-1), or None if the model does not estimate probabilities.
+        """
+        if not documents:
+            return []
+        documents = [doc if isinstance(doc, str) else ' '.join(str(word) for word in doc) for doc in documents]
+        X = self.vectorizer.transform(documents) if self.vectorizer else documents
+        if hasattr(self.model, 'predict_proba'):
+            probabilities = self.model.predict_proba(X)
+            best = probabilities.argmax(axis=1)
+            return [(self.model.classes_[i].item(), probabilities[row, i].item()) for row, i in enumerate(best)]
+        return [(label.item() if hasattr(label, 'item') else label, None) for label in self.model.predict(X)]
+
+    def classify(self, document):
+        return self.classify_many([document])[0]
+
+
+class TierMetrics:
+    """Counters of a classification cascade: how many emails every tier evaluated and decided, and how long it took"""
+    def __init__(self):
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def record(self, tier, evaluated, decided, seconds):
+        with self.__lock:
+            stats = self.__stats.setdefault(tier, {'evaluated': 0, 'decided': 0, 'seconds': 0.0})
+            stats['evaluated'] += evaluated
+            stats['decided'] += decided
+            stats['seconds'] += seconds
+
+    def summary(self):
+        """Per tier: the counters, the share of the evaluated emails it decided (hit rate), and its latency per email"""
+        with self.__lock:
+            summary = {tier: dict(stats) for tier, stats in self.__stats.items()}
+        for stats in summary.values():
+            stats['hit_rate'] = stats['decided'] / stats['evaluated'] if stats['evaluated'] else 0.0
+            stats['ms_per_email'] = stats['seconds'] * 1e3 / stats['evaluated'] if stats['evaluated'] else 0.0
+        return summary
+
+
+__POOL = None
+__CACHE = None
+__CLASSIFIER = None
+__FAST_CLASSIFIER = None
+
+
+def resident_classifier():
+    """The resident Classifier of `CLASSIFIER_MODEL_FILE`, loaded on first use, or None if not configured"""
+    global __CLASSIFIER
+    if __CLASSIFIER is None and MODEL_FILE:
+        __CLASSIFIER = Classifier.load(MODEL_FILE, VECTORIZER_FILE or None)
+    return __CLASSIFIER
+
+
+def fast_classifier():
+    """The resident Classifier of `CLASSIFIER_FAST_MODEL_FILE`, loaded on first use, or None if not configured"""
+    global __FAST_CLASSIFIER
+    if __FAST_CLASSIFIER is None and FAST_MODEL_FILE:
+        __FAST_CLASSIFIER = Classifier.load(FAST_MODEL_FILE, FAST_VECTORIZER_FILE or None)
+    return __FAST_CLASSIFIER
+
+
+def classify_fast(contents):
+    """Classify email bodies by their plain tokens with the fast model
+
+        Returns
+        -------
+        results : list
+            A (label, confidence) tuple per body, or None if there is no fast model.
+    """
+    classifier = fast_classifier()
+    if not classifier:
+        return None
+    return classifier.classify_many([tokenize(content) for content in contents])
+
+
+def __cache():
+    global __CACHE
+    if __CACHE is None:
+        __CACHE = ResultCache(CACHE_FILE or None, memory_entries=CACHE_MEMORY_ENTRIES, disk_entries=CACHE_DISK_ENTRIES)
+    return __CACHE
+
+
+def __cache_key(content):
+    model = f'{MODEL_FILE}@{os.path.getmtime(MODEL_FILE)}' if MODEL_FILE and os.path.exists(MODEL_FILE) else ALGO
+    return content_key(content, f'{model}:{MODEL_VERSION}:{getattr(katatasso, "__version__", "")}')
+
+
+def start_classifiers(workers=None):
+    """Start the classifier worker processes
+
+        Every worker loads the NER tagger and the `ALGO` model once, and then classifies
+        emails until it has classified `CLASSIFIER_MAX_TASKS` of them and is replaced.
+        A worker that takes longer than `CLASSIFIER_TIMEOUT` seconds on an email is killed.
+        With a resident model (`CLASSIFIER_MODEL_FILE`), the workers only extract the words,
+        and the model classifies them in batches in this process.
+    """
+    global __POOL
+    workers = WORKERS if workers is None else workers
+    if __POOL or workers < 1:
+        return
+    __POOL = WorkerPool(extract_words if MODEL_FILE else classify_content, workers=workers, initializer=warm_up, timeout=TIMEOUT, max_tasks=MAX_TASKS)
+    __POOL.start()
+    logger.info(f'[CLASS ] Started {workers} classifier workers.')
+
+
+def stop_classifiers():
+    global __POOL
+    if __POOL:
+        __POOL.close()
+        __POOL = None
+
+
+def classifier_stats():
+    """Task counters of the classifier workers (None if they are not running), and the counters of the result cache"""
+    return {
+        'workers': dict(__POOL.stats) if __POOL else None,
+        'cache': __cache().counters()
+    }
+
+
+def __run(func, contents):
+    if __POOL:
+        return __POOL.map(contents)
+    results = []
+    for content in contents:
+        try:
+            results.append(func(content))
+        except Exception as e:
+            logger.error(f'[CLASS ] An error occurred while classifying the email.')
+            logger.error(e)
+            results.append(None)
+    return results
+
+
+def __classify_uncached(contents):
+    # Returns a (words, label, confidence) tuple per body, or None where it failed
+    classifier = resident_classifier()
+    if not classifier:
+        return [(result[0], result[1], None) if result else None for result in __run(classify_content, contents)]
+    words = __run(extract_words, contents)
+    extracted = [w for w in words if w is not None]
+    try:
+        predictions = iter(classifier.classify_many(extracted))
+    except Exception as e:
+        logger.error(f'[CLASS ] An error occurred while classifying {len(extracted)} emails.')
+        logger.error(e)
+        return [None] * len(contents)
+    return [(w, *next(predictions)) if w is not None else None for w in words]
+
+
+def classify_contents(contents):
+    """Classify several email bodies, on the worker processes if they are running
+
+        Bodies that have been classified before (by the same `ALGO` and model version) are
+        answered from the result cache, and identical bodies in a batch are classified once.
+
+        Returns
+        -------
+        results : list
+            A result per body, or None where classification failed:
+                { 'label': int, 'confidence': float, 'words': list }
+                label : int
+                    The predicted category (see `katatasso.helpers.const.categories`).
+                confidence : float
+                    The probability of the label (0-1), or None if it is not known.
+    """
+    cache = __cache()
+    keys = [__cache_key(content) for content in contents]
+    results = {}
+    missing = {}
+    for key, content in zip(keys, contents):
+        if key in results or key in missing:
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            results[key] = cached
+        else:
+            missing[key] = content
+
+    for key, result in zip(missing, __classify_uncached(list(missing.values()))):
+        if result is not None:
+            words, label, confidence = result
+            # numpy scalars are not JSON serializable
+            results[key] = {'words': list(words), 'label': label.item() if hasattr(label, 'item') else label, 'confidence': confidence}
+            cache.put(key, results[key])
+    return [results.get(key) for key in keys]
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pura.helpers.logger import rootLogger as logger
+
+CACHE_DIR = os.getenv('THREAT_FEED_CACHE_DIR', '/tmp/pura/feeds')
+CHUNK_SIZE = 64 * 1024
+
+
+class FeedCache:
+    """An on-disk cache of threat intel feeds
+
+        Every feed is stored as a data file and a JSON metadata file under `cache_dir`,
+        named after the SHA-1 of the feed URL. A cached feed is served as-is until it
+        is older than `max_age_hrs`, after which it is revalidated with a conditional
+        request (ETag / If-Modified-Since). If the feed cannot be fetched, a stale copy
+        is served instead.
+
+        Parameters
+        ----------
+        cache_dir : string
+            The directory to store the feeds in.
+        max_age_hrs : int
+            How many hours before a cached feed is considered expired.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_age_hrs=24):
+        self.cache_dir = cache_dir
+        self.max_age = max_age_hrs * 3600
+
+    def __paths(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, name)
+        return f'{base}.feed', f'{base}.json'
+
+    def __load_meta(self, url):
+        data_path, meta_path = self.__paths(url)
+        if not os.path.exists(data_path):
+            return None
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'[TH-INT] Unable to read cache metadata for {url}.')
+            logger.warning(e)
+        return None
+
+    def __write_atomic(self, path, chunks):
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def __store_meta(self, url, meta):
+        _, meta_path = self.__paths(url)
+        self.__write_atomic(meta_path, [json.dumps(meta).encode('utf-8')])
+
+    def __store(self, url, res):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, _ = self.__paths(url)
+        # Stream the body to disk instead of holding it in memory
+        res.raw.decode_content = True
+        self.__write_atomic(data_path, iter(lambda: res.raw.read(CHUNK_SIZE), b''))
+        self.__store_meta(url, {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'fetched_at': time.time()
+        })
+
+    def version(self, url):
+        """A token that changes whenever the cached content of the feed changes"""
+        data_path, _ = self.__paths(url)
+        try:
+            return os.stat(data_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def age(self, url):
+        """Seconds since the feed was last fetched or revalidated, or None if it is not cached"""
+        meta = self.__load_meta(url)
+        if meta:
+            return time.time() - meta.get('fetched_at', 0)
+        return None
+
+    def open(self, url):
+        """Open the cached copy of a feed as a text file, to be read line by line
+
+            Raises
+            ------
+            OSError
+                If the feed is not cached.
+        """
+        data_path, _ = self.__paths(url)
+        return open(data_path, 'r', encoding='utf-8', errors='replace', newline='')
+
+    def refresh(self, session, url, timeout=None):
+        """Make sure the cached copy of a feed is usable, fetching it if it has expired
+
+            Parameters
+            ----------
+            session : requests.Session
+                The session to fetch the feed with.
+            url : string
+                The URL of the feed.
+            timeout : float
+                Seconds to wait for the server to connect/send data.
+
+            Returns
+            -------
+            version : int
+                The version of the cached copy (see `version`), or None if no copy is available.
+        """
+        meta = self.__load_meta(url)
+        if meta and time.time() - meta.get('fetched_at', 0) < self.max_age:
+            logger.debug(f'[TH-INT] Using cached feed for {url}.')
+            return self.version(url)
+
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            with session.get(url, headers=headers, timeout=timeout, stream=True) as res:
+                if res.status_code == 304 and meta:
+                    logger.debug(f'[TH-INT] Cached feed for {url} is still valid.')
+                    meta['fetched_at'] = time.time()
+                    self.__store_meta(url, meta)
+                    return self.version(url)
+                res.raise_for_status()
+                self.__store(url, res)
+            logger.debug(f'[TH-INT] Cached feed for {url} updated.')
+        except Exception as err:
+            logger.error(f'[TH-INT] An error occurred while fetching a feed\n{err}')
+            if meta:
+                logger.warning(f'[TH-INT] Falling back to stale cached feed for {url}.')
+
+        return self.version(url)
@@ -0,0 +1,201 @@
+from pura.helpers.hosts import get_fqdn, get_fqdn_path, is_ip, is_ipv4_address, is_url
+from pura.helpers.logger import rootLogger as logger
+from pura.modules.ip_ranges import IPRangeIndex
+from pura.modules.partial_match import DomainTrie, split_host_path
+
+
+class BaseFeedIndex:
+    """The lookup logic shared by the in-memory `FeedIndex` and the memory-mapped `SnapshotIndex`
+
+        Subclasses implement the primitive checks used by `lookup`.
+    """
+    def _has_ip(self, ip):
+        raise NotImplementedError
+
+    def _in_range(self, ip):
+        raise NotImplementedError
+
+    def _contains(self, token):
+        raise NotImplementedError
+
+    def _has_path(self, host, path):
+        raise NotImplementedError
+
+    def _has_subdomain(self, host):
+        raise NotImplementedError
+
+    def _has_parent(self, host):
+        raise NotImplementedError
+
+    def lookup(self, host):
+        """Look up a host in the feed
+
+            Parameters
+            ----------
+            host : string
+                An IP address, FQDN or URL.
+
+            Returns
+            -------
+            found : bool
+                Whether the host was found.
+            confidence : float
+                1.0 for exact matches, 0.8 (FQDN/path), 0.7 (full) or 0.6 (FQDN, IP) for partial matches.
+        """
+        host_is_ip = is_ip(host)
+        host_is_url = is_url(host)
+        if host_is_ip and self._has_ip(host):
+            logger.debug(f'[TH-INT] Host {host} found in feed (src: IP, exact)')
+            return True, 1.0
+        if (host_is_ip or ':' in host) and self._in_range(host):
+            logger.debug(f'[TH-INT] Host {host} found in feed (src: IP, range)')
+            return True, 1.0
+        if host_is_url:
+            fqdn_path = get_fqdn_path(host)
+            if self._contains(fqdn_path):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN/path, exact)')
+                return True, 1.0
+            fqdn = get_fqdn(host)
+            if self._contains(fqdn):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN, exact)')
+                return True, 1.0
+        if self._contains(host):
+            logger.debug(f'[TH-INT] Host {host} found in feed (src: full, exact)')
+            return True, 1.0
+
+        # No direct match, look deeper.
+        # Look for partial matches
+        if host_is_url:
+            fqdn, path = split_host_path(fqdn_path)
+            if self._has_path(fqdn, path):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN/path, partial)')
+                return True, 0.8
+            if self._has_subdomain(fqdn) or self._has_parent(fqdn):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN, partial)')
+                return True, 0.6
+        if host_is_ip:
+            if self._has_subdomain(host):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: IP, partial)')
+                return True, 0.6
+        if not host_is_url and not host_is_ip:
+            if self._has_subdomain(host) or self._has_parent(host):
+                logger.debug(f'[TH-INT] Host {host} found in feed (src: full, partial)')
+                return True, 0.7
+
+        return False, 0.0
+
+
+class FeedIndex(BaseFeedIndex):
+    """A compiled, hash-indexed view of a single threat intel feed
+
+        The feed is stripped and bucketed once when the index is built, so
+        that exact lookups are O(1) set lookups regardless of the feed size.
+        Entries are bucketed by their shape (IP, FQDN, FQDN/path or full URL),
+        and every query token is only checked against the bucket of its own shape.
+        IP ranges (`a.b.c.d-e.f.g.h`) and CIDR blocks are kept as integer intervals,
+        and partial matches are answered by a reverse-label `DomainTrie` of the hosts.
+
+        Parameters
+        ----------
+        lines : iterable
+            The lines of the feed (plain text lines or the hosts parsed from a CSV).
+    """
+    def __init__(self, lines=None):
+        self.__ips = set()
+        self.__fqdns = set()
+        self.__fqdn_paths = set()
+        self.__urls = set()
+        self.__ranges = IPRangeIndex()
+        self.__trie = DomainTrie()
+        self.__size = 0
+        if lines:
+            for line in lines:
+                self.add(line)
+            self.__trie.finalize()
+
+    def __len__(self):
+        return self.__size
+
+    def __bucket(self, token):
+        # Only exact addresses, so that `ipv4` of `export` holds nothing but addresses
+        if is_ipv4_address(token):
+            return self.__ips
+        if '://' in token:
+            return self.__urls
+        if '/' in token:
+            return self.__fqdn_paths
+        return self.__fqdns
+
+    def __insert(self, token):
+        self.__bucket(token).add(token)
+        host, path = split_host_path(token)
+        self.__trie.insert(host, path)
+
+    def __add_range(self, token):
+        try:
+            if '-' in token:
+                first, _, last = token.partition('-')
+                if first and last:
+                    self.__ranges.add_range(first, last)
+                    return True
+            elif '/' in token and '://' not in token:
+                self.__ranges.add_network(token)
+                return True
+        except ValueError:
+            pass
+        return False
+
+    def add(self, line):
+        # Remove comments, blank lines, and any counts
+        if not line or line.startswith('#'):
+            return
+        tokens = line.split()
+        if not tokens:
+            return
+        token = tokens[0]
+        # Some FEEDS use dashes (-) for IP ranges, or CIDR blocks
+        if not self.__add_range(token):
+            self.__insert(token)
+        self.__size += 1
+
+    def _has_ip(self, ip):
+        return ip in self.__ips
+
+    def _in_range(self, ip):
+        return self.__ranges.contains(ip)
+
+    def _contains(self, token):
+        return token in self.__bucket(token)
+
+    def _has_path(self, host, path):
+        return self.__trie.has_path(host, path)
+
+    def _has_subdomain(self, host):
+        return self.__trie.has_subdomain(host)
+
+    def _has_parent(self, host):
+        return self.__trie.has_parent(host)
+
+    def export(self):
+        """The compiled contents of the index, used to write a snapshot (see `feed_snapshot`)
+
+            Returns
+            -------
+            contents : dict
+                { 'size': int, 'ipv4': set, 'tokens': set, 'ranges': dict, 'hosts': iterator }
+                ipv4 : set
+                    The exact IPv4 addresses.
+                tokens : set
+                    All other exact entries (FQDNs, FQDN/paths, URLs, and IPs with a port or path).
+                ranges : dict
+                    The merged (start, end) intervals, keyed by IP version.
+                hosts : iterator
+                    (labels, terminal, paths) for every node of the domain trie.
+        """
+        return {
+            'size': self.__size,
+            'ipv4': self.__ips,
+            'tokens': self.__fqdns | self.__fqdn_paths | self.__urls,
+            'ranges': {4: self.__ranges.intervals(4), 6: self.__ranges.intervals(6)},
+            'hosts': self.__trie.walk()
+        }
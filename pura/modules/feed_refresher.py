@@ -0,0 +1,132 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pura.helpers.logger import rootLogger as logger
+
+
+class FeedRefresher:
+    """Keeps the threat intel feed indexes fresh from a background thread
+
+        Every feed is reloaded on its own schedule. New indexes are built off to the side,
+        and then swapped in by replacing the whole `indexes` mapping in a single assignment,
+        so lookups always see either the previous or the new set of complete indexes.
+        If a feed fails to load, its previous index is kept.
+
+        Parameters
+        ----------
+        feeds : list
+            A list of (feed_url, csv) tuples.
+        load : callable
+            `load(feed_url, csv)`, returning a FeedIndex or None on failure.
+        interval : float
+            The default number of seconds between reloads of a feed.
+        intervals : dict
+            Optional per-feed reload intervals in seconds, keyed by feed URL.
+    """
+    def __init__(self, feeds, load, interval=3600, intervals=None):
+        self.feeds = feeds
+        self.load = load
+        self.interval = interval
+        self.intervals = intervals or {}
+        self.indexes = {}
+        self.__status = {feed_url: {'feed_url': feed_url, 'ok': None, 'last_refresh': None, 'last_success': None, 'entries': 0, 'error': None} for feed_url, _ in feeds}
+        self.__next_run = {feed_url: 0 for feed_url, _ in feeds}
+        self.__stop = threading.Event()
+        self.__ready = threading.Event()
+        self.__thread = None
+
+    def __refresh(self, feed_url, csv):
+        status = dict(self.__status[feed_url])
+        status['last_refresh'] = time.time()
+        try:
+            index = self.load(feed_url, csv)
+        except Exception as err:
+            logger.error(f'[TH-INT] An error occurred while refreshing the feed {feed_url}\n{err}')
+            index = None
+            status['error'] = str(err)
+        if index:
+            status.update({'ok': True, 'last_success': status['last_refresh'], 'entries': len(index), 'error': None})
+        else:
+            status['ok'] = False
+            status['error'] = status['error'] or 'Feed is None or empty'
+        self.__status[feed_url] = status
+        return feed_url, index
+
+    def refresh(self, force=False):
+        """Reload every feed that is due (or all of them if `force`), and swap in the new indexes"""
+        now = time.time()
+        due = [(feed_url, csv) for feed_url, csv in self.feeds if force or self.__next_run[feed_url] <= now]
+        if not due:
+            return
+        with ThreadPoolExecutor(max_workers=len(due), thread_name_prefix='feed-refresh') as executor:
+            loaded = list(executor.map(lambda feed: self.__refresh(*feed), due))
+
+        indexes = dict(self.indexes)
+        for feed_url, index in loaded:
+            self.__next_run[feed_url] = time.time() + self.intervals.get(feed_url, self.interval)
+            if index:
+                indexes[feed_url] = index
+        # Atomic swap
+        self.indexes = indexes
+        logger.info(f'[TH-INT] Refreshed {len(due)} feeds ({sum(1 for _, index in loaded if index)} updated).')
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.error(f'[TH-INT] An error occurred while refreshing the feeds\n{err}')
+            self.__ready.set()
+            wait = min(self.__next_run.values()) - time.time() if self.__next_run else self.interval
+            self.__stop.wait(max(wait, 1))
+
+    def start(self, wait=None):
+        """Start the background thread
+
+            Parameters
+            ----------
+            wait : float
+                If set, block for up to `wait` seconds until the first refresh has completed.
+        """
+        if self.running:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='feed-refresh', daemon=True)
+        self.__thread.start()
+        if wait:
+            self.__ready.wait(wait)
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join(timeout)
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def status(self):
+        """The freshness of every feed, for monitoring
+
+            Returns
+            -------
+            status : list
+                A list of objects in the following format:
+                    { 'feed_url': string, 'ok': bool, 'last_refresh': float, 'last_success': float, 'age': float, 'entries': int, 'error': string }
+                    ok : bool
+                        Whether the last refresh succeeded (None if it has not run yet).
+                    last_refresh, last_success : float
+                        UNIX timestamps of the last attempt and the last successful refresh.
+                    age : float
+                        Seconds since the last successful refresh, or None.
+                    entries : int
+                        The number of entries in the current index.
+        """
+        now = time.time()
+        status = []
+        for feed_url, _ in self.feeds:
+            entry = dict(self.__status[feed_url])
+            entry['age'] = now - entry['last_success'] if entry['last_success'] else None
+            status.append(entry)
+        return status
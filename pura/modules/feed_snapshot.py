@@ -0,0 +1,249 @@
+"""
+A compact, read-only binary snapshot of a compiled FeedIndex.
+
+Snapshots are opened with `mmap`, so every worker process shares one page-cache copy
+of a feed, and opening one only parses the header.
+
+Layout (native byte order, every section padded to 8 bytes):
+    header      MAGIC, then 8 x uint64: n_ipv4, n_v4_ranges, n_v6_ranges, n_hashes, n_paths, blob_len, size, byte order
+    ipv4        n_ipv4 x uint32, sorted
+    v4 ranges   n_v4_ranges x uint32 starts, then n_v4_ranges x uint32 ends, sorted and merged
+    v6 ranges   n_v6_ranges x (16 byte start, 16 byte end), big-endian
+    hashes      n_hashes x uint64 (64-bit BLAKE2b of the tagged key), sorted
+    offsets     n_hashes x uint64, blob offset of the key of every hash, for verification
+    paths       n_paths x uint64, blob offsets of the `host\\0path` keys, sorted by key
+    blob        uint32 length-prefixed keys
+
+The hashed keys are tagged: exact entries (E), hosts with an entry on or below them (S)
+and hosts that are themselves an entry without a path (T).
+"""
+import hashlib
+import ipaddress
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from pura.modules.feed_index import BaseFeedIndex
+from pura.modules.partial_match import host_labels, is_searchable, normalize_host
+
+# Bumped when the contents change, so that stale snapshots are rebuilt
+MAGIC = b'PURASNP2'
+HEADER = struct.Struct('<8Q')
+BYTE_ORDER = {'little': 1, 'big': 2}
+
+TAG_EXACT = b'E\0'
+TAG_SUBTREE = b'S\0'
+TAG_TERMINAL = b'T\0'
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def __pad(data):
+    return data + b'\0' * (-len(data) % 8)
+
+
+def label_key(labels):
+    # Not joined with dots, so that a domain can never collide with an IP address (a single label)
+    return '\1'.join(labels)
+
+
+def canonical_host(host):
+    """(normalized host, labels, key of the labels)"""
+    host = normalize_host(host)
+    labels = host_labels(host)
+    return host, labels, label_key(labels)
+
+
+def write_snapshot(index, path):
+    """Write a compiled snapshot of a FeedIndex to disk
+
+        The file is written next to `path` and then renamed, so processes that have the
+        previous snapshot mapped keep reading it until they reopen the file.
+
+        Parameters
+        ----------
+        index : FeedIndex
+            The index to write.
+        path : string
+            The path of the snapshot.
+    """
+    contents = index.export()
+    keys = set(TAG_EXACT + token.encode('utf-8') for token in contents['tokens'])
+    paths = set()
+    for labels, terminal, host_paths in contents['hosts']:
+        canonical = label_key(labels)
+        if not is_searchable('.'.join(reversed(labels)), labels):
+            continue
+        keys.add(TAG_SUBTREE + canonical.encode('utf-8'))
+        # Only host-only entries are parent domains, the host of a URL is not
+        if terminal:
+            keys.add(TAG_TERMINAL + canonical.encode('utf-8'))
+        if host_paths:
+            # Index the paths under every searchable ancestor, since a host matches the paths of its subdomains
+            ancestors = [labels] if len(labels) == 1 else [labels[:depth] for depth in range(2, len(labels) + 1)]
+            for ancestor in ancestors:
+                prefix = label_key(ancestor).encode('utf-8') + b'\0'
+                paths.update(prefix + p.encode('utf-8') for p in host_paths)
+
+    blob = bytearray()
+    key_offsets = {}
+    for key in sorted(keys | paths):
+        key_offsets[key] = len(blob)
+        blob += struct.pack('<I', len(key)) + key
+
+    hashed = sorted((key_hash(key), key_offsets[key]) for key in keys)
+    ipv4 = sorted(int(ipaddress.ip_address(ip)) for ip in contents['ipv4'])
+    v4_ranges = contents['ranges'][4]
+    v6_ranges = contents['ranges'][6]
+
+    header = MAGIC + HEADER.pack(len(ipv4), len(v4_ranges), len(v6_ranges), len(hashed), len(paths), len(blob), contents['size'], BYTE_ORDER[sys.byteorder])
+    sections = [
+        header,
+        __pad(array('I', ipv4).tobytes()),
+        __pad(array('I', [start for start, _ in v4_ranges]).tobytes() + array('I', [end for _, end in v4_ranges]).tobytes()),
+        b''.join(start.to_bytes(16, 'big') + end.to_bytes(16, 'big') for start, end in v6_ranges),
+        array('Q', [h for h, _ in hashed]).tobytes(),
+        array('Q', [offset for _, offset in hashed]).tobytes(),
+        array('Q', [key_offsets[key] for key in sorted(paths)]).tobytes(),
+        bytes(blob)
+    ]
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for section in sections:
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+class SnapshotIndex(BaseFeedIndex):
+    """A read-only FeedIndex backed by a memory-mapped snapshot (see `write_snapshot`)
+
+        Parameters
+        ----------
+        path : string
+            The path of the snapshot.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a snapshot, or was written on a machine with a different byte order.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a feed snapshot')
+        n_ipv4, n_v4_ranges, n_v6_ranges, n_hashes, n_paths, blob_len, size, byte_order = HEADER.unpack_from(self.__mm, len(MAGIC))
+        if byte_order != BYTE_ORDER[sys.byteorder]:
+            self.close()
+            raise ValueError(f'{path} was written with a different byte order')
+        self.__size = size
+
+        # Every view into the map has to be released before it can be closed
+        self.__views = [memoryview(self.__mm)]
+        offset = len(MAGIC) + HEADER.size
+
+        def section(length, pad=True):
+            nonlocal offset
+            start = offset
+            offset += length + (-length % 8 if pad else 0)
+            return self.__track(self.__views[0][start:start + length])
+
+        self.__ipv4 = self.__track(section(n_ipv4 * 4).cast('I'))
+        v4_ranges = section(n_v4_ranges * 8)
+        self.__v4_starts = self.__track(self.__track(v4_ranges[:n_v4_ranges * 4]).cast('I'))
+        self.__v4_ends = self.__track(self.__track(v4_ranges[n_v4_ranges * 4:]).cast('I'))
+        v6_ranges = section(n_v6_ranges * 32)
+        # IPv6 ranges are rare, and do not fit in a native integer type
+        self.__v6_starts = [int.from_bytes(v6_ranges[i * 32:i * 32 + 16], 'big') for i in range(n_v6_ranges)]
+        self.__v6_ends = [int.from_bytes(v6_ranges[i * 32 + 16:i * 32 + 32], 'big') for i in range(n_v6_ranges)]
+        self.__hashes = self.__track(section(n_hashes * 8).cast('Q'))
+        self.__hash_offsets = self.__track(section(n_hashes * 8).cast('Q'))
+        self.__paths = self.__track(section(n_paths * 8).cast('Q'))
+        self.__blob = section(blob_len, pad=False)
+
+    def __len__(self):
+        return self.__size
+
+    def __track(self, view):
+        self.__views.append(view)
+        return view
+
+    def close(self):
+        for view in reversed(getattr(self, '_SnapshotIndex__views', [])):
+            view.release()
+        self.__mm.close()
+
+    def __key(self, offset):
+        length = int.from_bytes(self.__blob[offset:offset + 4], 'little')
+        return self.__blob[offset + 4:offset + 4 + length].tobytes()
+
+    def __has_key(self, key):
+        h = key_hash(key)
+        i = bisect_left(self.__hashes, h)
+        while i < len(self.__hashes) and self.__hashes[i] == h:
+            if self.__key(self.__hash_offsets[i]) == key:
+                return True
+            i += 1
+        return False
+
+    def _has_ip(self, ip):
+        try:
+            value = int(ipaddress.IPv4Address(ip.strip()))
+        except ValueError:
+            return False
+        i = bisect_left(self.__ipv4, value)
+        return i < len(self.__ipv4) and self.__ipv4[i] == value
+
+    def _in_range(self, ip):
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            return False
+        value = int(address)
+        if address.version == 4:
+            starts, ends = self.__v4_starts, self.__v4_ends
+        else:
+            starts, ends = self.__v6_starts, self.__v6_ends
+        i = bisect_left(starts, value + 1) - 1
+        return i >= 0 and value <= ends[i]
+
+    def _contains(self, token):
+        # Exact IPv4 entries are only stored in the ipv4 section
+        return self._has_ip(token) or self.__has_key(TAG_EXACT + token.encode('utf-8'))
+
+    def _has_subdomain(self, host):
+        host, labels, canonical = canonical_host(host)
+        if not labels or not is_searchable(host, labels):
+            return False
+        return self.__has_key(TAG_SUBTREE + canonical.encode('utf-8'))
+
+    def _has_parent(self, host):
+        _, labels, _ = canonical_host(host)
+        for depth in range(2, len(labels)):
+            if self.__has_key(TAG_TERMINAL + label_key(labels[:depth]).encode('utf-8')):
+                return True
+        return False
+
+    def _has_path(self, host, path):
+        if not self._has_subdomain(host):
+            return False
+        if not path or path == '/':
+            return True
+        _, _, canonical = canonical_host(host)
+        query = canonical.encode('utf-8') + b'\0' + path.encode('utf-8')
+        lo, hi = 0, len(self.__paths)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__key(self.__paths[mid]) < query:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(self.__paths) and self.__key(self.__paths[lo]).startswith(query)
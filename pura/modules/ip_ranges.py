@@ -0,0 +1,104 @@
+import ipaddress
+from array import array
+from bisect import bisect_right
+
+# An unsigned type wide enough for IPv4 addresses
+V4_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+
+class IPRangeIndex:
+    """Sorted, merged integer intervals of IPv4/IPv6 ranges and CIDR blocks
+
+        Ranges are never expanded into single addresses. IPv4 intervals are stored as
+        two unsigned 32-bit arrays (starts and ends), IPv6 intervals as two lists of
+        ints, and containment is a binary search over the starts.
+        The intervals are (re)built on the first lookup after a range has been added.
+    """
+    def __init__(self):
+        self.__pending = {4: [], 6: []}
+        self.__starts = {4: array(V4_TYPECODE), 6: []}
+        self.__ends = {4: array(V4_TYPECODE), 6: []}
+        self.__dirty = False
+
+    def __len__(self):
+        self.__build()
+        return len(self.__starts[4]) + len(self.__starts[6])
+
+    def add_range(self, first, last):
+        """Add an inclusive range of addresses, e.g. `('10.0.0.1', '10.0.0.9')`
+
+            Raises
+            ------
+            ValueError
+                If either address is invalid, or they are of different versions.
+        """
+        first = ipaddress.ip_address(first.strip())
+        last = ipaddress.ip_address(last.strip())
+        if first.version != last.version:
+            raise ValueError(f'Mixed IP versions in range {first}-{last}')
+        if int(first) > int(last):
+            first, last = last, first
+        self.__pending[first.version].append((int(first), int(last)))
+        self.__dirty = True
+
+    def add_network(self, cidr):
+        """Add a CIDR block, e.g. `'10.0.0.0/8'`
+
+            Raises
+            ------
+            ValueError
+                If the block is invalid.
+        """
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        self.__pending[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self.__dirty = True
+
+    def __build(self):
+        if not self.__dirty:
+            return
+        for version in (4, 6):
+            intervals = list(zip(self.__starts[version], self.__ends[version])) + self.__pending[version]
+            intervals.sort()
+            merged = []
+            for start, end in intervals:
+                if merged and start <= merged[-1][1] + 1:
+                    if end > merged[-1][1]:
+                        merged[-1][1] = end
+                else:
+                    merged.append([start, end])
+            if version == 4:
+                self.__starts[4] = array(V4_TYPECODE, (start for start, _ in merged))
+                self.__ends[4] = array(V4_TYPECODE, (end for _, end in merged))
+            else:
+                self.__starts[6] = [start for start, _ in merged]
+                self.__ends[6] = [end for _, end in merged]
+            self.__pending[version] = []
+        self.__dirty = False
+
+    def intervals(self, version):
+        """The merged (start, end) intervals of an IP version, sorted by start"""
+        self.__build()
+        return list(zip(self.__starts[version], self.__ends[version]))
+
+    def contains(self, ip):
+        """Whether an address falls inside any of the ranges
+
+            Parameters
+            ----------
+            ip : string
+                An IPv4 or IPv6 address.
+
+            Returns
+            -------
+            found : bool
+                False if the address is not covered, or is not a valid address.
+        """
+        self.__build()
+        try:
+            address = ipaddress.ip_address(ip.strip())
+        except ValueError:
+            return False
+        value = int(address)
+        starts = self.__starts[address.version]
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= self.__ends[address.version][i]
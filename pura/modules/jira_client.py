@@ -1,27 +1,49 @@
 import os
-import sys
 import random
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from jira import JIRA, JIRAError
 
 from pura.helpers.logger import rootLogger as logger
+from pura.modules.jira_metadata import MetadataCache
 
 JIRA_SERVER = os.getenv('JIRA_SERVER', None)
 JIRA_USER = os.getenv('JIRA_USER', None)
 JIRA_TOKEN = os.getenv('JIRA_TOKEN', None)
-if not JIRA_SERVER:
-    logger.error('[JIRA  ] Missing environment variable `JIRA_SERVER`.')
-    sys.exit(2)
-if not JIRA_USER and JIRA_TOKEN:
-    logger.error('[JIRA  ] Missing environment variables for authentication (`JIRA_USER` and `JIRA_PASS`).')
-    sys.exit(2)
 
-jc = JIRA(JIRA_SERVER, basic_auth = (JIRA_USER, JIRA_TOKEN))
-
-
-JIRA_ASSIGNEES = os.getenv('JIRA_ASSIGNEES', '').split(',')
+JIRA_ASSIGNEES = [user for user in os.getenv('JIRA_ASSIGNEES', '').split(',') if user]
 JIRA_PROJECT_KEY = os.getenv('JIRA_PROJECT_KEY', 'SEC')
-
-MIN_CONFIDENCE_LEVEL = os.getenv('MIN_CONFIDENCE_LEVEL', 85)
+# Issues per bulk create request (Jira accepts at most 50), and concurrent attachment uploads
+JIRA_BULK_SIZE = min(int(os.getenv('JIRA_BULK_SIZE', '50')), 50)
+JIRA_UPLOAD_WORKERS = int(os.getenv('JIRA_UPLOAD_WORKERS', '4'))
+# How low-confidence issues are assigned: `least_open` (the user with the fewest open issues), `round_robin` or `random`
+JIRA_ASSIGNMENT = os.getenv('JIRA_ASSIGNMENT', 'least_open')
+# Seconds that the assignable users, priorities and issue types are cached, and that the open issues per user are counted
+JIRA_METADATA_TTL = float(os.getenv('JIRA_METADATA_TTL', '3600'))
+JIRA_OPEN_ISSUES_TTL = float(os.getenv('JIRA_OPEN_ISSUES_TTL', '300'))
+
+MIN_CONFIDENCE_LEVEL = float(os.getenv('MIN_CONFIDENCE_LEVEL', 85))
+
+__JC = None
+__JC_LOCK = threading.Lock()
+
+
+def client():
+    """The Jira client, which connects on first use (so that importing PURA does not need a Jira server)"""
+    global __JC
+    with __JC_LOCK:
+        if __JC is None:
+            if not JIRA_SERVER:
+                logger.error('[JIRA  ] Missing environment variable `JIRA_SERVER`.')
+                raise JIRAError('Missing environment variable `JIRA_SERVER`.')
+            if not JIRA_USER and JIRA_TOKEN:
+                logger.error('[JIRA  ] Missing environment variables for authentication (`JIRA_USER` and `JIRA_PASS`).')
+                raise JIRAError('Missing environment variables for authentication.')
+            __JC = JIRA(JIRA_SERVER, basic_auth = (JIRA_USER, JIRA_TOKEN))
+    return __JC
 
 
 templates = {
@@ -38,30 +60,47 @@ PRIORITIES = {
 }
 
 
-def __create_issue(summary, description, issue_type='Task'):
+def __create_issue(fields):
     try:
         logger.debug(f'[JIRA  ] Creating new issue for project `{JIRA_PROJECT_KEY}`.')
-        issue = {
-            'project': {'key': JIRA_PROJECT_KEY},
-            'summary': summary,
-            'description': description,
-            'issuetype': {'name': issue_type},
-        }
-        return jc.create_issue(fields = issue)
+        # The created issue is not fetched again, its key is all that is needed
+        return client().create_issue(fields = fields, prefetch = False)
     except JIRAError as jc_err:
+        if jc_err.status_code == 400 and ('priority' in fields or 'assignee' in fields):
+            # Priority and assignee are not on the create screen of every project. Set them afterwards instead.
+            logger.warning(f'[JIRA  ] Unable to create the issue with priority and assignee. Setting them separately.')
+            return __create_issue_then_update(fields)
         logger.error(jc_err)
     except Exception as err:
         logger.error(err)
 
-def __add_attachment(issue_key, filepath, filename='email'):
+
+def __create_issue_then_update(fields):
+    try:
+        issue = client().create_issue(fields = __required_fields(fields), prefetch = False)
+    except JIRAError as jc_err:
+        logger.error(jc_err)
+        return None
+    if 'priority' in fields:
+        __set_priority(issue, fields['priority'])
+    if 'assignee' in fields:
+        __assign_user(issue.key, fields['assignee']['accountId'])
+    return issue
+
+
+def __required_fields(fields):
+    return {k: v for k, v in fields.items() if k not in ('priority', 'assignee')}
+
+def __add_attachment(issue_key, attachment, filename='email'):
     try:
         logger.debug(f'[JIRA  ] Adding attachment to issue `{issue_key}`.')
-        return jc.add_attachment(issue_key, filepath, filename)
+        # `attachment` is either a path or a binary file object
+        return client().add_attachment(issue_key, attachment, filename)
     except JIRAError as jc_err:
         logger.error(jc_err)
         __add_comment(issue_key, f'Uploading of email attachment `{filename}` failed.')
     except FileNotFoundError:
-        logger.error(f'[JIRA  ] File `{filepath}` does not exist.')
+        logger.error(f'[JIRA  ] File `{attachment}` does not exist.')
     except Exception as err:
         logger.error(f'[JIRA  ] An error occurred while uploading an attachment to issue `{issue_key}`.')
         logger.error(err)
@@ -71,7 +110,7 @@ def __add_attachment(issue_key, filepath, filename='email'):
 def __add_comment(issue_key, body):
     try:
         logger.debug(f'[JIRA  ] Adding comment to issue `{issue_key}`.')
-        return jc.add_comment(issue_key, body)
+        return client().add_comment(issue_key, body)
     except JIRAError as jc_err:
         logger.error(jc_err)
     except Exception as err:
@@ -83,16 +122,12 @@ def __assign_user(issue_key, accountId=None):
     try:
         logger.debug(f'[JIRA  ] Assigning user for issue `{issue_key}`..')
         if not accountId:
-            logger.debug(f'[JIRA  ] No accountId provided. Selecting random user.')
-            users = __search_assignable_users_for_projects()
-            if users:
-                logger.debug(f'[JIRA  ] User search: {len(users)} users found.')
-                accountId = random.choice(users).accountId
-            else:
-                logger.error(f'[JIRA  ] No assignable users were found for this project.')
+            logger.debug(f'[JIRA  ] No accountId provided. Selecting a user ({JIRA_ASSIGNMENT}).')
+            accountId = __select_assignee()
+            if not accountId:
                 return assigned
-            assigned = jc.assign_issue(issue_key, accountId)
-            logger.debug(f'[JIRA  ] User assigned: {assigned}')
+        assigned = client().assign_issue(issue_key, accountId)
+        logger.debug(f'[JIRA  ] User assigned: {assigned}')
     except JIRAError as jc_err:
         logger.error(jc_err)
     except Exception as err:
@@ -103,33 +138,113 @@ def __assign_user(issue_key, accountId=None):
 def __search_assignable_users_for_projects():
     try:
         logger.debug(f'[JIRA  ] Searching for assignable users for project `{JIRA_PROJECT_KEY}`.')
-        assignable = jc.search_assignable_users_for_projects('', JIRA_PROJECT_KEY)
+        assignable = client().search_assignable_users_for_projects('', JIRA_PROJECT_KEY)
+        return assignable
     except JIRAError as jc_err:
         logger.error(jc_err)
     except Exception as err:
         logger.error(err)
 
 
-def __set_priority(issue, priority_key):
+def __load_assignable_users():
+    if JIRA_ASSIGNEES:
+        return JIRA_ASSIGNEES
+    users = __search_assignable_users_for_projects()
+    if users is None:
+        return None
+    logger.debug(f'[JIRA  ] User search: {len(users)} users found.')
+    return [user.accountId for user in users if getattr(user, 'active', True)]
+
+
+def __load_priorities():
+    return {priority.name: priority.id for priority in client().priorities()}
+
+
+def __load_issue_types():
+    return {issue_type.name: issue_type.id for issue_type in client().issue_types()}
+
+
+def __load_open_issues():
+    users = METADATA.get('assignable_users')
+    if not users:
+        return None
+    quoted = ', '.join(f'"{user}"' for user in users)
+    jql = f'project = {JIRA_PROJECT_KEY} AND statusCategory != Done AND assignee in ({quoted})'
+    with __ASSIGN_LOCK:
+        # The issues assigned before the search are in its counts. Those assigned during the search may be too, so they
+        # are kept, and count twice until the next count, rather than not at all.
+        counted = Counter(__ASSIGNED)
+    open_issues = Counter()
+    for issue in client().search_issues(jql, fields='assignee', maxResults=False):
+        if issue.fields.assignee:
+            open_issues[issue.fields.assignee.accountId] += 1
+    with __ASSIGN_LOCK:
+        __ASSIGNED.subtract(counted)
+        for user in [user for user, assigned in __ASSIGNED.items() if assigned <= 0]:
+            del __ASSIGNED[user]
+    return open_issues
+
+
+METADATA = MetadataCache({
+    'assignable_users': (__load_assignable_users, JIRA_METADATA_TTL),
+    'priorities': (__load_priorities, JIRA_METADATA_TTL),
+    'issue_types': (__load_issue_types, JIRA_METADATA_TTL),
+    'open_issues': (__load_open_issues, JIRA_OPEN_ISSUES_TTL)
+})
+__ASSIGN_LOCK = threading.Lock()
+# Issues assigned per user since the open issues were last counted
+__ASSIGNED = Counter()
+__ROUND_ROBIN = count()
+
+
+def start_metadata_refresher():
+    """Refresh the cached Jira metadata (assignable users, priorities, issue types and open issues) in the background"""
+    METADATA.start()
+
+
+def stop_metadata_refresher():
+    METADATA.stop()
+
+
+def __select_assignee():
+    users = METADATA.get('assignable_users')
+    if not users:
+        logger.error(f'[JIRA  ] No assignable users were found for this project.')
+        return None
+    open_issues = METADATA.get('open_issues') if JIRA_ASSIGNMENT == 'least_open' else None
+    with __ASSIGN_LOCK:
+        turn = next(__ROUND_ROBIN)
+        if JIRA_ASSIGNMENT == 'random':
+            return random.choice(users)
+        if open_issues is None:
+            # Round robin, also if the open issues could not be counted
+            return users[turn % len(users)]
+        # Ties are broken in round robin order, so that equally loaded users take turns
+        user = min(users, key=lambda u: (open_issues.get(u, 0) + __ASSIGNED[u], (users.index(u) - turn) % len(users)))
+        __ASSIGNED[user] += 1
+        return user
+
+
+def __set_priority(issue, priority):
     try:
         logger.debug(f'[JIRA  ] Setting priority for issue `{issue.key}`.')
         issue.update(
             fields = {
-                'priority': {
-                    'id': priority_key,
-                    'name': PRIORITIES.get(priority_key)
-                }
+                'priority': priority
             }
         )
-        logger.debug(f'[JIRA  ] Priority for issue `{issue.key}` set to `{PRIORITIES.get(priority_key)}` ({priority_key}).')
+        logger.debug(f'[JIRA  ] Priority for issue `{issue.key}` set to `{priority.get("name")}` ({priority.get("id")}).')
     except JIRAError as jc_err:
         logger.error(jc_err)
     except Exception as err:
         logger.error(err)
 
 
-def __determine_priority(issue, classification):
-    logger.debug(f'[JIRA  ] Determining priority for issue `{issue.key}`.')
+def __determine_priority(classification, confidence_level):
+    logger.debug(f'[JIRA  ] Determining priority for `{classification}` (confidence level: {confidence_level}).')
+    if float(confidence_level) < MIN_CONFIDENCE_LEVEL:
+        logger.debug(f'[JIRA  ] Setting priority to `Highest` due to low confidence level [level: {confidence_level}]')
+        return '1'
     pri = '2'
     classification = classification.lower()
     if classification == 'malware':
@@ -142,8 +257,26 @@ def __determine_priority(issue, classification):
         pri = '3'
     elif classification == 'legitimate':
         pri = '5'
+    return pri
+
+
+def __determine_assignee(confidence_level):
+    if float(confidence_level) >= MIN_CONFIDENCE_LEVEL:
+        return None
+    logger.debug(f'[JIRA  ] Assigning user to handle manually due to low confidence level [level: {confidence_level}]')
+    return __select_assignee()
+
+
+def __priority_field(pri):
+    # The IDs of the priorities differ between instances, so they are looked up by name
+    name = PRIORITIES.get(pri)
+    priorities = METADATA.get('priorities') or {}
+    return {'id': priorities.get(name, pri), 'name': name}
 
-    __set_priority(issue, pri)    
+
+def __issue_type_field(issue_type):
+    issue_types = METADATA.get('issue_types') or {}
+    return {'id': issue_types[issue_type]} if issue_type in issue_types else {'name': issue_type}
 
 
 def __parse_template(classification, confidence_level, recipient, email_sender, email_subject, timedate):
@@ -166,22 +299,53 @@ def __parse_template(classification, confidence_level, recipient, email_sender,
     return summary, desc
 
 
-def create_issue(classification, confidence_level, recipient, email_sender, email_subject, timedate, attachment_filepath=None, comment=''):
+def __idempotency_label(idempotency_key):
+    # Labels cannot contain spaces, and Message-IDs can be long
+    return 'pura-' + hashlib.sha1(idempotency_key.encode('utf-8')).hexdigest()[:20]
+
+
+def __issue_fields(classification, confidence_level, recipient, email_sender, email_subject, timedate, issue_type='Task', idempotency_key=None):
+    summary, desc = __parse_template(classification, confidence_level, recipient, email_sender, email_subject, timedate)
+    pri = __determine_priority(classification, confidence_level)
+    fields = {
+        'project': {'key': JIRA_PROJECT_KEY},
+        'summary': summary,
+        'description': desc,
+        'issuetype': __issue_type_field(issue_type),
+        'priority': __priority_field(pri)
+    }
+    assignee = __determine_assignee(confidence_level)
+    if assignee:
+        fields['assignee'] = {'accountId': assignee}
+    if idempotency_key:
+        fields['labels'] = [__idempotency_label(idempotency_key)]
+    return fields
+
+
+def __finish_issue(issue_key, attachment=None, comment=''):
+    if attachment:
+        __add_attachment(issue_key, attachment, 'email')
+    if comment:
+        __add_comment(issue_key, comment)
+
+
+def create_issue(classification, confidence_level, recipient, email_sender, email_subject, timedate, attachment_filepath=None, comment='', attachment=None, idempotency_key=None):
+    """Create an issue, with its priority and assignee, in a single request
+
+        The attachment (a path or a binary file object) and the comment are added afterwards.
+        The issue is labeled with the `idempotency_key` (e.g. the Message-ID of the report),
+        if set, so that it can be found with `find_issues`.
+
+        Returns
+        -------
+        key : string
+            The key of the issue, or None if it could not be created.
+    """
     try:
-        summary, desc = __parse_template(classification, confidence_level, recipient, email_sender, email_subject, timedate)
-        issue = __create_issue(summary, desc)
+        issue = __create_issue(__issue_fields(classification, confidence_level, recipient, email_sender, email_subject, timedate, idempotency_key=idempotency_key))
         if issue:
-            __determine_priority(issue, classification)
-
-            if int(float(confidence_level)) < MIN_CONFIDENCE_LEVEL:
-                logger.debug(f'[JIRA  ] Assigning user to handle manually due to low confidence level [level: {confidence_level}]')
-                assigned = __assign_user(issue.key)
-                logger.debug(f'[JIRA  ] Setting priority to `Highest` due to low confidence level [level: {confidence_level}]')
-                __set_priority(issue, '1')
-            if attachment_filepath:
-                __add_attachment(issue.key, attachment_filepath, 'email')
-            if comment:
-                __add_comment(issue.key, comment)
+            __finish_issue(issue.key, attachment or attachment_filepath, comment)
+            return issue.key
         else:
             logger.error(f'[JIRA  ] An error occurred while creating the issue in JIRA.')
     except JIRAError as jc_err:
@@ -190,6 +354,120 @@ def create_issue(classification, confidence_level, recipient, email_sender, emai
         logger.error(err)
 
 
+def __create_bulk(field_list):
+    try:
+        logger.debug(f'[JIRA  ] Creating {len(field_list)} issues for project `{JIRA_PROJECT_KEY}`.')
+        # Rejected issues are returned as errors, other errors (e.g. Jira is down) are raised
+        results = client().create_issues(field_list, prefetch = False)
+    except JIRAError as jc_err:
+        logger.error(jc_err)
+        return [None] * len(field_list)
+    except Exception as err:
+        logger.error(err)
+        return [None] * len(field_list)
+    issues = []
+    for result, fields in zip(results, field_list):
+        if result.get('issue'):
+            issues.append(result['issue'])
+        else:
+            # Fall back to creating the rejected issue on its own, and setting priority and assignee separately
+            logger.warning(f'[JIRA  ] Bulk creation of an issue failed: {result.get("error")}')
+            issues.append(__create_issue_then_update(fields))
+    return issues
+
+
+def create_issues(reports):
+    """Create several issues with the bulk create endpoint, and then upload their attachments concurrently
+
+        Parameters
+        ----------
+        reports : list
+            The issues to create, as dicts with the keyword arguments of `create_issue`:
+                { 'classification', 'confidence_level', 'recipient', 'email_sender', 'email_subject', 'timedate',
+                  'attachment_filepath', 'attachment', 'comment', 'idempotency_key' }
+
+        Returns
+        -------
+        keys : list
+            The key of every issue, or None where it could not be created.
+    """
+    field_list = []
+    for report in reports:
+        try:
+            field_list.append(__issue_fields(report.get('classification'), report.get('confidence_level'), report.get('recipient'),
+                                             report.get('email_sender'), report.get('email_subject'), report.get('timedate'),
+                                             idempotency_key=report.get('idempotency_key')))
+        except Exception as err:
+            logger.error(err)
+            field_list.append(None)
+
+    issues = [None] * len(reports)
+    valid = [i for i, fields in enumerate(field_list) if fields]
+    for start in range(0, len(valid), JIRA_BULK_SIZE):
+        batch = valid[start:start + JIRA_BULK_SIZE]
+        for i, issue in zip(batch, __create_bulk([field_list[i] for i in batch])):
+            issues[i] = issue
+    keys = [issue.key if issue else None for issue in issues]
+    logger.info(f'[JIRA  ] Created {sum(1 for key in keys if key)} of {len(reports)} issues.')
+
+    uploads = [(key, report.get('attachment') or report.get('attachment_filepath'), report.get('comment', ''))
+               for key, report in zip(keys, reports) if key and (report.get('attachment') or report.get('attachment_filepath') or report.get('comment'))]
+    if uploads:
+        with ThreadPoolExecutor(max_workers=JIRA_UPLOAD_WORKERS, thread_name_prefix='jira-upload') as executor:
+            list(executor.map(lambda upload: __finish_issue(*upload), uploads))
+    return keys
+
+
+def find_issues(idempotency_keys):
+    """Find the issues that were created with the given idempotency keys (see `create_issue`)
+
+        Returns
+        -------
+        issues : dict
+            The key of the issue of every idempotency key that has one, or None if the search failed.
+    """
+    labels = {__idempotency_label(key): key for key in idempotency_keys}
+    found = {}
+    try:
+        for start in range(0, len(labels), JIRA_BULK_SIZE):
+            batch = list(labels)[start:start + JIRA_BULK_SIZE]
+            quoted = ', '.join(f'"{label}"' for label in batch)
+            jql = f'project = {JIRA_PROJECT_KEY} AND labels in ({quoted})'
+            logger.debug(f'[JIRA  ] Searching for {len(batch)} previously created issues.')
+            for issue in client().search_issues(jql, fields='labels', maxResults=len(batch)):
+                for label in issue.fields.labels:
+                    if label in labels:
+                        found[labels[label]] = issue.key
+        return found
+    except JIRAError as jc_err:
+        logger.error(jc_err)
+    except Exception as err:
+        logger.error(err)
+
+
+def find_comments(issue_key, idempotency_keys):
+    """Find the comments of an issue that were added with the given idempotency keys (see `add_comment_reported_again`)
+
+        Returns
+        -------
+        comments : dict
+            The ID of the comment of every idempotency key that has one, or None if the comments could not be read.
+    """
+    labels = {__idempotency_label(key): key for key in idempotency_keys}
+    found = {}
+    try:
+        logger.debug(f'[JIRA  ] Searching the comments of issue `{issue_key}` for {len(labels)} previously added comments.')
+        for comment in client().comments(issue_key):
+            for label, key in labels.items():
+                if label in comment.body:
+                    found[key] = comment.id
+        return found
+    except JIRAError as jc_err:
+        logger.error(jc_err)
+    except Exception as err:
+        logger.error(err)
+
+
 def add_comment_user_notified(issue_key, notified_user, message='', via='email'):
     try:
         body = f'Response sent to user {notified_user} via {via}.'
@@ -202,8 +480,27 @@ def add_comment_user_notified(issue_key, notified_user, message='', via='email')
         logger.error(err)
 
 
+def add_comment_reported_again(issue_key, email_sender, email_subject, timedate, reports=None, idempotency_key=None):
+    """Add a comment about another report of the same campaign to an issue
+
+        The comment is tagged with the `idempotency_key` (e.g. the Message-ID of the report),
+        if set, so that it can be found with `find_comments`.
+    """
+    try:
+        body = f'Reported again: {email_subject}\nSender: {email_sender}\nReceived: {timedate}'
+        if reports:
+            body += f'\n\nReports in this campaign: {reports}'
+        if idempotency_key:
+            body += f'\nReport: {__idempotency_label(idempotency_key)}'
+        return __add_comment(issue_key, body)
+    except JIRAError as jc_err:
+        logger.error(jc_err)
+    except Exception as err:
+        logger.error(err)
+
+
 def main():
-    if jc:
+    if client():
         classification = 'Phishing'
         confidence_level = '86.9'
         recipient = 'u.ser@mail.ru'
@@ -0,0 +1,116 @@
+import threading
+import time
+
+from pura.helpers.logger import rootLogger as logger
+
+# Seconds to wait before loading an entry again after a failure
+RETRY_AFTER = 60
+
+
+class MetadataCache:
+    """A TTL cache of slowly changing metadata (e.g. the assignable users of a project)
+
+        Every entry is loaded on first use, and kept for its TTL. While the background
+        thread runs, entries are reloaded before they expire, so `get` does not have to
+        wait for the server. Without it, an expired entry is reloaded by `get`.
+        If a reload fails, the previous value is kept.
+
+        Parameters
+        ----------
+        loaders : dict
+            The entries, keyed by name: { name: (load, ttl) }
+            load : callable
+                `load()`, returning the value, or None on failure.
+            ttl : float
+                Seconds that the value is used before it is reloaded.
+    """
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.stats = {'hits': 0, 'loads': 0, 'errors': 0}
+        self.__values = {}
+        self.__failed = {}
+        self.__locks = {name: threading.Lock() for name in loaders}
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __load(self, name):
+        load, _ = self.loaders[name]
+        try:
+            value = load()
+        except Exception as err:
+            logger.error(f'[JIRA  ] An error occurred while loading the {name}.')
+            logger.error(err)
+            value = None
+        if value is None:
+            self.stats['errors'] += 1
+            self.__failed[name] = time.time()
+            return self.__values[name][0] if name in self.__values else None
+        self.stats['loads'] += 1
+        self.__values[name] = (value, time.time())
+        self.__failed.pop(name, None)
+        logger.debug(f'[JIRA  ] Loaded the {name}.')
+        return value
+
+    def __expired(self, name, now, margin=0.0):
+        _, ttl = self.loaders[name]
+        if name in self.__failed and now - self.__failed[name] < min(RETRY_AFTER, ttl):
+            return False
+        return name not in self.__values or now - self.__values[name][1] >= ttl * (1 - margin)
+
+    def get(self, name):
+        """The value of an entry, loading it if it has not been loaded yet or has expired"""
+        if name in self.__values and (self.running or not self.__expired(name, time.time())):
+            self.stats['hits'] += 1
+            return self.__values[name][0]
+        with self.__locks[name]:
+            # Another thread may have loaded it in the meantime, or it failed to load recently
+            if not self.__expired(name, time.time()):
+                return self.__values[name][0] if name in self.__values else None
+            return self.__load(name)
+
+    def invalidate(self, name=None):
+        """Drop an entry (or all of them), so that it is loaded again on the next `get`"""
+        for key in [name] if name else list(self.loaders):
+            self.__values.pop(key, None)
+            self.__failed.pop(key, None)
+
+    def refresh(self, force=False):
+        """Reload the entries that are about to expire (or all of them if `force`)"""
+        now = time.time()
+        for name in self.loaders:
+            # Reload a tenth of the TTL early, so that `get` never finds an expired entry
+            if force or self.__expired(name, now, margin=0.1):
+                with self.__locks[name]:
+                    self.__load(name)
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.error(f'[JIRA  ] An error occurred while refreshing the metadata\n{err}')
+            now = time.time()
+            waits = [ttl * 0.9 - (now - self.__values[name][1]) if name in self.__values else RETRY_AFTER for name, (_, ttl) in self.loaders.items()]
+            self.__stop.wait(max(min(waits, default=RETRY_AFTER), 1))
+
+    def start(self):
+        if self.running:
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='jira-metadata', daemon=True)
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join(timeout)
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def status(self):
+        """The age in seconds of every entry (None if it has not been loaded), and the counters"""
+        now = time.time()
+        ages = {name: now - self.__values[name][1] if name in self.__values else None for name in self.loaders}
+        return {'age': ages, **self.stats}
@@ -1,6 +1,12 @@
+import json
 import os
+import re
+import select
 import smtplib
-from imaplib import IMAP4_SSL
+import ssl
+import threading
+import time
+from imaplib import IMAP4, IMAP4_SSL
 import email
 import emailyzer
 
@@ -15,25 +21,358 @@ if not os.path.exists(TEMP_DIR):
         logger.error(e)
 
 
+class MailboxState:
+    """The last processed UID and the UIDVALIDITY of every mailbox, persisted as JSON
+
+        Emails below the high-water mark that have been fetched but not handled yet are kept
+        as pending, with the number of attempts (see `fetched` and `acknowledge`). They are
+        fetched again after `retry_delay` seconds, up to `max_attempts` times, also after a
+        restart.
+
+        Parameters
+        ----------
+        path : string
+            The path of the state file.
+        retry_delay : float
+            Seconds after an attempt before a pending email is fetched again (`IMAP_RETRY_DELAY` if not set).
+        max_attempts : int
+            The max number of times an email is fetched (`IMAP_MAX_ATTEMPTS` if not set).
+    """
+    def __init__(self, path=None, retry_delay=None, max_attempts=None):
+        self.path = path or CONFIG.get('state_file')
+        self.retry_delay = CONFIG.get('retry_delay') if retry_delay is None else retry_delay
+        self.max_attempts = max_attempts or CONFIG.get('max_attempts')
+        self.__state = {}
+        self.__lock = threading.Lock()
+        try:
+            with open(self.path, 'r') as f:
+                self.__state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f'[MAILER] Unable to read the mailbox state from {self.path}. Starting from scratch.')
+            logger.error(e)
+
+    def get(self, mailbox):
+        """Returns (uidvalidity, last_uid) of a mailbox, or (None, 0) if it has not been processed before"""
+        entry = self.__state.get(mailbox, {})
+        return entry.get('uidvalidity'), entry.get('last_uid', 0)
+
+    def __entry(self, mailbox, uidvalidity):
+        # The pending emails of an earlier UIDVALIDITY are gone
+        entry = self.__state.get(mailbox)
+        if not entry or entry.get('uidvalidity') != uidvalidity:
+            entry = self.__state[mailbox] = {'uidvalidity': uidvalidity, 'last_uid': 0, 'pending': {}}
+        entry.setdefault('pending', {})
+        return entry
+
+    def update(self, mailbox, uidvalidity, last_uid):
+        with self.__lock:
+            self.__entry(mailbox, uidvalidity)['last_uid'] = last_uid
+
+    def advance(self, mailbox, uidvalidity, uids, done):
+        """Move the high-water mark of a mailbox up to the first of `uids` that is not `done`"""
+        if uidvalidity is None:
+            # Nothing was searched, and an unknown UIDVALIDITY must not replace the known one
+            return
+        known_uidvalidity, last_uid = self.get(mailbox)
+        last_uid = last_uid if known_uidvalidity == uidvalidity else 0
+        for uid in sorted(uids):
+            if uid not in done:
+                break
+            # Retried emails are below the high-water mark
+            if uid > last_uid:
+                self.update(mailbox, uidvalidity, uid)
+
+    def fetched(self, mailbox, uidvalidity, uid):
+        """Mark an email as fetched, and pending until it is acknowledged"""
+        with self.__lock:
+            pending = self.__entry(mailbox, uidvalidity)['pending']
+            attempts, _ = pending.get(str(uid), (0, 0))
+            pending[str(uid)] = [attempts + 1, time.time()]
+
+    def acknowledge(self, mailbox, uids):
+        """Mark emails as handled, so that they are not fetched again"""
+        with self.__lock:
+            pending = self.__state.get(mailbox, {}).get('pending', {})
+            for uid in uids:
+                pending.pop(str(uid), None)
+
+    def pending(self, mailbox=None):
+        """The UIDs of the pending emails of a mailbox, or a dict of them per mailbox if `mailbox` is not set"""
+        with self.__lock:
+            if mailbox is None:
+                return {mailbox: sorted(int(uid) for uid in entry.get('pending', {})) for mailbox, entry in self.__state.items()}
+            return sorted(int(uid) for uid in self.__state.get(mailbox, {}).get('pending', {}))
+
+    def retry(self, mailbox, uidvalidity, now=None):
+        """The UIDs of the pending emails of a mailbox that are due to be fetched again
+
+            Emails that have been fetched `max_attempts` times are given up on.
+        """
+        now = time.time() if now is None else now
+        with self.__lock:
+            entry = self.__state.get(mailbox)
+            if not entry or entry.get('uidvalidity') != uidvalidity:
+                return []
+            pending = entry.get('pending', {})
+            for uid, (attempts, _) in list(pending.items()):
+                if attempts >= self.max_attempts:
+                    logger.warning(f'[MAILER] Giving up on email with UID {uid} in {mailbox}, which was not handled after {attempts} attempts.')
+                    del pending[uid]
+            return sorted(int(uid) for uid, (_, last_attempt) in pending.items() if last_attempt <= now - self.retry_delay)
+
+    def save(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self.__lock:
+                state = json.dumps(self.__state)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(state)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f'[MAILER] An error occurred while saving the mailbox state to {self.path}.')
+            logger.error(e)
+
+
+def message_set(uids):
+    """Compress a list of UIDs into an IMAP message set, e.g. [1, 2, 3, 7] -> '1:3,7'"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(f'{first}:{last}' if first != last else str(first) for first, last in ranges)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 class FetchMail:
-    def __init__(self):
-        self.__mailbox = CONFIG.get('default_mailbox')
-        self.client = IMAP4_SSL(CONFIG.get('imap').get('server'))
+    def __init__(self, mailbox=None):
+        self.__mailbox = mailbox or CONFIG.get('default_mailbox')
+        imap = CONFIG.get('imap')
+        if imap.get('ssl'):
+            self.client = IMAP4_SSL(imap.get('server'), int(imap.get('port') or 993))
+        else:
+            self.client = IMAP4(imap.get('server'), int(imap.get('port') or 143))
         self.client.login(CONFIG.get('auth').get('user'), CONFIG.get('auth').get('pass'))
         self.client.select(self.__mailbox)
 
+    @property
+    def mailbox(self):
+        return self.__mailbox
+
+    def logout(self):
+        try:
+            self.client.logout()
+        except Exception as e:
+            logger.debug(f'[MAILER] An error occurred while logging out: {e}')
+
+    def __buffered(self):
+        # Whether a read would return without waiting: imaplib reads through a buffered file, which may already hold
+        # lines (e.g. an EXISTS sent with the IDLE continuation), like TLS records that have been received already.
+        # Neither is visible to select(), so peek without blocking.
+        sock = self.client.sock
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(self.client.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def __wait_readable(self, timeout):
+        if self.__buffered():
+            return True
+        readable, _, _ = select.select([self.client.sock], [], [], timeout)
+        return bool(readable)
+
+    def idle(self, timeout=None, stop=None):
+        """Wait for new emails with IMAP IDLE (RFC 2177)
+
+            Falls back to sleeping for `poll_interval` if the server does not support IDLE.
+
+            Parameters
+            ----------
+            timeout : float
+                Seconds to stay in IDLE before returning (servers drop idle clients after 30 minutes).
+            stop : threading.Event
+                Optional event that ends the IDLE early when set.
+
+            Returns
+            -------
+            new : bool
+                Whether the server reported new emails.
+
+            Raises
+            ------
+            IMAP4.abort
+                If the connection was lost.
+        """
+        timeout = timeout or CONFIG.get('idle_timeout')
+        deadline = time.time() + timeout
+        if 'IDLE' not in self.client.capabilities:
+            wait = min(timeout, CONFIG.get('poll_interval'))
+            if stop:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)
+            self.client.noop()
+            return True
+
+        # imaplib has no IDLE command, so speak it on the underlying connection
+        tag = self.client._new_tag()
+        self.client.send(tag + b' IDLE\r\n')
+        # Untagged responses may come before the continuation (RFC 2177), e.g. emails that just arrived
+        new = False
+        while True:
+            line = self.client.readline()
+            if not line:
+                raise IMAP4.abort('Connection closed while starting IDLE')
+            if line.startswith(b'+'):
+                break
+            if not line.startswith(b'*'):
+                raise IMAP4.error(f'IDLE was rejected: {line!r}')
+            if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                new = True
+        logger.debug(f'[MAILER] Waiting for new emails in the mailbox {self.__mailbox} (IDLE).')
+
+        while not new and time.time() < deadline and not (stop and stop.is_set()):
+            if not self.__wait_readable(min(1.0, max(deadline - time.time(), 0))):
+                continue
+            line = self.client.readline()
+            if not line:
+                raise IMAP4.abort('Connection closed during IDLE')
+            if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                new = True
+
+        self.client.send(b'DONE\r\n')
+        while True:
+            line = self.client.readline()
+            if not line:
+                raise IMAP4.abort('Connection closed while ending IDLE')
+            if line.startswith(tag):
+                break
+        return new
+
+    def __parse_fetch(self, data):
+        for res_part in data:
+            if isinstance(res_part, tuple):
+                # Not every email is UTF-8; undecodable bytes must not lose the whole email
+                eml = res_part[1].decode('utf-8', errors='replace')
+                if eml:
+                    return eml
+
     def fetch(self, _id):
         try:
             _type, data = self.client.fetch(_id, '(RFC822)')
-            for res_part in data:
-                if isinstance(res_part, tuple):
-                    eml = res_part[1].decode('utf-8')
-                    if eml:
-                        return eml
+            return self.__parse_fetch(data)
         except Exception as e:
             logger.error(f'[MAILER] An error occurred while fetching the email with id `{_id}`.')
             logger.error(e)
 
+    def fetch_uid(self, uid):
+        try:
+            _type, data = self.client.uid('FETCH', str(uid), '(RFC822)')
+            return self.__parse_fetch(data)
+        except Exception as e:
+            logger.error(f'[MAILER] An error occurred while fetching the email with UID `{uid}`.')
+            logger.error(e)
+
+    def __parse_bulk(self, data):
+        # Yields (uid, attributes, literal) for every literal in a FETCH response. A message starts with its
+        # sequence number, and may have several literals; its attributes (UID, RFC822.SIZE, ...) may come before,
+        # between or after them, so they are collected for the whole message first. The attributes of a literal
+        # are those sent with it, followed by those sent after the message's literals.
+        messages = []
+        for res_part in data:
+            meta, literal = res_part if isinstance(res_part, tuple) else (res_part, None)
+            if not isinstance(meta, bytes):
+                continue
+            if not messages or re.match(rb'\d+ \(', meta):
+                messages.append([])
+            messages[-1].append((meta, literal))
+        for parts in messages:
+            text = b' '.join(meta for meta, _ in parts)
+            match = re.search(rb'UID (\d+)', text)
+            if not match:
+                logger.warning(f'[MAILER] Skipping a FETCH response without a UID: {parts[0][0][:80]!r}')
+                continue
+            uid = int(match.group(1))
+            trailing = b' '.join(meta for meta, literal in parts if literal is None)
+            for meta, literal in parts:
+                if literal is not None:
+                    yield uid, meta + b' ' + trailing, literal
+
+    def fetch_sizes(self, uids, chunk_size=None):
+        """Fetch the size and headers of many emails, without marking them as read
+
+            Parameters
+            ----------
+            uids : list
+                The UIDs of the emails.
+            chunk_size : int
+                The number of emails to request per FETCH command.
+
+            Returns
+            -------
+            sizes : dict
+                { uid: (size, headers) }, for every UID that still exists.
+        """
+        chunk_size = chunk_size or CONFIG.get('fetch_chunk_size')
+        sizes = {}
+        for chunk in chunks(list(uids), chunk_size):
+            try:
+                _type, data = self.client.uid('FETCH', message_set(chunk), '(UID RFC822.SIZE BODY.PEEK[HEADER])')
+                for uid, meta, literal in self.__parse_bulk(data):
+                    match = re.search(rb'RFC822\.SIZE (\d+)', meta)
+                    if match:
+                        sizes[uid] = (int(match.group(1)), literal)
+            except Exception as e:
+                logger.error(f'[MAILER] An error occurred while fetching the headers of {len(chunk)} emails.')
+                logger.error(e)
+                break
+        return sizes
+
+    def fetch_many(self, uids, chunk_size=None):
+        """Fetch many emails with one FETCH command per chunk of UIDs
+
+            Parameters
+            ----------
+            uids : list
+                The UIDs of the emails.
+            chunk_size : int
+                The number of emails to request per FETCH command.
+
+            Yields
+            ------
+            (uid, eml) : (int, bytes)
+                The raw emails of every chunk, in UID order, as soon as the chunk has been received.
+        """
+        chunk_size = chunk_size or CONFIG.get('fetch_chunk_size')
+        for chunk in chunks(sorted(uids), chunk_size):
+            try:
+                _type, data = self.client.uid('FETCH', message_set(chunk), '(UID RFC822)')
+            except Exception as e:
+                logger.error(f'[MAILER] An error occurred while fetching {len(chunk)} emails.')
+                logger.error(e)
+                return
+            emls = {}
+            for uid, meta, literal in self.__parse_bulk(data):
+                if re.search(rb'RFC822 \{', meta):
+                    emls[uid] = literal
+            logger.debug(f'[MAILER] Fetched {len(emls)} emails in one command.')
+            for uid in sorted(emls):
+                yield uid, emls[uid]
+
     def read(self, eml):
         print(eml['subject'])
         print(eml['from'])
@@ -68,11 +407,15 @@ class FetchMail:
 
     def set_mailbox(self, name):
         try:
-            self.client.select(name)
+            typ, data = self.client.select(name)
+            if typ != 'OK':
+                raise IMAP4.error(f'{typ} {data}')
             self.__mailbox = name
+            return True
         except Exception as e:
             logger.error(f'[MAILER] An error occurred while setting the mailboxes to {name}.')
             logger.error(e)
+        return False
 
     def search(self, _from=None, subject=None, criterion='ALL'):
         try:
@@ -92,9 +435,70 @@ class FetchMail:
             logger.error(f'[MAILER] An error occurred while searching the mailbox.')
             logger.error(e)
 
+    def uidvalidity(self):
+        try:
+            _type, data = self.client.status(self.__mailbox, '(UIDVALIDITY)')
+            match = re.search(rb'UIDVALIDITY (\d+)', data[0])
+            if match:
+                return int(match.group(1))
+        except Exception as e:
+            logger.error(f'[MAILER] An error occurred while reading the UIDVALIDITY of the mailbox {self.__mailbox}.')
+            logger.error(e)
+
+    def search_uids(self, since_uid=0):
+        """Returns the sorted UIDs in the mailbox greater than `since_uid`"""
+        try:
+            _type, data = self.client.uid('SEARCH', None, f'UID {since_uid + 1}:*')
+            # `n:*` always includes the highest UID, even when it is lower than n
+            uids = sorted(uid for uid in (int(uid) for uid in data[0].split()) if uid > since_uid)
+            logger.debug(f'[MAILER] Found {len(uids)} emails with UID > {since_uid} in the mailbox {self.__mailbox}.')
+            return uids
+        except Exception as e:
+            logger.error(f'[MAILER] An error occurred while searching the mailbox.')
+            logger.error(e)
+        return []
+
+    def search_new(self, state):
+        """Search for the emails that arrived since the last run, and the pending emails that are due to be retried
+
+            A full resync is done if the UIDVALIDITY of the mailbox has changed.
+
+            Parameters
+            ----------
+            state : MailboxState
+                The persisted state of the mailboxes.
+
+            Returns
+            -------
+            uidvalidity : int
+                The current UIDVALIDITY of the mailbox.
+            uids : list
+                The sorted UIDs of the emails.
+
+            Raises
+            ------
+            IMAP4.error
+                If the UIDVALIDITY of the mailbox could not be read. It is not taken for a change,
+                which would resync the whole mailbox.
+        """
+        uidvalidity = self.uidvalidity()
+        if uidvalidity is None:
+            raise IMAP4.error(f'Unable to read the UIDVALIDITY of the mailbox {self.__mailbox}')
+        known_uidvalidity, last_uid = state.get(self.__mailbox)
+        if known_uidvalidity != uidvalidity:
+            if known_uidvalidity is not None:
+                logger.info(f'[MAILER] UIDVALIDITY of the mailbox {self.__mailbox} changed. Resyncing.')
+            last_uid = 0
+        retry = state.retry(self.__mailbox, uidvalidity)
+        if retry:
+            logger.info(f'[MAILER] Fetching {len(retry)} emails of the mailbox {self.__mailbox} again, which were not handled.')
+        return uidvalidity, sorted(set(retry).union(self.search_uids(last_uid)))
+
     def save_tmp(self, _id, eml_string):
         try:
-            tempfile_path = f'{TEMP_DIR}/eml_{_id.decode("utf-8")}'
+            if isinstance(_id, bytes):
+                _id = _id.decode('utf-8')
+            tempfile_path = f'{TEMP_DIR}/eml_{_id}'
             with open(tempfile_path, 'w') as f:
                 f.write(eml_string)
             return tempfile_path
@@ -0,0 +1,217 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+
+from pura.helpers.config import mail_config as CONFIG
+from pura.helpers.logger import rootLogger as logger
+from pura.modules.mail_client import FetchMail, MailboxState, chunks
+from pura.modules.raw_email import RawEmail
+
+
+def fetch_new(client, uids, done, max_size=None):
+    """Fetch emails by UID as RawEmails, skipping those larger than `max_size`
+
+        Sizes are fetched first, and the rest of the emails in bulk (see `FetchMail.fetch_many`).
+
+        Parameters
+        ----------
+        client : FetchMail
+            The connection, with the mailbox of the UIDs selected.
+        uids : list
+            The UIDs of the emails.
+        done : set
+            Every UID that is done with (fetched, skipped, or expunged in the meantime) is added to it.
+        max_size : int
+            The size in bytes above which an email is skipped (`MAX_EMAIL_SIZE` if not set).
+
+        Yields
+        ------
+        eml : RawEmail
+    """
+    max_size = max_size or CONFIG.get('max_message_size')
+    sizes = client.fetch_sizes(uids)
+    fetch = []
+    for uid in uids:
+        if uid not in sizes:
+            done.add(uid)
+        elif sizes[uid][0] > max_size:
+            logger.warning(f'[MAILER] Skipping email with UID {uid} in {client.mailbox} ({sizes[uid][0]} bytes > {max_size} bytes).')
+            done.add(uid)
+        else:
+            fetch.append(uid)
+    for uid, raw in client.fetch_many(fetch):
+        yield RawEmail(raw, uid=uid, mailbox=client.mailbox)
+        done.add(uid)
+
+
+class IMAPPool:
+    """A pool of authenticated IMAP connections, each with its own selected mailbox
+
+        Connections are opened on demand, up to `max_connections`, and are reused:
+        preferably one that already has the requested mailbox selected.
+        Callers block while every connection is in use.
+
+        Parameters
+        ----------
+        max_connections : int
+            The max number of open connections (`IMAP_MAX_CONNECTIONS` if not set).
+        connect : callable
+            `connect(mailbox)`, returning a new FetchMail with the mailbox selected.
+    """
+    def __init__(self, max_connections=None, connect=FetchMail):
+        self.max_connections = max_connections or CONFIG.get('max_connections')
+        self.connect = connect
+        self.__idle = []
+        self.__open = 0
+        self.__cond = threading.Condition()
+
+    def __acquire(self, mailbox):
+        with self.__cond:
+            while True:
+                for client in self.__idle:
+                    if client.mailbox == mailbox:
+                        self.__idle.remove(client)
+                        return client
+                if self.__idle:
+                    client = self.__idle.pop(0)
+                    if client.set_mailbox(mailbox):
+                        return client
+                    self.__open -= 1
+                    self.__cond.notify()
+                    client.logout()
+                    raise ValueError(f'Unable to select the mailbox {mailbox}')
+                if self.__open < self.max_connections:
+                    self.__open += 1
+                    break
+                self.__cond.wait()
+        try:
+            return self.connect(mailbox)
+        except Exception:
+            with self.__cond:
+                self.__open -= 1
+                self.__cond.notify()
+            raise
+
+    @contextmanager
+    def connection(self, mailbox=None):
+        """Check out a connection with `mailbox` selected (the default mailbox if not set)
+
+            A connection that raised an error is closed instead of being returned to the pool.
+        """
+        mailbox = mailbox or CONFIG.get('default_mailbox')
+        client = self.__acquire(mailbox)
+        try:
+            yield client
+        except Exception:
+            with self.__cond:
+                self.__open -= 1
+                self.__cond.notify()
+            client.logout()
+            raise
+        with self.__cond:
+            self.__idle.append(client)
+            self.__cond.notify()
+
+    def close(self):
+        with self.__cond:
+            idle, self.__idle = self.__idle, []
+            self.__open -= len(idle)
+        for client in idle:
+            client.logout()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __search(self, mailbox, state, limit):
+        with self.connection(mailbox) as client:
+            uidvalidity, uids = client.search_new(state)
+        return mailbox, uidvalidity, uids[:limit] if limit else uids
+
+    def __fetch(self, mailbox, uidvalidity, uids, done, queue, stop, pending):
+        fetched = set()
+        with self.connection(mailbox) as client:
+            for eml in fetch_new(client, uids, done):
+                if stop and stop.is_set():
+                    # The email is not done, so the high-water mark stays below it
+                    break
+                if pending:
+                    pending.fetched(mailbox, uidvalidity, eml.uid)
+                queue.put(eml)
+                fetched.add(eml.uid)
+        if pending:
+            # Emails that were skipped, or expunged in the meantime, are not fetched again
+            pending.acknowledge(mailbox, [uid for uid in uids if uid in done and uid not in fetched])
+        return len(fetched)
+
+    def fetch(self, mailboxes=None, queue=None, limit=None, state=None, range_size=None, stop=None):
+        """Fetch the new emails of several mailboxes in parallel
+
+            The new UIDs of every mailbox are split into ranges of `range_size`, so that a
+            large mailbox is fetched over several connections too. The high-water marks of
+            the mailboxes are saved once every range has been fetched.
+
+            Parameters
+            ----------
+            mailboxes : list
+                The mailboxes to fetch (`IMAP_MAILBOXES` if not set).
+            queue : queue.Queue
+                The queue to put the fetched RawEmails in, as soon as they have been received.
+                If not set, the emails are returned.
+            limit : int
+                The maximum number of emails to fetch per mailbox.
+            state : MailboxState
+                The persisted state of the mailboxes (loaded from `MAILBOX_STATE_FILE` if not set). If set, the
+                fetched emails stay pending in it until they are acknowledged (see `MailboxState.acknowledge`),
+                and are fetched again on a later run otherwise.
+            range_size : int
+                The max number of UIDs per range (`IMAP_FETCH_CHUNK_SIZE` if not set).
+            stop : threading.Event
+                If set, no more emails are fetched. Those that were not fetched are fetched on the next run.
+
+            Returns
+            -------
+            emls : list
+                The fetched emails, if no queue was given, otherwise the number of fetched emails.
+        """
+        mailboxes = mailboxes or CONFIG.get('mailboxes')
+        pending = state
+        state = state or MailboxState()
+        range_size = range_size or CONFIG.get('fetch_chunk_size')
+        out = queue if queue is not None else Queue()
+        fetched = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix='imap-fetch') as executor:
+            searches = [executor.submit(self.__search, mailbox, state, limit) for mailbox in mailboxes]
+            searched, fetches = [], []
+            for search in searches:
+                try:
+                    mailbox, uidvalidity, uids = search.result()
+                except Exception as e:
+                    logger.error(f'[MAILER] An error occurred while searching for new emails.')
+                    logger.error(e)
+                    continue
+                # The ranges of a mailbox share one set of done UIDs
+                done = set()
+                searched.append((mailbox, uidvalidity, uids, done))
+                for uid_range in chunks(uids, range_size):
+                    fetches.append((mailbox, executor.submit(self.__fetch, mailbox, uidvalidity, uid_range, done, out, stop, pending)))
+
+            for mailbox, future in fetches:
+                try:
+                    fetched += future.result()
+                except Exception as e:
+                    logger.error(f'[MAILER] An error occurred while fetching emails from the mailbox {mailbox}.')
+                    logger.error(e)
+
+        for mailbox, uidvalidity, uids, done in searched:
+            state.advance(mailbox, uidvalidity, uids, done)
+        state.save()
+        logger.info(f'[MAILER] Fetched {fetched} emails from {len(mailboxes)} mailboxes.')
+        if queue is None:
+            return [out.get() for _ in range(out.qsize())]
+        return fetched
+
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pura.helpers.logger import rootLogger as logger
+
+# Statuses of a message. Failed messages are not handled: the mailbox state keeps them pending, and they are fetched
+# again after `IMAP_RETRY_DELAY` seconds (see `MailboxState`).
+REPORTED = 'reported'
+QUEUED = 'queued'
+REPEATED = 'repeated'
+FAILED = 'failed'
+HANDLED = (REPORTED, QUEUED, REPEATED)
+
+
+class MessageStore:
+    """The messages that have been handled, with their classification, threat intel result and Jira issue
+
+        Messages are keyed by their Message-ID (or another unique key), and can also be
+        looked up by mailbox and UID. Checking whether messages have been handled is a
+        primary key lookup, done for a whole batch in one query, so it is cheap enough
+        to do before any other work. The store also answers metrics queries (see `summary`)
+        without calling Jira.
+
+        Parameters
+        ----------
+        path : string
+            The path of the SQLite database.
+    """
+    COLUMNS = ('key', 'mailbox', 'uid', 'sender', 'subject', 'label', 'class', 'confidence', 'tier', 'threats', 'threat', 'campaign', 'issue_key', 'status', 'handled')
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS messages (
+            key TEXT PRIMARY KEY,
+            mailbox TEXT,
+            uid INTEGER,
+            sender TEXT,
+            subject TEXT,
+            label INTEGER,
+            class TEXT,
+            confidence REAL,
+            tier TEXT,
+            threats INTEGER NOT NULL DEFAULT 0,
+            threat TEXT,
+            campaign INTEGER,
+            issue_key TEXT,
+            status TEXT NOT NULL,
+            handled REAL NOT NULL
+        )''')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS messages_uid ON messages (mailbox, uid)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS messages_handled ON messages (handled)')
+        self.__db.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def handled(self, keys):
+        """The subset of `keys` whose messages have been handled"""
+        keys = list(set(key for key in keys if key))
+        found = set()
+        with self.__lock:
+            # Below SQLite's limit of host parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.__db.execute(
+                    f'SELECT key FROM messages WHERE key IN ({", ".join("?" * len(batch))}) AND status IN ({", ".join("?" * len(HANDLED))})',
+                    batch + list(HANDLED)
+                ).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    def handled_uids(self, mailbox, uids):
+        """The subset of the UIDs of a mailbox whose messages have been handled"""
+        uids = list(set(uids))
+        found = set()
+        with self.__lock:
+            for start in range(0, len(uids), 500):
+                batch = uids[start:start + 500]
+                rows = self.__db.execute(
+                    f'SELECT uid FROM messages WHERE mailbox = ? AND uid IN ({", ".join("?" * len(batch))}) AND status IN ({", ".join("?" * len(HANDLED))})',
+                    [mailbox] + batch + list(HANDLED)
+                ).fetchall()
+                found.update(row[0] for row in rows)
+        return found
+
+    def get(self, key=None, mailbox=None, uid=None):
+        """A message by its key, or by its mailbox and UID, as a dict (None if it is not in the store)"""
+        with self.__lock:
+            if key:
+                row = self.__db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM messages WHERE key = ?', (key,)).fetchone()
+            else:
+                row = self.__db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM messages WHERE mailbox = ? AND uid = ? ORDER BY handled DESC', (mailbox, uid)).fetchone()
+        if not row:
+            return None
+        message = dict(zip(self.COLUMNS, row))
+        message['threat'] = json.loads(message['threat']) if message['threat'] else None
+        return message
+
+    def record(self, messages):
+        """Store or update messages
+
+            Parameters
+            ----------
+            messages : list
+                The messages, as dicts with any of the `COLUMNS` ('key' and 'status' are required).
+                A known issue key is not overwritten by None.
+        """
+        now = time.time()
+        rows = []
+        for message in messages:
+            message = dict(message)
+            message.setdefault('handled', now)
+            if message.get('threat') is not None:
+                threat = message['threat']
+                message['threats'] = sum(1 for match in threat if match.get('found'))
+                message['threat'] = json.dumps(threat)
+            rows.append(tuple(message.get(column, 0 if column == 'threats' else None) for column in self.COLUMNS))
+        updates = ', '.join(f'{column} = excluded.{column}' for column in self.COLUMNS if column not in ('key', 'issue_key', 'status'))
+        with self.__lock:
+            try:
+                # The issue of a queued message may have been created already (see `set_issue_key`)
+                self.__db.executemany(
+                    f'''INSERT INTO messages ({", ".join(self.COLUMNS)}) VALUES ({", ".join("?" * len(self.COLUMNS))})
+                        ON CONFLICT (key) DO UPDATE SET {updates},
+                        issue_key = COALESCE(excluded.issue_key, messages.issue_key),
+                        status = CASE WHEN excluded.status = '{QUEUED}' AND messages.issue_key IS NOT NULL THEN '{REPORTED}' ELSE excluded.status END''',
+                    rows
+                )
+                self.__db.commit()
+            except sqlite3.Error as e:
+                logger.error(f'[STORE ] An error occurred while recording {len(rows)} messages.')
+                logger.error(e)
+
+    def set_issue_key(self, key, issue_key):
+        """Record the Jira issue of a message, also if the message itself has not been recorded yet"""
+        with self.__lock:
+            self.__db.execute(
+                '''INSERT INTO messages (key, issue_key, status, handled) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET issue_key = excluded.issue_key,
+                   status = CASE WHEN messages.status = ? THEN ? ELSE messages.status END''',
+                (key, issue_key, REPORTED, time.time(), QUEUED, REPORTED)
+            )
+            self.__db.commit()
+
+    def set_status(self, keys, status):
+        """Change the status of the messages that have been recorded"""
+        with self.__lock:
+            self.__db.executemany('UPDATE messages SET status = ? WHERE key = ?', [(status, key) for key in keys])
+            self.__db.commit()
+
+    def summary(self, since=None):
+        """Metrics of the handled messages (since the UNIX timestamp `since`, if set)
+
+            Returns
+            -------
+            summary : dict
+                { 'messages': int, 'reported': int, 'threats': int, 'mean_confidence': float,
+                  'status': dict, 'class': dict, 'tier': dict, 'mailbox': dict }
+                reported : int
+                    The number of messages with a Jira issue.
+                threats : int
+                    The number of messages with at least one host found in the threat intel feeds.
+                status, class, tier, mailbox : dict
+                    The number of messages per status, class, cascade tier and mailbox.
+        """
+        where, params = ('WHERE handled >= ?', (since,)) if since is not None else ('', ())
+        with self.__lock:
+            total, reported, threats, confidence = self.__db.execute(
+                f'SELECT COUNT(*), COUNT(issue_key), SUM(threats > 0), AVG(confidence) FROM messages {where}', params
+            ).fetchone()
+            groups = {
+                column: dict(self.__db.execute(f'SELECT {column}, COUNT(*) FROM messages {where} GROUP BY {column}', params).fetchall())
+                for column in ('status', 'class', 'tier', 'mailbox')
+            }
+        return {'messages': total, 'reported': reported, 'threats': threats or 0, 'mean_confidence': confidence, **groups}
@@ -0,0 +1,286 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from pura.helpers.logger import rootLogger as logger
+
+
+class Outbox:
+    """A durable queue of records in SQLite, which a background worker delivers with retries
+
+        `put` returns once the record has been committed to disk, and the worker delivers
+        it later, in batches. A batch that fails is retried with exponential backoff, and
+        records survive restarts until they are delivered. A record that is still not delivered
+        after `max_attempts` attempts (e.g. its issue was deleted, or its payload is rejected) is
+        given up on: it is marked as failed, together with the records that wait for it, and is
+        no longer retried. Every record has a unique key: putting a key that is already queued
+        (or was delivered or given up on within `retention` seconds) does nothing.
+
+        Records are delivered at least once: after a crash the last batch is delivered
+        again, with its `attempts` above 0, so `deliver` can check whether it already got
+        through before.
+
+        Parameters
+        ----------
+        path : string
+            The path of the SQLite database.
+        deliver : callable
+            `deliver(records)`, delivering a list of records and returning a result per record
+            (e.g. the key of the created issue), or None where it failed. Records are dicts:
+                { 'key', 'kind', 'payload', 'attachment', 'attempts', 'parent' }
+                payload : dict
+                    The JSON serializable payload, as it was put.
+                attachment : bytes
+                    The binary attachment, or None.
+                attempts : int
+                    The number of previous attempts to deliver the record.
+                parent : string
+                    The result of the parent record, if the record has one.
+        batch_size : int
+            The max number of records per `deliver` call.
+        retry_min, retry_max : float
+            Seconds before the first retry of a record, doubled on every failure up to `retry_max`.
+        max_attempts : int
+            The number of attempts after which a record is given up on, or None to retry it forever.
+        retention : float
+            Seconds that delivered and given up records are kept, to ignore them when they are put again.
+        on_failed : callable
+            `on_failed(keys)`, called with the keys of the records that were given up on.
+    """
+    def __init__(self, path, deliver, batch_size=50, retry_min=5, retry_max=600, max_attempts=20, retention=7 * 24 * 3600, on_failed=None):
+        self.path = path
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.on_failed = on_failed
+        self.stats = {'queued': 0, 'duplicates': 0, 'delivered': 0, 'failed': 0, 'given_up': 0}
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        # A record is on disk once `put` has returned, even if the machine crashes
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=FULL')
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            parent TEXT,
+            payload TEXT NOT NULL,
+            attachment BLOB,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            result TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            delivered REAL,
+            failed REAL
+        )''')
+        # Outboxes created before records could be given up on
+        if 'failed' not in [row[1] for row in self.__db.execute('PRAGMA table_info(outbox)')]:
+            self.__db.execute('ALTER TABLE outbox ADD COLUMN failed REAL')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (delivered, next_attempt)')
+        self.__db.commit()
+
+    def start(self):
+        if self.__thread:
+            return
+        self.__stopping.clear()
+        self.__thread = threading.Thread(target=self.__run, name='outbox', daemon=True)
+        self.__thread.start()
+        pending = self.counters()['pending']
+        if pending:
+            logger.info(f'[OUTBOX] {pending} records are waiting to be delivered.')
+
+    def close(self, timeout=None):
+        """Deliver the records that are due, and stop the worker
+
+            Records that are waiting for a retry stay on disk, and are delivered after the next start.
+        """
+        if self.__thread:
+            self.__stopping.set()
+            self.__wakeup.set()
+            self.__thread.join(timeout)
+            if self.__thread.is_alive():
+                logger.warning(f'[OUTBOX] Stopped waiting for the delivery of the outbox after {timeout}s.')
+                return
+            self.__thread = None
+        with self.__lock:
+            self.__db.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, key, payload, kind='issue', attachment=None, parent=None):
+        """Store a record durably, and wake up the worker
+
+            Parameters
+            ----------
+            key : string
+                The unique key of the record (e.g. the Message-ID of a report).
+            payload : dict
+                The JSON serializable content of the record.
+            kind : string
+                The kind of record, for `deliver`.
+            attachment : bytes
+                A binary attachment.
+            parent : string
+                The key of a record that must be delivered first. Its result is passed to `deliver`.
+
+            Returns
+            -------
+            queued : bool
+                False if a record with the same key is already in the outbox.
+        """
+        now = time.time()
+        with self.__lock:
+            cursor = self.__db.execute(
+                'INSERT OR IGNORE INTO outbox (key, kind, parent, payload, attachment, next_attempt, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, kind, parent, json.dumps(payload), attachment, now, now)
+            )
+            self.__db.commit()
+            queued = cursor.rowcount > 0
+            self.stats['queued' if queued else 'duplicates'] += 1
+        if queued:
+            self.__wakeup.set()
+        else:
+            logger.debug(f'[OUTBOX] Record `{key}` is already in the outbox.')
+        return queued
+
+    def discard_children(self, key):
+        """Remove the undelivered records that wait for the record `key`, returning their keys"""
+        with self.__lock:
+            keys = [row[0] for row in self.__db.execute('SELECT key FROM outbox WHERE parent = ? AND delivered IS NULL', (key,))]
+            self.__db.execute('DELETE FROM outbox WHERE parent = ? AND delivered IS NULL', (key,))
+            self.__db.commit()
+        return keys
+
+    def result(self, key):
+        """The result of a delivered record, or None"""
+        with self.__lock:
+            row = self.__db.execute('SELECT result FROM outbox WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def counters(self):
+        """Counters since the start, and the number of records that are pending, retrying, delivered or given up on"""
+        with self.__lock:
+            pending, retrying, oldest = self.__db.execute(
+                'SELECT COUNT(*), SUM(attempts > 0), MIN(created) FROM outbox WHERE delivered IS NULL AND failed IS NULL'
+            ).fetchone()
+            delivered = self.__db.execute('SELECT COUNT(*) FROM outbox WHERE delivered IS NOT NULL').fetchone()[0]
+            failed = self.__db.execute('SELECT COUNT(*) FROM outbox WHERE failed IS NOT NULL').fetchone()[0]
+            stats = dict(self.stats)
+        stats.update({
+            'pending': pending,
+            'retrying': retrying or 0,
+            'stored_delivered': delivered,
+            'stored_failed': failed,
+            'oldest_pending_s': time.time() - oldest if oldest else 0.0
+        })
+        return stats
+
+    def __due(self, now):
+        # Records whose parent has not been delivered yet are not due
+        rows = self.__db.execute('''
+            SELECT o.id, o.key, o.kind, o.payload, o.attachment, o.attempts, p.result
+            FROM outbox o LEFT JOIN outbox p ON p.key = o.parent
+            WHERE o.delivered IS NULL AND o.failed IS NULL AND o.next_attempt <= ? AND (o.parent IS NULL OR p.delivered IS NOT NULL)
+            ORDER BY o.id LIMIT ?
+        ''', (now, self.batch_size)).fetchall()
+        return [{
+            'id': row[0],
+            'key': row[1],
+            'kind': row[2],
+            'payload': json.loads(row[3]),
+            'attachment': row[4],
+            'attempts': row[5],
+            'parent': row[6]
+        } for row in rows]
+
+    def __next_wait(self, now):
+        # Records that wait for their parent are due once the parent has been delivered, which is checked right after
+        row = self.__db.execute('''
+            SELECT MIN(o.next_attempt) FROM outbox o LEFT JOIN outbox p ON p.key = o.parent
+            WHERE o.delivered IS NULL AND o.failed IS NULL AND (o.parent IS NULL OR p.delivered IS NOT NULL)
+        ''').fetchone()
+        return min(max(row[0] - now, 0), self.retry_max) if row[0] is not None else None
+
+    def __give_up(self, record, error, now):
+        # The records that wait for it would never be due
+        children = [row[0] for row in self.__db.execute('SELECT key FROM outbox WHERE parent = ? AND delivered IS NULL AND failed IS NULL', (record['key'],))]
+        self.__db.execute('UPDATE outbox SET failed = ?, error = ?, attachment = NULL WHERE key = ? OR (parent = ? AND delivered IS NULL AND failed IS NULL)',
+                          (now, error, record['key'], record['key']))
+        self.stats['given_up'] += 1 + len(children)
+        logger.error(f'[OUTBOX] Giving up on record `{record["key"]}` ({record["kind"]}) after {record["attempts"] + 1} attempts'
+                     + (f', and on the {len(children)} records that wait for it.' if children else '.'))
+        return [record['key']] + children
+
+    def __record(self, records, results, error=None):
+        now = time.time()
+        given_up = []
+        with self.__lock:
+            for record, result in zip(records, results):
+                if result is not None:
+                    self.__db.execute('UPDATE outbox SET result = ?, error = NULL, delivered = ?, attachment = NULL WHERE id = ?', (str(result), now, record['id']))
+                    self.stats['delivered'] += 1
+                elif self.max_attempts and record['attempts'] + 1 >= self.max_attempts:
+                    self.stats['failed'] += 1
+                    given_up.extend(self.__give_up(record, error, now))
+                else:
+                    backoff = min(self.retry_min * 2 ** record['attempts'], self.retry_max)
+                    self.__db.execute('UPDATE outbox SET next_attempt = ?, error = ? WHERE id = ?', (now + backoff, error, record['id']))
+                    self.stats['failed'] += 1
+            self.__db.execute('DELETE FROM outbox WHERE delivered < ? OR failed < ?', (now - self.retention, now - self.retention))
+            self.__db.commit()
+        if given_up and self.on_failed:
+            try:
+                self.on_failed(given_up)
+            except Exception as e:
+                logger.error(f'[OUTBOX] An error occurred while handling {len(given_up)} records that were given up on.')
+                logger.error(e)
+
+    def __run(self):
+        while True:
+            now = time.time()
+            with self.__lock:
+                records = self.__due(now)
+                if records:
+                    # Count the attempt before delivering, so that a crash during delivery is known after the restart
+                    self.__db.executemany('UPDATE outbox SET attempts = attempts + 1 WHERE id = ?', [(record['id'],) for record in records])
+                    self.__db.commit()
+                else:
+                    wait = self.__next_wait(now)
+            if not records:
+                if self.__stopping.is_set():
+                    return
+                self.__wakeup.wait(wait)
+                self.__wakeup.clear()
+                continue
+
+            error = None
+            try:
+                results = self.deliver(records)
+            except Exception as e:
+                logger.error(f'[OUTBOX] An error occurred while delivering {len(records)} records.')
+                logger.error(e)
+                results, error = [None] * len(records), str(e)
+            self.__record(records, results, error)
+            failed = sum(1 for result in results if result is None)
+            if failed:
+                logger.warning(f'[OUTBOX] {failed} of {len(records)} records were not delivered. Retrying later.')
+            else:
+                logger.debug(f'[OUTBOX] Delivered {len(records)} records.')
@@ -0,0 +1,155 @@
+from bisect import bisect_left
+
+
+class _Node:
+    __slots__ = ('children', 'terminal', 'paths')
+
+    def __init__(self):
+        self.children = {}
+        # Whether a feed entry is exactly this host, without a path
+        self.terminal = False
+        # Paths of the feed entries on this host, sorted once the trie is finalized
+        self.paths = None
+
+
+def normalize_host(host):
+    """Lower-case a host and strip any credentials, port and trailing dot"""
+    host = host.rsplit('@', 1)[-1]
+    if host.startswith('['):
+        host = host[1:].split(']', 1)[0]
+    elif host.count(':') == 1:
+        host = host.split(':', 1)[0]
+    return host.strip().rstrip('.').lower()
+
+
+def host_labels(host):
+    """The labels of a normalized host, top-level domain first. IP addresses are a single label"""
+    if host.replace('.', '').isdigit() or ':' in host:
+        return [host]
+    return [label for label in reversed(host.split('.')) if label]
+
+
+def is_searchable(host, labels):
+    """Whether a host is specific enough for partial matches (a bare top-level domain would match most of the feed)"""
+    return len(labels) >= 2 or '.' in host or ':' in host
+
+
+def split_host_path(entry):
+    """Split a URL or `host/path` entry into (host, path)"""
+    if '://' in entry:
+        entry = entry.split('://', 1)[1]
+    host, sep, path = entry.partition('/')
+    return normalize_host(host), f'{sep}{path}'
+
+
+class DomainTrie:
+    """A reverse-label trie of the hosts in a feed
+
+        `login.evil.com/verify` is stored under the path com -> evil -> login, with
+        `/verify` kept in the sorted path list of the `login` node. This turns the partial
+        matches of a host into walks down the trie:
+
+        - subdomain: a feed entry is on the host or one of its subdomains
+        - parent: a feed entry is a parent domain of the host
+        - path: a feed entry on the host (or a subdomain) has a path starting with the query path
+
+        IP addresses are stored as a single label.
+    """
+    def __init__(self):
+        self.__root = _Node()
+        self.__dirty = False
+        self.size = 0
+
+    def insert(self, host, path=''):
+        labels = host_labels(normalize_host(host))
+        if not labels:
+            return
+        node = self.__root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = _Node()
+            node = child
+        if path and path != '/':
+            # A URL is not a listed domain: its path only matches the FQDN/path tier
+            if node.paths is None:
+                node.paths = []
+            node.paths.append(path)
+            self.__dirty = True
+        else:
+            node.terminal = True
+        self.size += 1
+
+    def finalize(self):
+        """Sort the path lists. Done lazily on the first path lookup after an insert"""
+        if not self.__dirty:
+            return
+        stack = [self.__root]
+        while stack:
+            node = stack.pop()
+            if node.paths:
+                node.paths = sorted(set(node.paths))
+            stack.extend(node.children.values())
+        self.__dirty = False
+
+    def __find(self, host):
+        host = normalize_host(host)
+        labels = host_labels(host)
+        if not is_searchable(host, labels):
+            return None
+        node = self.__root
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                return None
+        return node
+
+    def walk(self):
+        """Yield (labels, terminal, paths) for every node of the trie, labels top-level domain first"""
+        self.finalize()
+        stack = [(self.__root, [])]
+        while stack:
+            node, labels = stack.pop()
+            if labels:
+                yield labels, node.terminal, node.paths or []
+            for label, child in node.children.items():
+                stack.append((child, labels + [label]))
+
+    def __subtree(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def has_subdomain(self, host):
+        """Whether a feed entry is on the host or any of its subdomains"""
+        node = self.__find(host)
+        return node is not None and node is not self.__root
+
+    def has_parent(self, host):
+        """Whether a host-only feed entry is a parent domain of the host (excluding the top-level domain)"""
+        labels = host_labels(normalize_host(host))
+        node = self.__root
+        for depth, label in enumerate(labels[:-1]):
+            node = node.children.get(label)
+            if node is None:
+                return False
+            if node.terminal and depth > 0:
+                return True
+        return False
+
+    def has_path(self, host, path):
+        """Whether a feed entry on the host, or one of its subdomains, has a path starting with `path`"""
+        node = self.__find(host)
+        if node is None or node is self.__root:
+            return False
+        if not path or path == '/':
+            return True
+        self.finalize()
+        for child in self.__subtree(node):
+            if child.paths:
+                i = bisect_left(child.paths, path)
+                if i < len(child.paths) and child.paths[i].startswith(path):
+                    return True
+        return False
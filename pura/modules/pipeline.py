@@ -0,0 +1,164 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pura.helpers.logger import rootLogger as logger
+
+# Marks the end of the items of a queue
+_DONE = object()
+
+
+def percentile(values, q):
+    """The `q`th percentile (0-100) of `values` by the nearest-rank method, or 0.0 if there are none"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(int(len(values) * q / 100 + 0.5), 1) - 1]
+
+
+class Stage:
+    """A stage of a Pipeline
+
+        Parameters
+        ----------
+        name : string
+        func : callable
+            `func(batch)`, run in a thread with a list of items, and returning the list of
+            items for the next stage. None items are dropped.
+        workers : int
+            The number of batches that are processed at once.
+        batch_size : int
+            The max number of items per batch. Batches are not delayed to fill them up:
+            a batch is whatever is waiting in the queue, up to `batch_size` items.
+        size : callable
+            `size(item)`, the number of units (e.g. emails) in an item of the queue of the stage, for the
+            stats of this stage and of the one before it. Every item counts as 1 if not set.
+    """
+    def __init__(self, name, func, workers=1, batch_size=1, size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.size = size
+
+
+def _size(stage, items):
+    return sum(stage.size(item) for item in items) if stage and stage.size else len(items)
+
+
+class Pipeline:
+    """Stages connected by bounded queues, run with asyncio and the blocking work in threads
+
+        Every stage takes batches of items from its queue, and puts the results in the queue
+        of the next stage. The queues hold at most `queue_size` items, so a slow stage holds
+        up the stages before it (backpressure) and the memory use is bounded by the queue
+        sizes, not by the number of items. Meanwhile the network waits of different stages
+        overlap.
+
+        When the source is exhausted, every stage finishes the items in its queue and in
+        flight before the next stage is told that no more items will come, so ending the
+        source drains the pipeline gracefully.
+
+        Parameters
+        ----------
+        stages : list
+            The Stages, in order.
+        queue_size : int
+            The max number of items in the queue of a stage.
+    """
+    def __init__(self, stages, queue_size=100):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {}
+        self.__latencies = {}
+
+    async def __feed(self, source, queue, executor):
+        # The running loop (`get_running_loop` needs Python 3.7)
+        loop = asyncio.get_event_loop()
+        iterator = iter(source)
+        while True:
+            # The source may block (e.g. waiting for the mail server), so it is read in a thread
+            item = await loop.run_in_executor(executor, next, iterator, _DONE)
+            if item is _DONE:
+                break
+            await queue.put(item)
+        await queue.put(_DONE)
+
+    async def __work(self, stage, inbox, outbox, executor, next_stage):
+        loop = asyncio.get_event_loop()
+        stats = self.stats[stage.name]
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # Leave it for the other workers of the stage
+                inbox.put_nowait(_DONE)
+                return
+            batch = [item]
+            while len(batch) < stage.batch_size and not inbox.empty():
+                item = inbox.get_nowait()
+                if item is _DONE:
+                    inbox.put_nowait(_DONE)
+                    break
+                batch.append(item)
+            stats['in'] += _size(stage, batch)
+            stats['batches'] += 1
+            stats['max_queue'] = max(stats['max_queue'], inbox.qsize() + len(batch))
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(executor, stage.func, batch)
+            except Exception as e:
+                logger.error(f'[PIPE  ] Stage `{stage.name}` failed on a batch of {len(batch)} items.')
+                logger.error(e)
+                stats['failed'] += _size(stage, batch)
+                results = []
+            elapsed = time.perf_counter() - start
+            stats['seconds'] += elapsed
+            self.__latencies[stage.name].append(elapsed)
+
+            for result in results or []:
+                if result is None:
+                    stats['failed'] += 1
+                    continue
+                stats['out'] += _size(next_stage, [result])
+                if outbox is not None:
+                    await outbox.put(result)
+
+    async def __run_stage(self, stage, inbox, outbox, executor, next_stage):
+        await asyncio.gather(*[self.__work(stage, inbox, outbox, executor, next_stage) for _ in range(stage.workers)])
+        if outbox is not None:
+            await outbox.put(_DONE)
+
+    async def run(self, source):
+        """Pass every item of `source` (an iterable, which may block) through the stages
+
+            Returns
+            -------
+            stats : dict
+                Per stage: the items (or units, see `Stage`) in and out, failed items, batches, seconds spent in `func`,
+                the median and 99th percentile seconds per batch, and the max number of items
+                that were waiting in its queue.
+        """
+        self.stats = {stage.name: {'in': 0, 'out': 0, 'failed': 0, 'batches': 0, 'seconds': 0.0, 'p50_s': 0.0, 'p99_s': 0.0, 'max_queue': 0} for stage in self.stages}
+        self.__latencies = {stage.name: [] for stage in self.stages}
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        workers = sum(stage.workers for stage in self.stages) + 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline') as executor:
+            await asyncio.gather(
+                self.__feed(source, queues[0], executor),
+                *[self.__run_stage(stage, queues[i], queues[i + 1] if i + 1 < len(queues) else None, executor, self.stages[i + 1] if i + 1 < len(self.stages) else None)
+                  for i, stage in enumerate(self.stages)]
+            )
+        for name, latencies in self.__latencies.items():
+            self.stats[name]['p50_s'] = percentile(latencies, 50)
+            self.stats[name]['p99_s'] = percentile(latencies, 99)
+        return self.stats
+
+    def process(self, source):
+        """Run the pipeline on `source` in a new event loop, blocking until it has been drained"""
+        # Like `asyncio.run`, which needs Python 3.7
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run(source))
+        finally:
+            loop.close()
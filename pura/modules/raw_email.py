@@ -0,0 +1,105 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from email import policy
+from email.parser import BytesHeaderParser
+
+import emailyzer
+
+from pura.helpers.logger import rootLogger as logger
+from pura.modules.mail_client import TEMP_DIR
+
+# Attachments larger than this are spooled to a temporary file instead of being kept in memory
+SPOOL_MAX_SIZE = int(os.getenv('EMAIL_SPOOL_SIZE', str(5 * 1024 * 1024)))
+
+
+class RawEmail:
+    """An email as fetched from the mail server, kept as the raw bytes
+
+        Nothing is decoded or written to disk up front. The headers are parsed on demand,
+        the email is parsed with emailyzer on first access to any of its attributes
+        (`subject`, `hosts`, ...), and `open()` provides the bytes as a file for uploads.
+
+        Parameters
+        ----------
+        raw : bytes
+            The email (RFC822).
+        uid : int
+            The IMAP UID of the email, if any.
+        mailbox : string
+            The mailbox the email was fetched from, if any.
+    """
+    filepath = None
+
+    def __init__(self, raw, uid=None, mailbox=None):
+        self.raw = raw
+        self.uid = uid
+        self.mailbox = mailbox
+        self.__headers = None
+        self.__parsed = None
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set on the instance, i.e. those of the parsed email
+        if name.startswith('__') or name.startswith('_RawEmail__'):
+            raise AttributeError(name)
+        return getattr(self.parse(), name)
+
+    @property
+    def headers(self):
+        """The headers of the email, without parsing the body"""
+        if self.__headers is None:
+            self.__headers = BytesHeaderParser(policy=policy.default).parsebytes(self.raw)
+        return self.__headers
+
+    @property
+    def message_id(self):
+        return (self.headers.get('Message-ID') or '').strip() or None
+
+    def parse(self):
+        """Parse the email with emailyzer (once)
+
+            emailyzer only reads from a path, so the bytes are handed to it through an
+            anonymous in-memory file where the platform supports it (`memfd_create`), and
+            through a temporary file that is removed right after parsing otherwise.
+        """
+        if self.__parsed is None:
+            with self.path() as path:
+                self.__parsed = emailyzer.from_eml(path)
+        return self.__parsed
+
+    @contextmanager
+    def path(self):
+        """A path to the email, valid until the context exits"""
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create(f'eml_{self.uid}', os.MFD_CLOEXEC)
+            try:
+                view = memoryview(self.raw)
+                while view:
+                    view = view[os.write(fd, view):]
+                yield f'/proc/self/fd/{fd}'
+            finally:
+                os.close(fd)
+        else:
+            with tempfile.NamedTemporaryFile(prefix=f'eml_{self.uid}_', dir=TEMP_DIR) as f:
+                f.write(self.raw)
+                f.flush()
+                yield f.name
+
+    @contextmanager
+    def open(self):
+        """The email as a binary file object, e.g. to upload it as an attachment
+
+            The file is kept in memory up to `EMAIL_SPOOL_SIZE` bytes, and is spooled to a
+            temporary file above that. It is closed (and removed) when the context exits.
+        """
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, prefix=f'eml_{self.uid}_', dir=TEMP_DIR)
+        try:
+            f.write(self.raw)
+            f.seek(0)
+            yield f
+        finally:
+            f.close()
+            logger.debug(f'[MAILER] Released the spooled copy of the email with UID {self.uid}.')
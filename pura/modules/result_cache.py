@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from pura.helpers.logger import rootLogger as logger
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def content_key(content, version=''):
+    """A hash of an email body, after normalizing unicode and whitespace, and the model version"""
+    content = WHITESPACE_RE.sub(' ', unicodedata.normalize('NFC', content)).strip()
+    return hashlib.sha256(f'{version}\0{content}'.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """A two-tier cache of JSON serializable results: an LRU in memory, backed by SQLite
+
+        Entries that are read from the disk tier are promoted to the memory tier. The disk
+        tier survives restarts, and is trimmed to `disk_entries` by evicting the least
+        recently used entries.
+
+        Parameters
+        ----------
+        path : string
+            The path of the SQLite database, or None to only cache in memory.
+        memory_entries : int
+            The max number of entries in memory.
+        disk_entries : int
+            The max number of entries on disk.
+    """
+    def __init__(self, path=None, memory_entries=1000, disk_entries=100000):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.__memory = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db = None
+        self.__disk_count = 0
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.__db = sqlite3.connect(path, check_same_thread=False)
+                self.__db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)')
+                self.__db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+                self.__db.commit()
+                self.__disk_count = self.__db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            except sqlite3.Error as e:
+                logger.error(f'[CACHE ] Unable to open the cache {path}. Caching in memory only.')
+                logger.error(e)
+                self.__db = None
+
+    def __remember(self, key, value):
+        self.__memory[key] = value
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.memory_entries:
+            self.__memory.popitem(last=False)
+
+    def get(self, key):
+        """The cached value of a key, or None"""
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return self.__memory[key]
+            if self.__db:
+                try:
+                    row = self.__db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                    if row:
+                        self.__db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+                        self.__db.commit()
+                        value = json.loads(row[0])
+                        self.__remember(key, value)
+                        self.stats['disk_hits'] += 1
+                        return value
+                except (sqlite3.Error, ValueError) as e:
+                    logger.error(f'[CACHE ] An error occurred while reading from the cache.')
+                    logger.error(e)
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__remember(key, value)
+            if not self.__db:
+                return
+            try:
+                row = (json.dumps(value), time.time(), key)
+                if self.__db.execute('UPDATE results SET value = ?, accessed = ? WHERE key = ?', row).rowcount == 0:
+                    self.__db.execute('INSERT INTO results (value, accessed, key) VALUES (?, ?, ?)', row)
+                    self.__disk_count += 1
+                if self.__disk_count > self.disk_entries:
+                    # Trim a tenth below the limit, so that trimming is not needed on every put
+                    excess = self.__disk_count - self.disk_entries + self.disk_entries // 10
+                    self.__db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)', (excess,))
+                    self.__disk_count = self.__db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+                self.__db.commit()
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                logger.error(f'[CACHE ] An error occurred while writing to the cache.')
+                logger.error(e)
+
+    def close(self):
+        with self.__lock:
+            if self.__db:
+                self.__db.close()
+                self.__db = None
+
+    def counters(self):
+        """Hit and miss counters, and the hit rate"""
+        with self.__lock:
+            stats = dict(self.stats)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        stats['memory_entries'] = len(self.__memory)
+        stats['disk_entries'] = self.__disk_count
+        return stats
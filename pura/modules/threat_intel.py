@@ -1,24 +1,39 @@
+import hashlib
+import io
 import os
-import re
 import sys
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait
+from csv import Error as CSVError
+from csv import reader as csv_reader
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
-import pura.helpers.regex as REGEX
+from pura.helpers.hosts import is_ip, is_url
 from pura.helpers.logger import rootLogger as logger
+from pura.modules.feed_cache import FeedCache
+from pura.modules.feed_index import FeedIndex
+from pura.modules.feed_refresher import FeedRefresher
+from pura.modules.feed_snapshot import SnapshotIndex, write_snapshot
 
-# TODO Cache files in temp dir
 CACHE_FILES = bool(int(os.getenv('CACHE_THREAT_FEEDS', '1')))
 CACHE_HRS = int(os.getenv('CACHE_THREAT_FEEDS_HRS', '24'))
+CACHE = FeedCache(max_age_hrs=CACHE_HRS) if CACHE_FILES else None
+# Directory of the compiled, memory-mapped feed snapshots shared by all workers (requires caching)
+SNAPSHOT_DIR = os.getenv('THREAT_FEED_SNAPSHOT_DIR')
+# Seconds to wait for a single feed to connect/send data, and for all feeds to be loaded
+FEED_TIMEOUT = float(os.getenv('THREAT_FEED_TIMEOUT', '10'))
+FEED_DEADLINE = float(os.getenv('THREAT_FEED_DEADLINE', '30'))
+# Minutes between background refreshes of a feed (see `start_refresher`)
+FEED_REFRESH_MINS = float(os.getenv('THREAT_FEED_REFRESH_MINS', '60'))
 
 FEEDS = {
     'plain': [
         'https://raw.githubusercontent.com/stamparm/ipsum/master/ipsum.txt',    # IPsum suspicious/malicious hosts
         'https://cinsscore.com/list/ci-badguys.txt',    # Collective Intelligence Network Security
         'https://openphish.com/feed.txt',   # OpenPhish
-        'https://panwdbl.appspot.com/lists/mdl.txt' # Malware Domain List,
+        'https://panwdbl.appspot.com/lists/mdl.txt',    # Malware Domain List
         'https://cybercrime-tracker.net/all.php'    # Cybercrime known hosts
     ],
     'csv': [
@@ -27,171 +42,253 @@ FEEDS = {
 }
 
 
-def __get_fqdn(host):
-    try:
-        o = urlparse(host)
-        if o.netloc:
-            return o.netloc
-        else:
-            logger.warning('[TH-INT] No netloc found in host.')
-    except ValueError as e:
-        logger.error(f'[TH-INT] An error occurred while parsing a host.')
-        logger.error(e)
+def __create_session():
+    # One connection pool per feed host, shared by all fetches
+    pool_size = len(FEEDS['plain']) + len(FEEDS['csv'])
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-    return host
 
+SESSION = __create_session()
 
-def __get_fqdn_path(host):
-    try:
-        o = urlparse(host)
-        if o.netloc:
-            if not o.path:
-                logger.warning('[TH-INT] No path found in host.')
-            return f'{o.netloc}{o.path}'
-        else:
-            logger.warning('[TH-INT] No netloc found in host.')
-    except ValueError as e:
-        logger.error(f'[TH-INT] An error occurred while parsing a host.')
-        logger.error(e)
 
-    return host
+class __FeedStream:
+    """Stream the body of a feed as text lines, without holding the whole response in memory"""
+    def __init__(self, feed_url):
+        self.feed_url = feed_url
+        self.res = None
 
+    def __enter__(self):
+        self.res = SESSION.get(self.feed_url, timeout=FEED_TIMEOUT, stream=True)
+        self.res.raise_for_status()
+        # Let urllib3 undo any Content-Encoding (gzip) while streaming,
+        # and keep the stream open at EOF so that TextIOWrapper can finish reading
+        self.res.raw.decode_content = True
+        self.res.raw.auto_close = False
+        return io.TextIOWrapper(self.res.raw, encoding=self.res.encoding or 'utf-8', errors='replace', newline='')
 
-def __is_ip(host):
+    def __exit__(self, *args):
+        if self.res is not None:
+            self.res.close()
+
+
+def __parse_csv(lines):
+    """Yield the URLs/IPs of a CSV feed, read row by row
+
+        Parameters
+        ----------
+        lines : iterable
+            The lines of the CSV (e.g. a text file object). Quoted fields, including ones
+            with embedded commas or newlines, are handled by the `csv` module.
+    """
+    rows = csv_reader(lines)
     try:
-        match = re.match(REGEX.IP, host, re.IGNORECASE)
-    except Exception as e:
+        headers = next(rows, None)
+        if not headers:
+            logger.error('[TH-INT] Response is empty. No CSV to parse.')
+            return
+        try:
+            index = headers.index('url')
+        except ValueError:
+            try:
+                index = headers.index('ip')
+            except ValueError:
+                logger.error(f'[TH-INT] Unable to find either [url, ip] in headers of CSV. Returning empty list.')
+                return
+
+        for row in rows:
+            try:
+                data = row[index]
+                if data:
+                    if is_ip(data) or is_url(data):
+                        yield data
+            except IndexError:
+                pass
+    except CSVError as e:
+        logger.error(f'[TH-INT] Unable to parse CSV (line {rows.line_num}).')
         logger.error(e)
-    if match:
-        return True
 
-    return False
+
+def __build_index(feed_url, lines, csv=False):
+    index = FeedIndex(__parse_csv(lines) if csv else lines)
+    if not len(index):
+        if csv:
+            logger.error(f'[TH-INT] No feed was returned from parsing the CSV.')
+        else:
+            logger.error(f'[TH-INT] Feed for {feed_url} is None or empty. Skipping.')
+        return None
+    return index
+
+
+# Compiled indexes of the cached feeds, keyed by feed URL: (cache version, FeedIndex or SnapshotIndex)
+__INDEXES = {}
 
 
-def __is_url(host):
+def __snapshot_path(feed_url):
+    name = hashlib.sha1(feed_url.encode('utf-8')).hexdigest()
+    return os.path.join(SNAPSHOT_DIR, f'{name}.snap')
+
+
+def __open_snapshot(feed_url, version):
+    # A snapshot is current if it was written after the cached feed
+    path = __snapshot_path(feed_url)
     try:
-        match = re.match(REGEX.URL, host, re.IGNORECASE)
-    except Exception as e:
-        logger.error(e)
-    if match:
-        return True
+        if os.stat(path).st_mtime_ns >= version:
+            logger.debug(f'[TH-INT] Using snapshot of feed {feed_url}.')
+            return SnapshotIndex(path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f'[TH-INT] Unable to open snapshot of feed {feed_url}.')
+        logger.warning(e)
+    return None
+
 
-    return False
+def __write_snapshot(feed_url, index):
+    path = __snapshot_path(feed_url)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        write_snapshot(index, path)
+        logger.debug(f'[TH-INT] Wrote snapshot of feed {feed_url} to {path}.')
+        return SnapshotIndex(path)
+    except (OSError, ValueError) as e:
+        logger.error(f'[TH-INT] Unable to write snapshot of feed {feed_url}.')
+        logger.error(e)
+    return None
 
 
-def __fetch_feed(feed):
-    with requests.Session() as session:
-        try:
-            res = session.get(feed)
-            res.raise_for_status()
-        except HTTPError as http_err:
-            logger.error(f'[TH-INT] HTTP error while fetching a feed\n{http_err}')
-        except Exception as err:
-            logger.error(f'[TH-INT] An error occurred while fetching a feed\n{err}')
-    if res and res.text:
+def __load_index(feed_url, csv=False):
+    if CACHE:
+        version = CACHE.refresh(SESSION, feed_url, timeout=FEED_TIMEOUT)
+        if version is None:
+            logger.error(f'[TH-INT] Feed for {feed_url} is None or empty. Skipping.')
+            return None
+        cached = __INDEXES.get(feed_url)
+        if cached and cached[0] == version:
+            return cached[1]
+        if SNAPSHOT_DIR:
+            index = __open_snapshot(feed_url, version)
+            if index:
+                __INDEXES[feed_url] = (version, index)
+                return index
         try:
-            return res.text.split('\n')
-        except Exception:
-            return res.text
+            with CACHE.open(feed_url) as f:
+                index = __build_index(feed_url, f, csv)
+        except OSError as e:
+            logger.error(f'[TH-INT] Unable to read cached feed for {feed_url}.')
+            logger.error(e)
+            return None
+        if index:
+            if SNAPSHOT_DIR:
+                # Drop the in-memory index in favour of the shared snapshot
+                index = __write_snapshot(feed_url, index) or index
+            __INDEXES[feed_url] = (version, index)
+        return index
 
+    try:
+        with __FeedStream(feed_url) as f:
+            return __build_index(feed_url, f, csv)
+    except HTTPError as http_err:
+        logger.error(f'[TH-INT] HTTP error while fetching a feed\n{http_err}')
+    except Exception as err:
+        logger.error(f'[TH-INT] An error occurred while fetching a feed\n{err}')
     return None
 
 
-def __parse_csv(response):
-    hosts = []
-    if response:
+def __feeds():
+    return [(feed_url, False) for feed_url in FEEDS['plain']] + [(feed_url, True) for feed_url in FEEDS['csv']]
+
+
+REFRESHER = None
+
+
+def start_refresher(wait=None):
+    """Keep the feed indexes fresh from a background thread
+
+        Once started, lookups use the indexes of the refresher and never touch the network.
+
+        Parameters
+        ----------
+        wait : float
+            If set, block for up to `wait` seconds until the feeds have been loaded once.
+
+        Returns
+        -------
+        refresher : FeedRefresher
+    """
+    global REFRESHER
+    if REFRESHER is None:
+        REFRESHER = FeedRefresher(__feeds(), __load_index, interval=FEED_REFRESH_MINS * 60)
+    REFRESHER.start(wait=wait)
+    return REFRESHER
+
+
+def stop_refresher():
+    if REFRESHER:
+        REFRESHER.stop()
+
+
+def feed_status():
+    """The age and last refresh status of every feed (see `FeedRefresher.status`)"""
+    if REFRESHER:
+        return REFRESHER.status()
+    return [{ 'feed_url': feed_url, 'age': CACHE.age(feed_url) if CACHE else None } for feed_url, _ in __feeds()]
+
+
+def __load_indexes():
+    """Load the index of every feed concurrently
+
+        Every feed gets its own worker thread, and the feeds share the pooled `SESSION`.
+        Feeds that are not loaded within `FEED_DEADLINE` seconds are skipped.
+        If the background refresher is running, its current indexes are returned instead.
+
+        Returns
+        -------
+        indexes : dict
+            The FeedIndex of every feed that was loaded, keyed by feed URL.
+    """
+    if REFRESHER and REFRESHER.running:
+        return REFRESHER.indexes
+
+    feeds = __feeds()
+    executor = ThreadPoolExecutor(max_workers=len(feeds), thread_name_prefix='feed')
+    futures = {executor.submit(__load_index, feed_url, csv): feed_url for feed_url, csv in feeds}
+    done, not_done = wait(futures, timeout=FEED_DEADLINE)
+    # Don't wait for the stragglers, they are bound by FEED_TIMEOUT. Feeds that have not started are cancelled
+    # one by one, since `shutdown(cancel_futures=True)` needs Python 3.9.
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+    indexes = {}
+    for future in done:
         try:
-            if isinstance(response, list):
-                headers = response.pop(0).split(',')
-                try:
-                    index = headers.index('url')
-                except ValueError:
-                    try:
-                        index = headers.index('ip')
-                    except ValueError:
-                        logger.error(f'[TH-INT] Unable to find either [url, ip] in headers of CSV. Returning empty list.')
-                        return hosts
-
-                for line in response:
-                    line = line.split(',')
-                    try:
-                        data = line[index]
-                        if data:
-                            if __is_ip(data) or __is_url(data):
-                                hosts.append(data)
-                    except IndexError:
-                        pass
-            else:
-                logger.error('[TH-INT] Response is not of expected type `list`. Returning empty list.')
-        except Exception as e:
-            logger.error(e)
-    else:
-        logger.error('[TH-INT] Response is empty. No CSV to parse.')
-
-    return hosts
-
-
-def __strip_feed(feed):
-    parsed = []
-    # Remove comments, blank lines, and any counts
-    feed = [line.split()[0] for line in feed if not line.startswith('#') and line != '']
-    # Some FEEDS use dashes (-) for IP ranges
-    # Split them up and add each to the main list
-    # TODO: Get the full range, not just split
-    for line in feed:
-        match = re.match(REGEX.IP_MULTI, line, re.IGNORECASE)
-        if match:
-            print(line)
-            ips = line.split('-')
-            parsed += ips
-        else:
-            parsed.append(line)
-    return parsed
-
-
-def __is_in_feed(host, feed):
-    feed = __strip_feed(feed)
-    if __is_ip(host):
-        if host in feed:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: IP, exact)')
-            return True, 1.0
-    if __is_url(host):
-        fqdn_path = __get_fqdn_path(host)
-        if fqdn_path in feed:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN/path, exact)')
-            return True, 1.0
-        fqdn = __get_fqdn(host)
-        if fqdn in feed:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN, exact)')
-            return True, 1.0
-    if host in feed:
-        logger.debug(f'[TH-INT] Host {host} found in feed (src: full, exact)')
-        return True, 1.0
-
-    # No direct match, look deeper.
-    # Look for partial matches
-    match = [line for line in feed if host in line]
-    if __is_url(host):
-        fqdn_path = __get_fqdn_path(host)
-        match = [line for line in feed if fqdn_path in line]
-        if match:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN/path, partial) [match: {match}]')
-            return True, 0.8
-        fqdn = __get_fqdn(host)
-        match = [line for line in feed if fqdn in line]
-        if match:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: FQDN, partial) [match: {match}]')
-            return True, 0.6
-    if __is_ip(host):
-        match = [line for line in feed if host in line]
-        if match:
-            logger.debug(f'[TH-INT] Host {host} found in feed (src: IP, partial) [match: {match}]')
-            return True, 0.6
-    if match:
-        logger.debug(f'[TH-INT] Host {host} found in feed (src: full, partial) [match: {match}]')
-        return True, 0.7
-
-    return False, 0.0
+            index = future.result()
+        except Exception as err:
+            logger.error(f'[TH-INT] An error occurred while loading the feed {futures[future]}\n{err}')
+            continue
+        if index:
+            indexes[futures[future]] = index
+    for future in not_done:
+        logger.error(f'[TH-INT] Feed {futures[future]} was not loaded within {FEED_DEADLINE}s. Skipping.')
+    return indexes
+
+
+def __match_hosts(hosts, indexes, lookup):
+    results = []
+    for feed_url in FEEDS['plain'] + FEEDS['csv']:
+        if len(results) == len(hosts):
+            return results
+        if feed_url in indexes:
+            for host in hosts:
+                found, confidence = lookup(feed_url, host)
+                if found:
+                    results.append({ 'host': host, 'found': found, 'confidence': confidence, 'feed_url': feed_url })
+                    break
+    return results
 
 
 def is_threat(hosts):
@@ -216,43 +313,55 @@ def is_threat(hosts):
                 feed_url : string
                     The URL of the threat intel where the host was found.
     """
-    results = []
-
     logger.info(f'[TH-INT] Checking host {len(hosts)} against threat intel feeds.')
-    
-    for feed_url in FEEDS['plain']:
-        if len(results) == len(hosts):
-            return results
-        feed = __fetch_feed(feed_url)
-        if feed:
-            for host in hosts:
-                found = False
-                host = host.strip()
-                found, confidence = __is_in_feed(host, feed)
-                if found:
-                    results.append({ 'host': host, 'found': found, 'confidence': confidence, 'feed_url': feed_url })
-                    break
-        else:
-            logger.error(f'[TH-INT] Feed for {feed_url} is None or empty. Skipping.')
-    for feed_url in FEEDS['csv']:
-        if len(results) == len(hosts):
-            return results
-        feed = __fetch_feed(feed_url)
-        if feed:
-            feed = __parse_csv(feed)
-            if feed:
-                for host in hosts:
-                    found = False
-                    host = host.strip()
-                    found, confidence = __is_in_feed(host, feed)
-                    if found:
-                        results.append({ 'host': host, 'found': found, 'confidence': confidence, 'feed_url': feed_url })
-                        break
-            else:
-                logger.error(f'[TH-INT] No feed was returned from parsing the CSV.')
-        else:
-            logger.error(f'[TH-INT] Feed for {feed_url} is None or empty. Skipping.')
-    return results
+    hosts = [host.strip() for host in hosts]
+
+    indexes = __load_indexes()
+    return __match_hosts(hosts, indexes, lambda feed_url, host: indexes[feed_url].lookup(host))
+
+
+def is_threat_batch(batch):
+    """Check the hosts of several emails against the threat intelligence sources at once
+
+        The feeds are loaded once for the whole batch, and every distinct host is only
+        looked up once per feed, no matter how many emails it appears in.
+
+        Parameters
+        ----------
+        batch : list
+            A list of host lists, one per email (see `is_threat`).
+
+        Returns
+        -------
+        results : list
+            The results of `is_threat` for every host list, in input order.
+        stats : dict
+            { 'requested': int, 'unique': int, 'lookups': int }
+                requested : int
+                    The total number of hosts in the batch.
+                unique : int
+                    The number of distinct hosts in the batch.
+                lookups : int
+                    The number of feed lookups that were performed.
+    """
+    batch = [[host.strip() for host in hosts] for hosts in batch]
+    requested = sum(len(hosts) for hosts in batch)
+    unique = len(set(host for hosts in batch for host in hosts))
+    logger.info(f'[TH-INT] Checking {requested} hosts ({unique} unique) from {len(batch)} emails against threat intel feeds.')
+
+    indexes = __load_indexes() if requested else {}
+    memo = {}
+
+    def lookup(feed_url, host):
+        key = (feed_url, host)
+        if key not in memo:
+            memo[key] = indexes[feed_url].lookup(host)
+        return memo[key]
+
+    results = [__match_hosts(hosts, indexes, lookup) for hosts in batch]
+    stats = { 'requested': requested, 'unique': unique, 'lookups': len(memo) }
+    logger.debug(f'[TH-INT] Batch lookups: {stats}')
+    return results, stats
 
 
 def main():
@@ -0,0 +1,264 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+from pura.helpers.logger import rootLogger as logger
+
+
+def _work(conn, func, initializer):
+    # Runs in the worker process: initialize once, then run tasks until told to stop
+    try:
+        if initializer:
+            initializer()
+    except Exception as e:
+        conn.send(('failed', repr(e)))
+        return
+    conn.send(('ready', None))
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        try:
+            conn.send(('done', func(*task)))
+        except Exception as e:
+            # Exceptions are not always picklable, so only their description is sent back
+            conn.send(('error', repr(e)))
+
+
+# Seconds before a worker whose initialization failed is started again, doubled on every failure in a row
+RETRY_MIN = 1
+RETRY_MAX = 60
+# Initialization failures in a row, across all workers, after which the queued tasks fail instead of waiting
+MAX_INIT_FAILURES = 5
+
+
+class _Worker:
+    def __init__(self, ctx, func, initializer, failures=0):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_work, args=(child_conn, func, initializer), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.tasks = 0
+        self.future = None
+        self.deadline = None
+        # Initialization failures in a row, and when the worker is started again after the last one
+        self.failures = failures
+        self.retry_at = None
+
+    def stop(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """A pool of long-lived worker processes, which are initialized once and then run tasks
+
+        Tasks are handed to idle workers by a dispatcher thread. A worker that exceeds the
+        task timeout is killed and replaced, and workers are replaced after `max_tasks` tasks
+        to bound their memory growth. Replacements are started right away, so that their
+        initialization overlaps with the work of the others. A worker that fails to initialize
+        is started again with exponential backoff, while the others keep taking tasks. After
+        `MAX_INIT_FAILURES` failed initializations in a row, and as long as no worker is ready,
+        the queued tasks fail with RuntimeError instead of waiting for a worker.
+
+        Workers are started with `start_method`, not forked from the current process by
+        default: the process has threads (e.g. the dispatcher), whose locks a forked child
+        could inherit while they are held.
+
+        Parameters
+        ----------
+        func : callable
+            The task, run as `func(*args)` in a worker. Must be picklable (a module-level function).
+        workers : int
+            The number of worker processes.
+        initializer : callable
+            Run once in every worker before it takes tasks, e.g. to load models.
+        timeout : float
+            Seconds a task may run before its worker is killed, or None.
+        max_tasks : int
+            The number of tasks after which a worker is replaced, or None.
+        start_method : string
+            The multiprocessing start method of the workers: 'forkserver' where it is available, otherwise 'spawn'.
+    """
+    def __init__(self, func, workers=None, initializer=None, timeout=None, max_tasks=None, start_method=None):
+        self.func = func
+        self.size = workers or multiprocessing.cpu_count()
+        self.initializer = initializer
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'timeouts': 0, 'recycled': 0}
+        if not start_method:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.__ctx = multiprocessing.get_context(start_method)
+        self.__workers = []
+        self.__pending = deque()
+        self.__lock = threading.Lock()
+        self.__wakeup_r, self.__wakeup_w = self.__ctx.Pipe(duplex=False)
+        self.__closing = False
+        self.__thread = None
+        self.__init_failures = 0
+
+    def start(self):
+        if self.__thread:
+            return
+        self.__workers = [self.__spawn() for _ in range(self.size)]
+        self.__thread = threading.Thread(target=self.__run, name='worker-pool', daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        """Finish the pending tasks, and then stop the workers"""
+        if not self.__thread:
+            return
+        with self.__lock:
+            self.__closing = True
+            self.__wakeup_w.send(None)
+        self.__thread.join()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, *args):
+        """Queue a task, returning a concurrent.futures.Future of its result
+
+            The future raises TimeoutError if the task timed out, and RuntimeError if it
+            raised an error or its worker died.
+        """
+        future = Future()
+        with self.__lock:
+            if self.__closing or not self.__thread:
+                raise RuntimeError('The worker pool is not running')
+            self.__pending.append((future, args))
+            self.stats['submitted'] += 1
+            self.__wakeup_w.send(None)
+        return future
+
+    def map(self, items):
+        """Run the task for every item, returning the results in order (None for failed tasks)"""
+        futures = [self.submit(item) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f'[POOL  ] A task failed: {e}')
+                results.append(None)
+        return results
+
+    def __spawn(self, failures=0):
+        return _Worker(self.__ctx, self.func, self.initializer, failures)
+
+    def __replace(self, worker, kill=False):
+        worker.stop(kill=kill)
+        self.__workers[self.__workers.index(worker)] = self.__spawn()
+
+    def __finish(self, worker, error=None, result=None):
+        future, worker.future, worker.deadline = worker.future, None, None
+        if error:
+            self.stats['failed'] += 1
+            future.set_exception(error)
+        else:
+            self.stats['completed'] += 1
+            future.set_result(result)
+
+    def __assign(self):
+        for worker in self.__workers:
+            if not self.__pending:
+                return
+            if worker.ready and not worker.future:
+                future, args = self.__pending.popleft()
+                if not future.set_running_or_notify_cancel():
+                    continue
+                worker.future = future
+                worker.deadline = time.monotonic() + self.timeout if self.timeout else None
+                worker.tasks += 1
+                worker.conn.send(args)
+
+    def __fail_pending(self):
+        # No worker can take the tasks, e.g. the models of the initializer are missing
+        if self.__init_failures < MAX_INIT_FAILURES or not self.__pending or any(worker.ready for worker in self.__workers):
+            return
+        logger.error(f'[POOL  ] Workers failed to initialize {self.__init_failures} times in a row. Failing {len(self.__pending)} queued tasks.')
+        while self.__pending:
+            future, _ = self.__pending.popleft()
+            if future.set_running_or_notify_cancel():
+                self.stats['failed'] += 1
+                future.set_exception(RuntimeError('The workers failed to initialize'))
+
+    def __receive(self, worker):
+        try:
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            logger.error(f'[POOL  ] Worker {worker.process.pid} died.')
+            if worker.future:
+                self.__finish(worker, error=RuntimeError('The worker died'))
+            self.__replace(worker, kill=True)
+            return
+        if status == 'ready':
+            worker.ready = True
+            worker.failures = 0
+            self.__init_failures = 0
+        elif status == 'failed':
+            # Started again later, so that a failing initialization does not respawn in a tight loop
+            worker.failures += 1
+            self.__init_failures += 1
+            backoff = min(RETRY_MIN * 2 ** (worker.failures - 1), RETRY_MAX)
+            logger.error(f'[POOL  ] Worker {worker.process.pid} failed to initialize: {value}. Retrying in {backoff}s.')
+            worker.stop(kill=True)
+            worker.retry_at = time.monotonic() + backoff
+        else:
+            self.__finish(worker, error=RuntimeError(value) if status == 'error' else None, result=value)
+            if self.max_tasks and worker.tasks >= self.max_tasks:
+                self.stats['recycled'] += 1
+                self.__replace(worker)
+
+    def __run(self):
+        while True:
+            with self.__lock:
+                if self.__closing and not self.__pending and not any(worker.future for worker in self.__workers):
+                    break
+                self.__fail_pending()
+                self.__assign()
+            deadlines = [worker.deadline or worker.retry_at for worker in self.__workers if worker.deadline or worker.retry_at]
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+            by_conn = {worker.conn: worker for worker in self.__workers if not worker.retry_at}
+            for conn in wait(list(by_conn) + [self.__wakeup_r], timeout):
+                if conn is self.__wakeup_r:
+                    while self.__wakeup_r.poll():
+                        self.__wakeup_r.recv()
+                else:
+                    self.__receive(by_conn[conn])
+            now = time.monotonic()
+            for worker in list(self.__workers):
+                if worker.deadline and worker.deadline < now:
+                    logger.error(f'[POOL  ] Task timed out after {self.timeout}s. Replacing worker {worker.process.pid}.')
+                    self.stats['timeouts'] += 1
+                    self.__finish(worker, error=TimeoutError(f'Task timed out after {self.timeout}s'))
+                    self.__replace(worker, kill=True)
+                elif worker.retry_at and worker.retry_at <= now:
+                    self.__workers[self.__workers.index(worker)] = self.__spawn(worker.failures)
+        for worker in self.__workers:
+            if not worker.retry_at:
+                worker.stop()
+        self.__workers = []
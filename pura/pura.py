@@ -1,78 +1,778 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import emailyzer
-import juicer
-import katatasso
+import hashlib
+import io
 import os
+import threading
+import time
+from contextlib import ExitStack
+from queue import Queue
 
-from pura.modules.threat_intel import is_threat
-from pura.modules.jira_client import create_issue, add_comment_user_notified
-from pura.modules.mail_client import FetchMail
+from pura.modules.threat_intel import is_threat, is_threat_batch, start_refresher, stop_refresher, feed_status
+from pura.modules.jira_client import JIRA_BULK_SIZE, create_issue, create_issues, find_issues, find_comments, add_comment_user_notified, add_comment_reported_again, start_metadata_refresher, stop_metadata_refresher
+from pura.modules.campaigns import CampaignIndex, features
+from pura.modules.classifier import ALGO, Classifier, TierMetrics, classify_contents, classify_fast, start_classifiers, stop_classifiers, classifier_stats
+from pura.modules.mail_client import FetchMail, MailboxState
+from pura.modules.mail_pool import IMAPPool, fetch_new
+from pura.modules.message_store import MessageStore, REPORTED, QUEUED, REPEATED, FAILED
+from pura.modules.outbox import Outbox
+from pura.modules.pipeline import Pipeline, Stage
+from pura.modules.raw_email import RawEmail
+from pura.helpers.config import mail_config as CONFIG
 from pura.helpers.logger import rootLogger as logger
 from katatasso.helpers.const import categories
 
 TRAININGDATA_PATH = os.getenv('TRAININGDATA_PATH', '../trainingdata/train/spam')
-ALGO = os.getenv('algo', 'mnb')
+# Reports at least this similar (estimated Jaccard similarity) within the window are grouped into one campaign
+CAMPAIGN_THRESHOLD = float(os.getenv('CAMPAIGN_THRESHOLD', '0.6'))
+CAMPAIGN_WINDOW_HRS = float(os.getenv('CAMPAIGN_WINDOW_HRS', '24'))
 
+# Classification cascade: emails with a host confirmed by threat intel (at this confidence) are classified as
+# CASCADE_THREAT_CLASS, and the fast model decides when it is at least CASCADE_THRESHOLD sure.
+# The rest go through NER and the full model.
+CASCADE_THREAT_CLASS = os.getenv('CASCADE_THREAT_CLASS', 'Phishing')
+CASCADE_THREAT_CONFIDENCE = float(os.getenv('CASCADE_THREAT_CONFIDENCE', '1.0'))
+CASCADE_THRESHOLD = float(os.getenv('CASCADE_THRESHOLD', '0.95'))
 
-def fetch_emails(limit=10):
+# Reports are stored in this outbox, and a background worker creates their issues in Jira, retrying with backoff
+# while Jira is unavailable. Empty to create the issues synchronously.
+OUTBOX_FILE = os.path.expanduser(os.getenv('OUTBOX_FILE', '~/.pura/outbox.sqlite'))
+OUTBOX_RETRY_MIN = float(os.getenv('OUTBOX_RETRY_MIN', '5'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '600'))
+# Attempts after which a report that still fails (e.g. its issue was deleted) is given up on
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '20'))
+# Seconds to wait for the outbox to be delivered before exiting
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv('OUTBOX_DRAIN_TIMEOUT', '60'))
+
+# The handled emails, with their classification and Jira issue, so that they are not processed again. Empty to disable.
+MESSAGE_STORE_FILE = os.path.expanduser(os.getenv('MESSAGE_STORE_FILE', '~/.pura/messages.sqlite'))
+
+# The pipeline of `run_pipeline`: max. emails waiting per stage, emails per batch, and concurrent batches per stage
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '100'))
+PIPELINE_BATCH_SIZE = int(os.getenv('PIPELINE_BATCH_SIZE', '32'))
+PIPELINE_PARSE_WORKERS = int(os.getenv('PIPELINE_PARSE_WORKERS', '4'))
+PIPELINE_THREAT_INTEL_WORKERS = int(os.getenv('PIPELINE_THREAT_INTEL_WORKERS', '2'))
+PIPELINE_CLASSIFY_WORKERS = int(os.getenv('PIPELINE_CLASSIFY_WORKERS', '2'))
+PIPELINE_REPORT_WORKERS = int(os.getenv('PIPELINE_REPORT_WORKERS', '2'))
+
+__CAMPAIGNS = CampaignIndex(threshold=CAMPAIGN_THRESHOLD, window=CAMPAIGN_WINDOW_HRS * 3600)
+__CAMPAIGN_LOCK = threading.Lock()
+__TIERS = TierMetrics()
+__OUTBOX = None
+__STORE = None
+
+
+def fetch_emails(limit=10, client=None, state=None):
+    """Fetch the emails that arrived since the last run, oldest first
+
+        Only UIDs above the persisted high-water mark of the mailbox are fetched,
+        unless its UIDVALIDITY has changed, and the pending emails that are due to be
+        fetched again (see `MailboxState`). At most `limit` emails are fetched per run.
+        Sizes are fetched first, and emails larger than `MAX_EMAIL_SIZE` are skipped.
+        The rest are fetched in bulk, `IMAP_FETCH_CHUNK_SIZE` emails per command,
+        and are kept in memory as raw bytes (see `RawEmail`).
+
+        Parameters
+        ----------
+        limit : int
+            The maximum number of emails to fetch.
+        client : FetchMail
+            An open connection to reuse. A new one is opened if not set.
+        state : MailboxState
+            The state of the mailboxes (loaded from `MAILBOX_STATE_FILE` if not set). If set, the fetched
+            emails stay pending in it until they are acknowledged, and are fetched again later otherwise.
+    """
     emls = []
-    i = 0
+    pending = state
+    state = state or MailboxState()
+    mailbox, uidvalidity, uids, done = None, None, [], set()
     try:
-        client = FetchMail()
+        client = client or FetchMail()
         #client.set_mailbox('Junk')
-        res = client.search()
-        while i <= limit:
-            for _id in res:
-                eml_str = client.fetch(_id)
-                tempfile_path = client.save_tmp(_id, eml_str)
-                emls.append(emailyzer.from_eml(tempfile_path))
-                i += 1
+        mailbox = client.mailbox
+        uidvalidity, uids = client.search_new(state)
+        uids = uids[:limit]
+        for eml in fetch_new(client, uids, done):
+            if pending:
+                pending.fetched(mailbox, uidvalidity, eml.uid)
+            emls.append(eml)
+        if pending:
+            # Emails that were skipped, or expunged in the meantime, are not fetched again
+            fetched = set(eml.uid for eml in emls)
+            pending.acknowledge(mailbox, [uid for uid in uids if uid in done and uid not in fetched])
         return emls
     except Exception as e:
         logger.error(f'[PURA  ] An error occurred while fetching the email.')
         logger.error(e)
+    finally:
+        # Move the high-water mark up to the first email that still has to be retried
+        state.advance(mailbox, uidvalidity, uids, done)
+        state.save()
     return emls
 
 
-def classify(eml):
+def fetch_mailboxes(mailboxes=None, limit=10, queue=None):
+    """Fetch the new emails of several mailboxes in parallel (see `IMAPPool.fetch`)
+
+        Parameters
+        ----------
+        mailboxes : list
+            The mailboxes to fetch (`IMAP_MAILBOXES` if not set).
+        limit : int
+            The maximum number of emails to fetch per mailbox.
+        queue : queue.Queue
+            The queue to put the emails in as soon as they are received. If not set, they are returned.
+    """
     try:
-        if eml:
-            content = eml.html_as_text
-            hosts = eml.hosts
-            # Preprocess, extract entities
-            words = juicer.extract_stanford(content, named_only=False, stemming=False)
-            category = katatasso.classifyv2(words, algo=ALGO)
-
-            return {
-                'label': category,
-                'class': categories[category],
-                'recipient': 'hidden',
-                'sender': eml.sender,
-                'subject': eml.subject,
-                'timedate': eml.date,
-                'hosts': hosts,
-                'file': eml.filepath
-            }
+        with IMAPPool() as pool:
+            return pool.fetch(mailboxes, queue=queue, limit=limit)
     except Exception as e:
-        logger.error(f'[PURA  ] An error occurred while classifying the email.')
+        logger.error(f'[PURA  ] An error occurred while fetching the emails.')
         logger.error(e)
+    return [] if queue is None else 0
+
+
+def __response(eml, result, threat):
+    category = result.get('label')
+    return {
+        'label': category,
+        'class': categories[category],
+        'confidence': result.get('confidence'),
+        'tier': result.get('tier'),
+        'threat': threat,
+        'recipient': 'hidden',
+        'sender': eml.sender,
+        'subject': eml.subject,
+        'timedate': eml.date,
+        'hosts': eml.hosts,
+        'file': eml.filepath,
+        'eml': eml
+    }
+
+
+def __threat_label():
+    for label, name in categories.items():
+        if name.lower() == CASCADE_THREAT_CLASS.lower():
+            return label
     return None
 
 
-def report_event(classification, confidence, recipient, sender, subject, timedate, attachment_filepath=None):
+def __check_hosts(hosts):
+    threats, stats = is_threat_batch(hosts)
+    logger.info(f'[PURA  ] Threat intel: {stats["unique"]} unique hosts of {stats["requested"]} in {len(hosts)} emails.')
+    return threats
+
+
+def __cascade(contents, hosts, threats=None):
+    # Returns the result of every body (None where it failed), and the threat intel result of every email
+    results = [None] * len(contents)
+    pending = [i for i, content in enumerate(contents) if content is not None]
+
+    # Tier 1: hosts confirmed by threat intel (unless they have been checked already)
+    start = time.perf_counter()
+    if threats is None:
+        threats = __check_hosts(hosts)
+    label = __threat_label()
+    if label is not None:
+        for i in pending:
+            confidence = max((match['confidence'] for match in threats[i] if match.get('found')), default=0.0)
+            if confidence and confidence >= CASCADE_THREAT_CONFIDENCE:
+                results[i] = {'label': label, 'confidence': confidence, 'tier': 'threat_intel'}
+    decided = [i for i in pending if results[i]]
+    __TIERS.record('threat_intel', len(pending), len(decided), time.perf_counter() - start)
+    pending = [i for i in pending if not results[i]]
+
+    # Tier 2: the fast token-based model
+    if pending:
+        start = time.perf_counter()
+        fast = classify_fast([contents[i] for i in pending])
+        if fast is not None:
+            for i, (label, confidence) in zip(pending, fast):
+                if confidence is not None and confidence >= CASCADE_THRESHOLD:
+                    results[i] = {'label': label, 'confidence': confidence, 'tier': 'fast'}
+            decided = [i for i in pending if results[i]]
+            __TIERS.record('fast', len(pending), len(decided), time.perf_counter() - start)
+            pending = [i for i in pending if not results[i]]
+
+    # Tier 3: NER and the full model
+    if pending:
+        start = time.perf_counter()
+        for i, result in zip(pending, classify_contents([contents[i] for i in pending])):
+            if result:
+                results[i] = dict(result, tier='full')
+        __TIERS.record('full', len(pending), sum(1 for i in pending if results[i]), time.perf_counter() - start)
+    logger.debug(f'[PURA  ] Classification tiers: {__TIERS.summary()}')
+    return results, threats
+
+
+def cascade_stats():
+    """Per tier of the classification cascade: emails evaluated and decided, hit rate and latency"""
+    return __TIERS.summary()
+
+
+def __read(eml):
+    # Returns the body and the hosts of an email, or (None, []) if it cannot be read
     try:
-        create_issue(classification, confidence, recipient, sender, subject, timedate, attachment_filepath=attachment_filepath, comment='')
+        return (eml.html_as_text, eml.hosts or []) if eml else (None, [])
+    except Exception as e:
+        logger.error(f'[PURA  ] An error occurred while reading the email.')
+        logger.error(e)
+        return None, []
+
+
+def classify_many(emls, threats=None):
+    """Classify several emails with a cascade of increasingly expensive tiers
+
+        1. Threat intel: emails with a host that is confirmed at `CASCADE_THREAT_CONFIDENCE`
+           are classified as `CASCADE_THREAT_CLASS`.
+        2. The fast model (`CLASSIFIER_FAST_MODEL_FILE`, if set) on plain tokens, if it is at
+           least `CASCADE_THRESHOLD` sure.
+        3. Stanford NER and the full model, in parallel on the classifier workers if they are running.
+
+        Parameters
+        ----------
+        emls : list
+        threats : list
+            The threat intel results of the emails (see `is_threat_batch`), if they have been checked already.
+
+        Returns
+        -------
+        responses : list
+            The classification of every email, or None where it failed. The response includes
+            the deciding `tier` and the threat intel result (`threat`).
+    """
+    contents, hosts = [], []
+    for eml in emls:
+        content, eml_hosts = __read(eml)
+        contents.append(content)
+        hosts.append(eml_hosts)
+    results, threats = __cascade(contents, hosts, threats)
+
+    responses = []
+    for eml, result, threat in zip(emls, results, threats):
+        try:
+            responses.append(__response(eml, result, threat) if result is not None else None)
+        except Exception as e:
+            logger.error(f'[PURA  ] An error occurred while classifying the email.')
+            logger.error(e)
+            responses.append(None)
+    return responses
+
+
+def classify(eml):
+    return classify_many([eml])[0]
+
+
+def report_event(classification, confidence, recipient, sender, subject, timedate, attachment_filepath=None, attachment=None):
+    try:
+        return create_issue(classification, confidence, recipient, sender, subject, timedate, attachment_filepath=attachment_filepath, attachment=attachment, comment='')
     except:
         logger.critical(f'Failed to create JIRA issue for {classification} event (from={sender},subject={subject}.')
 
 
+def __confidence_level(response):
+    # Jira expects a percentage
+    return f'{response["confidence"] * 100:.1f}' if response.get('confidence') is not None else '0.0'
+
+
+def __report_args(response):
+    return {
+        'classification': response.get('class'),
+        'confidence_level': __confidence_level(response),
+        'recipient': response.get('recipient'),
+        'email_sender': response.get('sender'),
+        'email_subject': response.get('subject'),
+        'timedate': str(response.get('timedate'))
+    }
+
+
+def __report(response):
+    eml = response.get('eml')
+    args = tuple(__report_args(response).values())
+    if isinstance(eml, RawEmail):
+        # Attach the raw email from memory, spooling to disk only if it is large
+        with eml.open() as attachment:
+            return report_event(*args, attachment=attachment)
+    return report_event(*args, attachment_filepath=response.get('file'))
+
+
+def __report_many(responses):
+    # One bulk request for all issues, and the attachments are uploaded concurrently
+    with ExitStack() as stack:
+        reports = []
+        for response in responses:
+            eml = response.get('eml')
+            reports.append(dict(
+                __report_args(response),
+                attachment=stack.enter_context(eml.open()) if isinstance(eml, RawEmail) else None,
+                attachment_filepath=response.get('file')
+            ))
+        try:
+            return create_issues(reports)
+        except Exception as e:
+            logger.critical(f'Failed to create JIRA issues for {len(reports)} events.')
+            logger.error(e)
+            return [None] * len(reports)
+
+
+def __report_key(eml):
+    # The Message-ID identifies a report across fetches and restarts
+    message_id = getattr(eml, 'message_id', None)
+    if message_id:
+        return message_id
+    return hashlib.sha256(f'{eml.sender}\0{eml.subject}\0{eml.date}'.encode('utf-8')).hexdigest()
+
+
+def __deliver(records):
+    # Delivers a batch of the outbox, returning the issue key of every record (None where it failed)
+    results = [None] * len(records)
+    issues = [i for i, record in enumerate(records) if record['kind'] == 'issue']
+
+    # An earlier attempt may have created the issue before it crashed or timed out, so look for it first
+    retried = [records[i]['key'] for i in issues if records[i]['attempts']]
+    existing = find_issues(retried) if retried else {}
+    if existing is None:
+        # Unable to check: retry them later, rather than creating duplicates
+        issues = [i for i in issues if not records[i]['attempts']]
+        existing = {}
+    create = []
+    for i in issues:
+        if records[i]['key'] in existing:
+            logger.info(f'[PURA  ] Issue {existing[records[i]["key"]]} of report `{records[i]["key"]}` was already created.')
+            results[i] = existing[records[i]['key']]
+        else:
+            create.append(i)
+    if create:
+        reports = [dict(
+            records[i]['payload'],
+            attachment=io.BytesIO(records[i]['attachment']) if records[i]['attachment'] else None,
+            idempotency_key=records[i]['key']
+        ) for i in create]
+        for i, issue_key in zip(create, create_issues(reports)):
+            results[i] = issue_key
+
+    store = __store()
+    if store:
+        for i in issues:
+            if results[i]:
+                store.set_issue_key(records[i]['key'], results[i])
+
+    comments = {i: records[i]['payload'].get('issue_key') or records[i]['parent'] for i, record in enumerate(records) if record['kind'] == 'comment'}
+    # Likewise for comments: look for those of earlier attempts on their issue
+    retried = {}
+    for i, issue_key in comments.items():
+        if records[i]['attempts']:
+            retried.setdefault(issue_key, []).append(i)
+    for issue_key, retried_comments in retried.items():
+        existing = find_comments(issue_key, [records[i]['key'] for i in retried_comments])
+        for i in retried_comments:
+            if existing is None:
+                # Unable to check: retry them later, rather than adding duplicates
+                del comments[i]
+            elif records[i]['key'] in existing:
+                logger.info(f'[PURA  ] Comment of report `{records[i]["key"]}` was already added to issue {issue_key}.')
+                results[i] = issue_key
+                del comments[i]
+    for i, issue_key in comments.items():
+        payload = records[i]['payload']
+        if add_comment_reported_again(issue_key, payload['email_sender'], payload['email_subject'], payload['timedate'], reports=payload.get('reports'), idempotency_key=records[i]['key']):
+            results[i] = issue_key
+    return results
+
+
+def __given_up(keys):
+    # Reports of the outbox that were given up on
+    store = __store()
+    if store:
+        store.set_status(keys, FAILED)
+
+
+def __outbox():
+    global __OUTBOX
+    if __OUTBOX is None and OUTBOX_FILE:
+        __OUTBOX = Outbox(OUTBOX_FILE, __deliver, batch_size=JIRA_BULK_SIZE, retry_min=OUTBOX_RETRY_MIN, retry_max=OUTBOX_RETRY_MAX,
+                          max_attempts=OUTBOX_MAX_ATTEMPTS, on_failed=__given_up)
+        __OUTBOX.start()
+    return __OUTBOX
+
+
+def stop_outbox(timeout=None):
+    """Deliver the reports that are due (waiting at most `OUTBOX_DRAIN_TIMEOUT` seconds), and stop the outbox worker
+
+        Reports that could not be delivered stay in the outbox, and are delivered after the next start.
+    """
+    global __OUTBOX
+    if __OUTBOX:
+        __OUTBOX.close(OUTBOX_DRAIN_TIMEOUT if timeout is None else timeout)
+        __OUTBOX = None
+
+
+def outbox_stats():
+    """Counters of the outbox (None if it is not running): queued, delivered, pending, retrying and given up reports"""
+    return __OUTBOX.counters() if __OUTBOX else None
+
+
+def __acknowledge(state):
+    # The fetched emails that have been handled are not fetched again. The rest (they failed, or were still being
+    # processed when the run stopped) stay pending in the mailbox state. Without a message store, every email is handled.
+    store = __store()
+    for mailbox, uids in state.pending().items():
+        if uids:
+            state.acknowledge(mailbox, store.handled_uids(mailbox, uids) if store else uids)
+    state.save()
+
+
+def __store():
+    global __STORE
+    if __STORE is None and MESSAGE_STORE_FILE:
+        __STORE = MessageStore(MESSAGE_STORE_FILE)
+    return __STORE
+
+
+def message_stats(since=None):
+    """Metrics of the handled emails (since the UNIX timestamp `since`, if set), or None without a message store
+
+        See `MessageStore.summary`: emails per status, class, cascade tier and mailbox, reported
+        emails, emails with a known threat, and the mean confidence.
+    """
+    store = __store()
+    return store.summary(since) if store else None
+
+
+def __unhandled(emls):
+    # Drops the emails that have been handled before, which only needs their headers
+    store = __store()
+    if not store or not emls:
+        return emls
+    keys = [__report_key(eml) for eml in emls]
+    handled = store.handled(keys)
+    if handled:
+        logger.info(f'[PURA  ] Skipping {sum(1 for key in keys if key in handled)} emails that have been handled before.')
+    return [eml for eml, key in zip(emls, keys) if key not in handled]
+
+
+def __message(eml, status, response=None, campaign=None, issue_key=None):
+    # The record of an email in the message store, or None if it cannot be read
+    try:
+        message = {
+            'key': __report_key(eml),
+            'mailbox': getattr(eml, 'mailbox', None),
+            'uid': getattr(eml, 'uid', None),
+            'sender': eml.sender,
+            'subject': eml.subject,
+            'campaign': campaign.id if campaign else None,
+            'issue_key': issue_key,
+            'status': status
+        }
+    except Exception as e:
+        logger.error(f'[PURA  ] An error occurred while reading the email.')
+        logger.error(e)
+        return None
+    if response:
+        message.update({column: response.get(column) for column in ('label', 'class', 'confidence', 'tier', 'threat')})
+    return message
+
+
+def __record(messages):
+    store = __store()
+    messages = [message for message in messages if message]
+    if store and messages:
+        store.record(messages)
+
+
+def __enqueue(outbox, response):
+    # Returns the outbox key of the report
+    eml = response.get('eml')
+    key = __report_key(eml)
+    payload = dict(__report_args(response), attachment_filepath=response.get('file'))
+    outbox.put(key, payload, attachment=eml.raw if isinstance(eml, RawEmail) else None)
+    return key
+
+
 def handle_event(eml):
+    """Classify an email and report it
+
+        With an outbox (`OUTBOX_FILE`), this returns as soon as the report is stored on
+        disk, and its issue is created in the background.
+    """
+    if not __unhandled([eml]):
+        return
     response = classify(eml)
     if response:
-        print(f'{response.get("class")} ({response.get("label")})')
+        print(f'{response.get("class")} ({response.get("label")}, confidence: {response.get("confidence")})')
         if response.get('hosts'):
-            threat = is_threat(response.get('hosts'))
-            print(threat)
+            print(response.get('threat'))
+
+        outbox = __outbox()
+        if outbox:
+            __enqueue(outbox, response)
+            __record([__message(eml, QUEUED, response)])
+        else:
+            issue_key = __report(response)
+            __record([__message(eml, REPORTED if issue_key else FAILED, response, issue_key=issue_key)])
+    else:
+        __record([__message(eml, FAILED)])
+
+
+def __campaign(eml):
+    try:
+        feats = features(eml.sender, eml.subject, eml.html_as_text, eml.hosts)
+    except Exception as e:
+        logger.error(f'[PURA  ] An error occurred while reading the email.')
+        logger.error(e)
+        return None, True
+    # Only a summary of the report is kept, since campaigns live for the whole window
+    return __CAMPAIGNS.add({'sender': eml.sender, 'subject': eml.subject, 'timedate': eml.date}, feats)
+
+
+def __discard(campaigns):
+    # Later reports that wait in the outbox for the issue of the campaign are dropped, and are fetched again later
+    outbox, store = __outbox(), __store()
+    with __CAMPAIGN_LOCK:
+        for campaign in campaigns:
+            if not campaign:
+                continue
+            __CAMPAIGNS.discard(campaign)
+            if outbox and campaign.report_key:
+                keys = outbox.discard_children(campaign.report_key)
+                if store and keys:
+                    store.set_status(keys, FAILED)
+            campaign.report_key = None
+
+
+def __classify_events(emls, threats=None):
+    # Groups the emails into campaigns, and classifies the first report of every new campaign.
+    # Returns the (campaign, response) of the classified first reports, and the (campaign, eml) of the other reports.
+    threats = threats if threats is not None else [None] * len(emls)
+    new, repeated = [], []
+    with __CAMPAIGN_LOCK:
+        for eml, threat in zip(emls, threats):
+            campaign, is_new = __campaign(eml)
+            if is_new:
+                if campaign:
+                    # Later reports, also in other batches, can refer to the issue of the campaign before it has been created
+                    campaign.report_key = __report_key(eml)
+                new.append((campaign, eml, threat))
+            else:
+                repeated.append((campaign, eml))
+    logger.info(f'[PURA  ] {len(emls)} emails: {len(new)} new campaigns, {len(repeated)} reports of known campaigns.')
+
+    known = [threat for _, _, threat in new]
+    responses = classify_many([eml for _, eml, _ in new], threats=known if None not in known else None)
+    reported = [(campaign, response) for (campaign, _, _), response in zip(new, responses) if response]
+    failed = [(campaign, eml) for (campaign, eml, _), response in zip(new, responses) if not response]
+    # The next report of a campaign whose first report failed starts the campaign again
+    __discard([campaign for campaign, _ in failed])
+    # Failed emails are not handled, so they are fetched again later (see `__acknowledge`)
+    __record([__message(eml, FAILED, campaign=campaign) for campaign, eml in failed])
+    for campaign, response in reported:
+        print(f'{response.get("class")} ({response.get("label")}, confidence: {response.get("confidence")})')
+        if response.get('hosts'):
+            print(response.get('threat'))
+        if campaign:
+            # Without the email itself, since campaigns are kept for the whole window
+            campaign.response = {key: value for key, value in response.items() if key != 'eml'}
+    return reported, repeated
+
+
+def __queue_comment(outbox, campaign, eml):
+    # Returns the record of the report in the message store
+    if not campaign.issue_key and campaign.report_key:
+        campaign.issue_key = outbox.result(campaign.report_key)
+    if not campaign.issue_key and not campaign.report_key:
+        logger.warning(f'[PURA  ] Campaign {campaign.id} has no issue. Skipping report `{eml.subject}`.')
+        return __message(eml, FAILED, campaign=campaign)
+    # The comment waits in the outbox until the issue of the campaign has been created
+    payload = {'issue_key': campaign.issue_key, 'email_sender': eml.sender, 'email_subject': eml.subject, 'timedate': str(eml.date), 'reports': len(campaign)}
+    outbox.put(__report_key(eml), payload, kind='comment', parent=None if campaign.issue_key else campaign.report_key)
+    return __message(eml, REPEATED, campaign.response, campaign, campaign.issue_key)
+
+
+def __add_comment(campaign, eml):
+    # Returns the record of the report in the message store
+    if not campaign.issue_key:
+        # Not handled, so that it is fetched again later
+        logger.warning(f'[PURA  ] Campaign {campaign.id} has no issue (yet). Skipping report `{eml.subject}`.')
+        return __message(eml, FAILED, campaign=campaign)
+    if not add_comment_reported_again(campaign.issue_key, eml.sender, eml.subject, eml.date, reports=len(campaign)):
+        return __message(eml, FAILED, campaign=campaign, issue_key=campaign.issue_key)
+    return __message(eml, REPEATED, campaign.response, campaign, campaign.issue_key)
+
+
+def __report_events(reported, repeated):
+    outbox = __outbox()
+    if outbox:
+        for campaign, response in reported:
+            __enqueue(outbox, response)
+        messages = [__message(response.get('eml'), QUEUED, response, campaign) for campaign, response in reported]
+        # Under the lock, since a campaign whose first report fails drops the comments that wait for its issue (see `__discard`)
+        with __CAMPAIGN_LOCK:
+            __record(messages + [__queue_comment(outbox, campaign, eml) for campaign, eml in repeated])
+        return
+
+    issue_keys = __report_many([response for _, response in reported]) if reported else []
+    messages = []
+    for (campaign, response), issue_key in zip(reported, issue_keys):
+        if campaign:
+            campaign.issue_key = issue_key
+        if not issue_key:
+            __discard([campaign])
+        messages.append(__message(response.get('eml'), REPORTED if issue_key else FAILED, response, campaign, issue_key))
+    __record(messages + [__add_comment(campaign, eml) for campaign, eml in repeated])
+
+
+def handle_events(emls):
+    """Handle several emails, grouped into campaigns of near-duplicate reports
+
+        The first report of a campaign is classified (see `classify_many`) and gets a Jira issue: the issues of a batch
+        are created with a single bulk request (see `create_issues`). Later reports of the campaign, in this
+        batch or a later one, are added to its issue as comments.
+        With an outbox (`OUTBOX_FILE`), the issues and comments are stored on disk, and created in the background.
+        Emails that are in the message store (`MESSAGE_STORE_FILE`) have been handled before, and are skipped.
+    """
+    emls = __unhandled(emls)
+    if emls:
+        __report_events(*__classify_events(emls))
+
+
+def __parse_stage(emls):
+    # Emails that have been handled before are dropped after reading only their headers
+    emls = __unhandled(emls)
+    for eml in emls:
+        # Parse now, so that the other stages find the parsed email
+        if isinstance(eml, RawEmail):
+            eml.parse()
+    return emls
+
+
+def __threat_intel_stage(emls):
+    return list(zip(emls, __check_hosts([__read(eml)[1] for eml in emls])))
+
+
+def __classify_stage(items):
+    # The batch stays together, so that the issues of its campaigns are created before their later reports
+    reported, repeated = __classify_events([eml for eml, _ in items], [threat for _, threat in items])
+    return [(reported, repeated)]
+
+
+def __report_stage(batches):
+    for reported, repeated in batches:
+        __report_events(reported, repeated)
+    return [response.get('eml') for reported, _ in batches for _, response in reported] + [eml for _, repeated in batches for _, eml in repeated]
+
+
+def __batch_size(batch):
+    # The emails in a batch of `__classify_stage`
+    reported, repeated = batch
+    return len(reported) + len(repeated)
+
+
+def run_pipeline(mailboxes=None, limit=None, stop=None):
+    """Fetch, parse, check, classify and report the new emails of several mailboxes in a pipeline
+
+        The stages run concurrently, connected by queues of at most `PIPELINE_QUEUE_SIZE` emails, so that
+        the waits on IMAP, the threat intel feeds and Jira overlap, while the memory use stays bounded:
+            fetch -> parse -> threat intel -> classify -> report
+        Threat intel runs before classification, since it is the first tier of the classification
+        cascade (see `classify_many`). The number of workers and the batch size of every stage are set with
+        `PIPELINE_<STAGE>_WORKERS` and `PIPELINE_BATCH_SIZE`.
+
+        Parameters
+        ----------
+        mailboxes : list
+            The mailboxes to fetch (`IMAP_MAILBOXES` if not set).
+        limit : int
+            The maximum number of emails to fetch per mailbox.
+        stop : threading.Event
+            Set to stop fetching. The emails that have been fetched already are still processed,
+            and the rest are fetched on the next run.
+
+        Returns
+        -------
+        stats : dict
+            Per stage: the emails in and out, failures, batches, and seconds of work (see `Pipeline.run`).
+    """
+    stop = stop or threading.Event()
+    fetched = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # Emails stay pending until they have been handled, so those that fail are fetched again later
+    state = MailboxState()
+
+    def fetch():
+        try:
+            with IMAPPool() as pool:
+                pool.fetch(mailboxes, queue=fetched, limit=limit, state=state, stop=stop)
+        except Exception as e:
+            logger.error(f'[PURA  ] An error occurred while fetching the emails.')
+            logger.error(e)
+        finally:
+            fetched.put(None)
+
+    def source():
+        thread = threading.Thread(target=fetch, name='pipeline-fetch', daemon=True)
+        thread.start()
+        # Read until the end, also when stopping, so that the fetch does not block on a full queue
+        yield from iter(fetched.get, None)
+        thread.join()
+
+    pipeline = Pipeline([
+        Stage('parse', __parse_stage, workers=PIPELINE_PARSE_WORKERS),
+        Stage('threat_intel', __threat_intel_stage, workers=PIPELINE_THREAT_INTEL_WORKERS, batch_size=PIPELINE_BATCH_SIZE),
+        Stage('classify', __classify_stage, workers=PIPELINE_CLASSIFY_WORKERS, batch_size=PIPELINE_BATCH_SIZE),
+        Stage('report', __report_stage, workers=PIPELINE_REPORT_WORKERS, size=__batch_size)
+    ], queue_size=PIPELINE_QUEUE_SIZE)
+    start = time.perf_counter()
+    stats = pipeline.process(source())
+    __acknowledge(state)
+    logger.info(f'[PURA  ] Processed {stats["parse"]["in"]} emails in {time.perf_counter() - start:.2f}s: {stats}')
+    return stats
+
+
+def run_daemon(limit=50, stop=None):
+    """Process reports as they arrive, until `stop` is set
+
+        Keeps one IMAP connection open: new emails are fetched and handled, and then the
+        connection waits in IMAP IDLE until the server reports new emails. The threat intel
+        feeds and the Jira metadata are refreshed in the background, emails are classified on
+        a pool of warm worker processes, and reports are delivered to Jira from the outbox in the background.
+        If the connection drops, it is reopened with exponential backoff.
 
-        report_event(response.get('class'), '0.0', response.get('recipient'), response.get('sender'), response.get('subject'), response.get('timedate'), attachment_filepath=response.get('file'))
\ No newline at end of file
+        Parameters
+        ----------
+        limit : int
+            The maximum number of emails to handle per batch.
+        stop : threading.Event
+            Set to stop the daemon.
+    """
+    stop = stop or threading.Event()
+    start_refresher(wait=60)
+    start_classifiers()
+    start_metadata_refresher()
+    __outbox()
+    state = MailboxState()
+    backoff = CONFIG.get('reconnect_min')
+    while not stop.is_set():
+        client = None
+        try:
+            client = FetchMail()
+            logger.info(f'[PURA  ] Connected to the mailbox {client.mailbox}.')
+            backoff = CONFIG.get('reconnect_min')
+            while not stop.is_set():
+                emls = fetch_emails(limit=limit, client=client, state=state)
+                if emls:
+                    handle_events(emls)
+                    __acknowledge(state)
+                # A full batch means there may be more emails waiting
+                if len(emls) < limit:
+                    client.idle(stop=stop)
+        except Exception as e:
+            logger.error(f'[PURA  ] Lost the connection to the mail server. Reconnecting in {backoff}s.')
+            logger.error(e)
+            stop.wait(backoff)
+            backoff = min(backoff * 2, CONFIG.get('reconnect_max'))
+        finally:
+            if client:
+                client.logout()
+    stop_classifiers()
+    stop_refresher()
+    stop_outbox()
+    stop_metadata_refresher()
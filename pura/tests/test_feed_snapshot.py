@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+from pura.modules.feed_index import FeedIndex
+from pura.modules.feed_snapshot import SnapshotIndex, write_snapshot
+
+FEED = [
+    '# Synthetic feed',
+    '1.2.3.4\t3',
+    '5.5.5.5',
+    '6.6.6.6/panel/gate.php',
+    '7.7.7.7:8080',
+    '10.0.0.0/24',
+    'evil.com',
+    'phish.example.org/login',
+    'http://bad.example.net/verify.php'
+]
+
+HOSTS = [
+    '1.2.3.4',
+    'http://1.2.3.4/login',
+    'http://5.5.5.5',
+    '5.5.5.6',
+    '6.6.6.6/panel/gate.php',
+    'http://6.6.6.6/panel/gate.php',
+    'http://6.6.6.6/other',
+    '7.7.7.7:8080',
+    '10.0.0.42',
+    'evil.com',
+    'http://evil.com/anything',
+    'sub.evil.com',
+    'http://phish.example.org/login/step2',
+    'http://bad.example.net/verify.php',
+    'example.org',
+    'benign.org'
+]
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'feed.snap')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def snapshot(self, index):
+        write_snapshot(index, self.path)
+        snapshot = SnapshotIndex(self.path)
+        self.addCleanup(snapshot.close)
+        return snapshot
+
+    def test_ip_with_path(self):
+        index = FeedIndex(['1.2.3.4/panel/gate.php', 'evil.com'])
+        snapshot = self.snapshot(index)
+        self.assertEqual(len(snapshot), 2)
+        self.assertEqual(snapshot.lookup('1.2.3.4/panel/gate.php'), (True, 1.0))
+        self.assertEqual(snapshot.lookup('evil.com'), (True, 1.0))
+
+    def test_same_results_as_feed_index(self):
+        index = FeedIndex(FEED)
+        snapshot = self.snapshot(index)
+        for host in HOSTS:
+            with self.subTest(host=host):
+                self.assertEqual(snapshot.lookup(host), index.lookup(host))
+
+    def test_exact_ip_in_url(self):
+        snapshot = self.snapshot(FeedIndex(['1.2.3.4', '5.5.5.5', 'evil.com']))
+        self.assertEqual(snapshot.lookup('http://1.2.3.4/login'), (True, 1.0))
+        self.assertEqual(snapshot.lookup('http://5.5.5.5'), (True, 1.0))
+
+    def test_url_is_not_a_parent_domain(self):
+        snapshot = self.snapshot(FeedIndex(['http://sites.google.com/view/phish/login', 'evil.com']))
+        for host in ('http://www.sites.google.com/x', 'www.sites.google.com', 'http://docs.google.com/document/d/1'):
+            with self.subTest(host=host):
+                self.assertEqual(snapshot.lookup(host), (False, 0.0))
+        self.assertEqual(snapshot.lookup('http://sites.google.com/view/'), (True, 0.8))
+        # Host-only entries still are
+        self.assertEqual(snapshot.lookup('http://sub.evil.com/login'), (True, 0.6))
+
+
+if __name__ == '__main__':
+    unittest.main()
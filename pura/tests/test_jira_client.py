@@ -0,0 +1,70 @@
+import unittest
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock
+
+from pura.bench.standins import JiraServer
+from pura.modules import jira_client
+
+
+def issue(account_id):
+    return SimpleNamespace(fields=SimpleNamespace(assignee=SimpleNamespace(accountId=account_id)))
+
+
+class OpenIssuesTest(unittest.TestCase):
+    def setUp(self):
+        self.assigned = Counter()
+        for patcher in (mock.patch.object(jira_client, '__ASSIGNED', self.assigned),
+                        mock.patch.object(jira_client, 'JIRA_ASSIGNMENT', 'least_open'),
+                        mock.patch.object(jira_client.METADATA, 'get', self.metadata)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.open_issues = Counter({'alice': 2, 'bob': 2})
+
+    def metadata(self, key):
+        return ['alice', 'bob'] if key == 'assignable_users' else self.open_issues
+
+    def load(self, search_issues):
+        with mock.patch.object(jira_client, 'client', lambda: SimpleNamespace(search_issues=search_issues)):
+            return getattr(jira_client, '__load_open_issues')()
+
+    def test_assigned_during_count(self):
+        select_assignee = getattr(jira_client, '__select_assignee')
+        self.assertEqual(select_assignee(), 'alice')
+
+        def search_issues(jql, **kwargs):
+            # Assigned while the open issues are being counted, after the search has found them
+            self.assertEqual(select_assignee(), 'bob')
+            return [issue('alice'), issue('alice'), issue('alice'), issue('bob'), issue('bob')]
+
+        self.assertEqual(self.load(search_issues), Counter({'alice': 3, 'bob': 2}))
+        # The issue assigned before the count is in it, the one assigned during the count is kept
+        self.assertEqual(self.assigned, Counter({'bob': 1}))
+
+
+class CommentsTest(unittest.TestCase):
+    def setUp(self):
+        self.jira = JiraServer()
+        self.jira.__enter__()
+        self.addCleanup(self.jira.__exit__, None, None, None)
+        for name, value in (('JIRA_SERVER', self.jira.url), ('JIRA_USER', 'test'), ('JIRA_TOKEN', 'test'), ('JIRA_ASSIGNEES', self.jira.users), ('__JC', None)):
+            patcher = mock.patch.object(jira_client, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        report = {'classification': 'Phishing', 'confidence_level': '90.0', 'recipient': 'hidden', 'email_sender': 'e.vil@example.org',
+                  'email_subject': 'Verify your account', 'timedate': '2020-04-15 13:37:00'}
+        self.issue_key, = jira_client.create_issues([report])
+
+    def test_find_comments(self):
+        self.assertEqual(jira_client.find_comments(self.issue_key, ['<1@example.org>']), {})
+        self.assertTrue(jira_client.add_comment_reported_again(self.issue_key, 'e.vil@example.org', 'Verify your account', '2020-04-15 13:38:00',
+                                                               reports=2, idempotency_key='<1@example.org>'))
+        jira_client.add_comment_reported_again(self.issue_key, 'e.vil@example.org', 'Verify your account', '2020-04-15 13:39:00', reports=3)
+        self.assertEqual(jira_client.find_comments(self.issue_key, ['<1@example.org>', '<2@example.org>']), {'<1@example.org>': '1'})
+
+    def test_unknown_issue(self):
+        self.assertIsNone(jira_client.find_comments('PURA-999', ['<1@example.org>']))
+
+
+if __name__ == '__main__':
+    unittest.main()
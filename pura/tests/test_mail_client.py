@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from pura.bench.standins import IMAPServer
+from pura.bench.synthetic import generate_eml
+from pura.helpers.config import mail_config
+from pura.modules.mail_client import FetchMail
+
+
+class IdleTest(unittest.TestCase):
+    def setUp(self):
+        self.server = IMAPServer({'inbox': [generate_eml(0)]})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        for config, values in ((mail_config['imap'], {'server': '127.0.0.1', 'port': self.server.port, 'ssl': False}),
+                               (mail_config['auth'], {'user': 'test', 'pass': 'test'})):
+            patcher = mock.patch.dict(config, values)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = FetchMail()
+        self.addCleanup(self.client.logout)
+
+    def idle(self, timeout=5):
+        start = time.perf_counter()
+        new = self.client.idle(timeout=timeout)
+        return new, time.perf_counter() - start
+
+    def test_exists_with_continuation(self):
+        # The server reports the email that arrived before the IDLE in the same write as the continuation
+        self.server.append('inbox', generate_eml(1))
+        new, seconds = self.idle()
+        self.assertTrue(new)
+        self.assertLess(seconds, 2)
+
+    def test_exists_before_continuation(self):
+        self.server.exists_before_idle = True
+        self.server.append('inbox', generate_eml(1))
+        new, seconds = self.idle()
+        self.assertTrue(new)
+        self.assertLess(seconds, 2)
+        self.assertEqual(self.client.search_uids(), [1, 2])
+
+    def test_exists_during_idle(self):
+        timer = threading.Timer(0.2, self.server.append, ('inbox', generate_eml(1)))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        new, seconds = self.idle()
+        self.assertTrue(new)
+        self.assertLess(seconds, 2)
+
+    def test_timeout(self):
+        new, _ = self.idle(timeout=1)
+        self.assertFalse(new)
+        # The connection is still usable after IDLE
+        self.assertEqual(self.client.search_uids(), [1])
+
+
+class BulkFetchTest(unittest.TestCase):
+    def client(self, data):
+        # A FetchMail whose connection answers every UID FETCH with `data`, as parsed by imaplib
+        client = FetchMail.__new__(FetchMail)
+        client.client = SimpleNamespace(uid=lambda *args: ('OK', data))
+        return client
+
+    def test_uid_before_literal(self):
+        client = self.client([(b'1 (UID 41 RFC822 {3}', b'one'), b')', (b'2 (UID 42 RFC822 {3}', b'two'), b')'])
+        self.assertEqual(list(client.fetch_many([41, 42])), [(41, b'one'), (42, b'two')])
+
+    def test_uid_after_literal(self):
+        client = self.client([(b'1 (RFC822 {3}', b'one'), b' UID 41)', (b'2 (RFC822 {3}', b'two'), b' UID 42)'])
+        self.assertEqual(list(client.fetch_many([41, 42])), [(41, b'one'), (42, b'two')])
+
+    def test_size_after_literal(self):
+        client = self.client([(b'1 (UID 41 BODY[HEADER] {3}', b'one'), b' RFC822.SIZE 100)'])
+        self.assertEqual(client.fetch_sizes([41]), {41: (100, b'one')})
+
+    def test_message_without_uid(self):
+        # Dropped, instead of taking the UID of the message before it
+        client = self.client([(b'1 (UID 41 RFC822 {3}', b'one'), b')', (b'2 (RFC822 {3}', b'two'), b')'])
+        self.assertEqual(list(client.fetch_many([41, 42])), [(41, b'one')])
+
+
+if __name__ == '__main__':
+    unittest.main()
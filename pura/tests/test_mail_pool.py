@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pura.bench.standins import IMAPServer
+from pura.bench.synthetic import generate_eml
+from pura.helpers.config import mail_config
+from pura.modules.mail_client import FetchMail, MailboxState
+from pura.modules.mail_pool import IMAPPool
+
+
+class PendingEmailsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'mailbox_state.json')
+        self.server = IMAPServer({'inbox': [generate_eml(i) for i in range(3)]})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        for config, values in ((mail_config['imap'], {'server': '127.0.0.1', 'port': self.server.port, 'ssl': False}),
+                               (mail_config['auth'], {'user': 'test', 'pass': 'test'})):
+            patcher = mock.patch.dict(config, values)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch(self, **kwargs):
+        # Like a new run: the state is loaded from disk, and saved after fetching
+        state = MailboxState(self.path, **kwargs)
+        with IMAPPool(max_connections=1) as pool:
+            emls = pool.fetch(['inbox'], state=state)
+        return state, sorted(eml.uid for eml in emls)
+
+    def test_failed_email_is_fetched_again(self):
+        state, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [1, 2, 3])
+        self.assertEqual(state.pending('inbox'), [1, 2, 3])
+        # The second email failed
+        state.acknowledge('inbox', [1, 3])
+        state.save()
+
+        state, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [2])
+        state.acknowledge('inbox', uids)
+        state.save()
+
+        state, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [])
+        self.assertEqual(state.pending('inbox'), [])
+
+    def test_unacknowledged_emails_are_fetched_again(self):
+        # E.g. the run stopped before the emails were handled
+        self.fetch(retry_delay=0)
+        _, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [1, 2, 3])
+
+    def test_retry_delay(self):
+        self.fetch(retry_delay=3600)
+        state, uids = self.fetch(retry_delay=3600)
+        self.assertEqual(uids, [])
+        self.assertEqual(state.pending('inbox'), [1, 2, 3])
+
+    def test_max_attempts(self):
+        self.fetch(retry_delay=0, max_attempts=2)
+        _, uids = self.fetch(retry_delay=0, max_attempts=2)
+        self.assertEqual(uids, [1, 2, 3])
+        state, uids = self.fetch(retry_delay=0, max_attempts=2)
+        self.assertEqual(uids, [])
+        self.assertEqual(state.pending('inbox'), [])
+
+    def test_uidvalidity_not_readable(self):
+        state, _ = self.fetch(retry_delay=0)
+        state.acknowledge('inbox', [1, 2, 3])
+        state.save()
+        # E.g. STATUS failed: the mailbox is skipped for this run, instead of being resynced
+        with mock.patch.object(FetchMail, 'uidvalidity', lambda client: None):
+            state, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [])
+        self.assertEqual(state.get('inbox'), (1, 3))
+
+        self.server.append('inbox', generate_eml(3))
+        _, uids = self.fetch(retry_delay=0)
+        self.assertEqual(uids, [4])
+
+    def test_fetch_without_state(self):
+        # Without a state of the caller, emails are done with once they have been fetched
+        with mock.patch.dict(mail_config, {'state_file': self.path}), IMAPPool(max_connections=1) as pool:
+            self.assertEqual(len(pool.fetch(['inbox'])), 3)
+            self.assertEqual(pool.fetch(['inbox']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
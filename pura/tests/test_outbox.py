@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from pura.modules.outbox import Outbox
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'outbox.sqlite')
+        self.attempts = []
+        self.given_up = []
+        self.done = threading.Event()
+
+    def deliver(self, records):
+        # E.g. the issue was deleted: the records are rejected every time
+        self.attempts.extend(record['key'] for record in records)
+        return [None] * len(records)
+
+    def on_failed(self, keys):
+        self.given_up.extend(keys)
+        self.done.set()
+
+    def test_max_attempts(self):
+        outbox = Outbox(self.path, self.deliver, retry_min=0, max_attempts=3, on_failed=self.on_failed)
+        outbox.put('report', {'subject': 'Verify your account'})
+        outbox.put('comment', {'subject': 'Verify your account'}, kind='comment', parent='report')
+        with outbox:
+            self.assertTrue(self.done.wait(5))
+            counters = outbox.counters()
+        self.assertEqual(self.attempts, ['report'] * 3)
+        self.assertEqual(self.given_up, ['report', 'comment'])
+        self.assertEqual((counters['pending'], counters['stored_failed'], counters['given_up']), (0, 2, 2))
+
+        # Not retried after a restart, and not queued again
+        outbox = Outbox(self.path, self.deliver, retry_min=0, max_attempts=3)
+        self.assertFalse(outbox.put('report', {'subject': 'Verify your account'}))
+        with outbox:
+            pass
+        self.assertEqual(self.attempts, ['report'] * 3)
+
+    def test_outbox_without_failed_column(self):
+        # Outboxes created before records could be given up on
+        db = sqlite3.connect(self.path)
+        db.execute('''CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, parent TEXT,
+                      payload TEXT NOT NULL, attachment BLOB, attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, result TEXT,
+                      error TEXT, created REAL NOT NULL, delivered REAL)''')
+        db.execute("INSERT INTO outbox (key, kind, payload, attempts, next_attempt, created) VALUES ('report', 'issue', '{}', 2, 0, 0)")
+        db.commit()
+        db.close()
+        outbox = Outbox(self.path, self.deliver, retry_min=0, max_attempts=3, on_failed=self.on_failed)
+        with outbox:
+            self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.attempts, ['report'])
+        self.assertEqual(self.given_up, ['report'])
+
+
+if __name__ == '__main__':
+    unittest.main()
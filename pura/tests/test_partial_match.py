@@ -0,0 +1,54 @@
+import unittest
+
+from pura.bench import partial_match
+from pura.bench.synthetic import generate_feed
+from pura.modules.feed_index import FeedIndex
+
+FEED = [
+    'http://google.com/url?q=http://evil.com',
+    'http://sites.google.com/view/phish/login',
+    'evil.com',
+    'phish.example.org/login'
+]
+
+HOSTS = [
+    'http://mail.google.com/mail/u/0',
+    'http://docs.google.com/document/d/1',
+    'drive.google.com',
+    'http://www.sites.google.com/x',
+    'http://google.com/url',
+    'http://sites.google.com/view/',
+    'http://phish.example.org/login/step2',
+    'http://example.org/login',
+    'benign.org'
+]
+
+
+class PartialMatchTest(unittest.TestCase):
+    def assertSameAsLegacy(self, feed, hosts):
+        index = FeedIndex(feed)
+        entries = [line.split()[0] for line in feed if not line.startswith('#')]
+        legacy_partial = getattr(partial_match, '__legacy_partial')
+        for host in hosts:
+            with self.subTest(host=host):
+                self.assertEqual(index.lookup(host), legacy_partial(host, entries))
+
+    def test_url_is_not_a_parent_domain(self):
+        # The subdomains of the host of a listed URL are not in the feed
+        index = FeedIndex(FEED)
+        for host in ('http://mail.google.com/mail/u/0', 'drive.google.com', 'http://www.sites.google.com/x'):
+            with self.subTest(host=host):
+                self.assertEqual(index.lookup(host), (False, 0.0))
+        self.assertEqual(index.lookup('http://google.com/url'), (True, 0.8))
+
+    def test_same_results_as_legacy(self):
+        self.assertSameAsLegacy(FEED, HOSTS)
+
+    def test_same_results_as_legacy_synthetic(self):
+        feed = generate_feed(1000)
+        entries = [line.split()[0] for line in feed if not line.startswith('#')]
+        self.assertSameAsLegacy(feed, getattr(partial_match, '__sample_hosts')(entries, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
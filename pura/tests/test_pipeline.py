@@ -0,0 +1,57 @@
+import unittest
+
+from pura.modules.pipeline import Pipeline, Stage, percentile
+
+
+def double(items):
+    return [item * 2 for item in items]
+
+
+def group(items):
+    # One item per batch, like the classify stage of `run_pipeline`
+    return [list(items)]
+
+
+def flatten(groups):
+    return [item for items in groups for item in items]
+
+
+class PipelineTest(unittest.TestCase):
+    def test_items(self):
+        results = []
+        pipeline = Pipeline([
+            Stage('double', double, workers=2, batch_size=4),
+            Stage('collect', lambda items: results.extend(items) or items)
+        ], queue_size=3)
+        stats = pipeline.process(range(10))
+        self.assertEqual(sorted(results), [i * 2 for i in range(10)])
+        self.assertEqual((stats['double']['in'], stats['double']['out']), (10, 10))
+        self.assertEqual((stats['collect']['in'], stats['collect']['out']), (10, 10))
+
+    def test_size(self):
+        # A batch that is passed on as one item still counts its items
+        pipeline = Pipeline([
+            Stage('group', group, batch_size=4),
+            Stage('flatten', flatten, size=len)
+        ])
+        stats = pipeline.process(range(10))
+        self.assertEqual((stats['group']['in'], stats['group']['out']), (10, 10))
+        self.assertEqual((stats['flatten']['in'], stats['flatten']['out']), (10, 10))
+        self.assertEqual(stats['flatten']['batches'], stats['group']['batches'])
+
+    def test_failed_batch(self):
+        def fail(items):
+            raise ValueError('Unable to process the batch')
+
+        stats = Pipeline([Stage('group', group, batch_size=10), Stage('fail', fail, size=len)]).process(range(5))
+        self.assertEqual(stats['fail']['failed'], 5)
+        self.assertEqual(stats['fail']['out'], 0)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 99), 99)
+
+
+if __name__ == '__main__':
+    unittest.main()
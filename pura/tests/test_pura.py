@@ -0,0 +1,183 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from pura import pura
+from pura.modules.campaigns import CampaignIndex
+from pura.modules.message_store import MessageStore, FAILED, REPEATED, REPORTED
+
+TEXT = 'Your mailbox is almost full. Verify your account within 24 hours to keep receiving emails.'
+
+
+class Email:
+    def __init__(self, i, text=TEXT):
+        self.message_id = f'<{i}@example.org>'
+        self.mailbox = 'inbox'
+        self.uid = i
+        self.sender = 'it-support@example.org'
+        self.subject = 'Mailbox quota exceeded'
+        self.date = '2020-04-15 13:37:00'
+        self.html_as_text = text
+        self.hosts = ['http://verify.example.org/login']
+        self.filepath = None
+
+
+def response(eml):
+    return {'label': 1, 'class': 'Phishing', 'confidence': 0.9, 'tier': 'full', 'threat': None, 'recipient': 'hidden',
+            'sender': eml.sender, 'subject': eml.subject, 'timedate': eml.date, 'hosts': eml.hosts, 'file': None, 'eml': eml}
+
+
+class PuraTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'messages.sqlite')
+        for name, value in (('OUTBOX_FILE', ''), ('MESSAGE_STORE_FILE', self.path), ('__OUTBOX', None), ('__STORE', None),
+                            ('__CAMPAIGNS', CampaignIndex())):
+            patcher = mock.patch.object(pura, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.issues = []
+        self.comments = []
+
+    def store(self):
+        store = MessageStore(self.path)
+        self.addCleanup(store.close)
+        return store
+
+    def create_issues(self, reports):
+        keys = []
+        for report in reports:
+            self.issues.append(report)
+            keys.append(f'PURA-{len(self.issues)}')
+        return keys
+
+    def add_comment(self, issue_key, *args, **kwargs):
+        self.comments.append(issue_key)
+        return issue_key
+
+    def handle(self, emls, classify=None, create_issues=None, add_comment=None):
+        with mock.patch.object(pura, 'classify_many', classify or (lambda emls, threats=None: [response(eml) for eml in emls])), \
+                mock.patch.object(pura, 'create_issues', create_issues or self.create_issues), \
+                mock.patch.object(pura, 'add_comment_reported_again', add_comment or self.add_comment):
+            pura.handle_events(emls)
+
+
+class HandleEventsTest(PuraTestCase):
+    def test_campaign(self):
+        self.handle([Email(1), Email(2), Email(3)])
+        self.assertEqual(len(self.issues), 1)
+        self.assertEqual(self.comments, ['PURA-1', 'PURA-1'])
+        store = self.store()
+        self.assertEqual(store.get(Email(1).message_id)['status'], REPORTED)
+        self.assertEqual(store.get(Email(3).message_id)['status'], REPEATED)
+
+    def test_first_report_not_classified(self):
+        self.handle([Email(1)], classify=lambda emls, threats=None: [None] * len(emls))
+        # The next report of the campaign is its first report again
+        self.handle([Email(2), Email(3)])
+        self.assertEqual(len(self.issues), 1)
+        self.assertEqual(self.comments, ['PURA-1'])
+        store = self.store()
+        self.assertEqual(store.get(Email(1).message_id)['status'], FAILED)
+        self.assertEqual(store.get(Email(2).message_id)['status'], REPORTED)
+
+    def test_first_report_not_created(self):
+        self.handle([Email(1), Email(2)], create_issues=lambda reports: [None] * len(reports))
+        self.handle([Email(3)])
+        self.assertEqual(len(self.issues), 1)
+        store = self.store()
+        # Reports without an issue are not handled, so they are fetched again
+        self.assertEqual(store.get(Email(1).message_id)['status'], FAILED)
+        self.assertEqual(store.get(Email(2).message_id)['status'], FAILED)
+        self.assertEqual(store.get(Email(3).message_id)['status'], REPORTED)
+
+    def test_comment_not_added(self):
+        self.handle([Email(1)])
+        self.handle([Email(2)], add_comment=lambda *args, **kwargs: None)
+        self.assertEqual(self.store().get(Email(2).message_id)['status'], FAILED)
+
+
+class ConcurrentBatchesTest(PuraTestCase):
+    """Two batches of one campaign, classified and reported concurrently like the workers of `run_pipeline` do"""
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(pura, 'OUTBOX_FILE', os.path.join(os.path.dirname(self.path), 'outbox.sqlite'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pura.stop_outbox, 0)
+
+    def add_comment(self, issue_key, *args, **kwargs):
+        self.comments.append(issue_key)
+        return f'comment-{len(self.comments)}'
+
+    def split_campaign(self, classified):
+        # The first report is still being classified while the rest of its campaign is reported
+        classifying, reported = threading.Event(), threading.Event()
+
+        def classify(emls, threats=None):
+            if emls:
+                classifying.set()
+                reported.wait(5)
+            return [response(eml) if classified else None for eml in emls]
+
+        with mock.patch.object(pura, 'classify_many', classify), \
+                mock.patch.object(pura, 'create_issues', self.create_issues), \
+                mock.patch.object(pura, 'find_issues', lambda keys: {}), \
+                mock.patch.object(pura, 'add_comment_reported_again', self.add_comment):
+            first = threading.Thread(target=pura.handle_events, args=([Email(1)],))
+            first.start()
+            self.assertTrue(classifying.wait(5))
+            pura.handle_events([Email(2), Email(3)])
+            reported.set()
+            first.join()
+            pura.stop_outbox(5)
+
+    def test_first_report_classified(self):
+        self.split_campaign(classified=True)
+        self.assertEqual(len(self.issues), 1)
+        self.assertEqual(self.comments, ['PURA-1', 'PURA-1'])
+        store = self.store()
+        self.assertEqual(store.get(Email(1).message_id)['status'], REPORTED)
+        self.assertEqual(store.get(Email(2).message_id)['status'], REPEATED)
+        self.assertEqual(store.get(Email(3).message_id)['status'], REPEATED)
+
+    def test_first_report_not_classified(self):
+        self.split_campaign(classified=False)
+        self.assertEqual(self.issues, [])
+        self.assertEqual(self.comments, [])
+        store = self.store()
+        # The later reports no longer wait for an issue that will never be created
+        for i in (1, 2, 3):
+            self.assertEqual(store.get(Email(i).message_id)['status'], FAILED)
+
+
+
+class DeliverTest(PuraTestCase):
+    """Comments of the outbox that are delivered again, e.g. after a crash"""
+    def comment(self, i, attempts):
+        return {'key': Email(i).message_id, 'kind': 'comment', 'attempts': attempts, 'parent': None, 'attachment': None,
+                'payload': {'issue_key': 'PURA-1', 'email_sender': 'it-support@example.org', 'email_subject': 'Mailbox quota exceeded',
+                            'timedate': '2020-04-15 13:37:00', 'reports': 2}}
+
+    def deliver(self, records, existing):
+        with mock.patch.object(pura, 'find_comments', lambda issue_key, keys: existing), \
+                mock.patch.object(pura, 'add_comment_reported_again', self.add_comment):
+            return getattr(pura, '__deliver')(records)
+
+    def test_comment_already_added(self):
+        results = self.deliver([self.comment(1, attempts=1), self.comment(2, attempts=1), self.comment(3, attempts=0)], {Email(1).message_id: '10'})
+        self.assertEqual(results, ['PURA-1', 'PURA-1', 'PURA-1'])
+        # Only the comments that were not found are added
+        self.assertEqual(self.comments, ['PURA-1', 'PURA-1'])
+
+    def test_comments_not_readable(self):
+        results = self.deliver([self.comment(1, attempts=1), self.comment(2, attempts=0)], None)
+        self.assertEqual(results, [None, 'PURA-1'])
+        self.assertEqual(self.comments, ['PURA-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
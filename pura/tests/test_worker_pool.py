@@ -0,0 +1,57 @@
+import functools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pura.modules import worker_pool
+from pura.modules.worker_pool import WorkerPool
+
+
+def square(x):
+    return x * x
+
+
+def fail_once(path):
+    # The first worker to initialize fails
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return
+    raise RuntimeError('Unable to load the model')
+
+
+def fail(*args):
+    raise RuntimeError('Unable to load the model')
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_map(self):
+        with WorkerPool(square, workers=2) as pool:
+            self.assertEqual(pool.map([1, 2, 3, 4]), [1, 4, 9, 16])
+        self.assertEqual(pool.stats['completed'], 4)
+
+    def test_initializer_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            initializer = functools.partial(fail_once, os.path.join(directory, 'failed'))
+            with WorkerPool(square, workers=2, initializer=initializer) as pool:
+                self.assertEqual(pool.map(range(10)), [x * x for x in range(10)])
+
+    def test_initializer_failure_single_worker(self):
+        # The only worker is started again after the backoff
+        with tempfile.TemporaryDirectory() as directory:
+            initializer = functools.partial(fail_once, os.path.join(directory, 'failed'))
+            with WorkerPool(square, workers=1, initializer=initializer) as pool:
+                self.assertEqual(pool.map([3]), [9])
+
+    def test_initializer_always_fails(self):
+        # The queued tasks fail instead of waiting forever, and the pool can still be closed
+        with mock.patch.object(worker_pool, 'MAX_INIT_FAILURES', 2):
+            with WorkerPool(square, workers=2, initializer=fail) as pool:
+                self.assertEqual(pool.map([1, 2, 3]), [None, None, None])
+                self.assertEqual(pool.map([4]), [None])
+        self.assertEqual(pool.stats['failed'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -62,7 +62,7 @@ setup(
     url='https://github.com/mortea15/pura.git',
     author=__author__,
     author_email=__contact__,
-    packages=['pura', 'pura.modules', 'pura.helpers', 'pura.tests'], #find_packages(),
+    packages=['pura', 'pura.modules', 'pura.helpers', 'pura.bench', 'pura.tests'], #find_packages(),
     classifiers=classifiers,
     zip_safe=False,
     entry_points={'console_scripts': ['pura = pura.__main__:main']}